@@ -0,0 +1,300 @@
+import os
+import logging
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from fast_json import dumps, loads
+from product_cache import product_cache
+from logging_setup import payload
+from metrics import stage, timed
+from projection import selects
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of upstream calls a single request may have in flight.
+# A value of 1 disables the thread pool and fetches everything serially.
+PRODUCT_FETCH_CONCURRENCY = int(os.getenv("PRODUCT_FETCH_CONCURRENCY", "16"))
+
+# Number of unique product IDs resolved per POST /products:batchGet call.
+# Must not exceed BATCH_GET_MAX_IDS in the Product Service.
+PRODUCT_BATCH_SIZE = int(os.getenv("PRODUCT_BATCH_SIZE", "500"))
+
+# Number of orders requested from the Order Service per page when streaming.
+# Must not exceed ORDERS_PAGE_MAX_LIMIT in the Order Service.
+ORDER_STREAM_PAGE_SIZE = int(os.getenv("ORDER_STREAM_PAGE_SIZE", "100"))
+
+# Line item fields that come from the Product Service rather than the order
+PRODUCT_DETAIL_FIELDS = ("name", "price")
+
+
+def upstream_needs(fields):
+    """
+    Which upstream data a `fields` projection needs, as (with_orders,
+    with_products): the user's orders, and product details for their line
+    items. Without a projection both are needed.
+    """
+    with_orders = selects(fields, "orders")
+    with_products = any(selects(fields, "orders", "products", name) for name in PRODUCT_DETAIL_FIELDS)
+    return with_orders, with_products
+
+
+@timed("fetch_user")
+def fetch_user(client, user_id):
+    """
+    Fetch a user profile from the User Service, or None if it does not exist
+    """
+    logger.debug("Fetching user data for user ID: %s", user_id)
+    user_resp = client.invoke_method(
+        app_id="user-service",
+        method_name=f"users/{user_id}",
+        http_verb="GET"
+    )
+    if not user_resp.data:
+        return None
+    return loads(user_resp.data)
+
+
+@timed("fetch_orders")
+def fetch_orders(client, user_id):
+    """
+    Fetch all orders placed by a user from the Order Service
+    """
+    logger.debug("Fetching orders for user ID: %s", user_id)
+    orders_resp = client.invoke_method(
+        app_id="order-service",
+        method_name=f"orders?userId={user_id}",
+        http_verb="GET"
+    )
+    if not orders_resp.data:
+        logger.warning("No orders found for user: %s", user_id)
+        return []
+    orders = loads(orders_resp.data)
+    logger.debug("Retrieved %s orders", len(orders))
+    return orders
+
+
+@timed("fetch_orders_page")
+def fetch_orders_page(client, user_id, limit, cursor=None):
+    """
+    Fetch one page of a user's orders from the Order Service.
+
+    Returns (orders, next_cursor); next_cursor is None on the last page.
+    Raises ValueError if the response is not a page of orders (e.g. an
+    error for a rejected cursor), so that it does not end the stream as if
+    it were the last page.
+    """
+    params = {"userId": user_id, "limit": limit}
+    if cursor is not None:
+        params["cursor"] = cursor
+    logger.debug("Fetching orders page for user ID: %s, cursor: %s", user_id, cursor)
+    orders_resp = client.invoke_method(
+        app_id="order-service",
+        method_name=f"orders?{urlencode(params)}",
+        http_verb="GET"
+    )
+    if not orders_resp.data:
+        return [], None
+    page = loads(orders_resp.data)
+    if not isinstance(page, dict) or not isinstance(page.get("orders"), list):
+        error = page.get("error") if isinstance(page, dict) else None
+        raise ValueError(f"Order Service did not return a page of orders for user {user_id}: {error or 'no orders'}")
+    return page["orders"], page.get("nextCursor")
+
+
+@timed("fetch_products_batch")
+def fetch_products(client, product_ids):
+    """
+    Resolve a batch of product IDs with one call to the Product Service.
+
+    Returns (products, not_found): a dict of productId -> product data and the
+    IDs the Product Service reported as missing. If the call fails, times out
+    or is rejected by the circuit breaker, both are empty so that nothing is
+    recorded as missing in the product cache and the products are sent as
+    "Unknown Product".
+    """
+    logger.debug("Fetching product details for %s product IDs", len(product_ids))
+    try:
+        products_resp = client.invoke_method(
+            app_id="product-service",
+            method_name="products:batchGet",
+            data=dumps({"productIds": product_ids}),
+            content_type="application/json",
+            http_verb="POST"
+        )
+        if products_resp.data:
+            result = loads(products_resp.data)
+            not_found = result.get("notFound", [])
+            for product_id in not_found:
+                logger.warning("Product not found: %s", product_id)
+            return result.get("products", {}), not_found
+        logger.warning("Empty response fetching %s products", len(product_ids))
+    except Exception as e:
+        logger.warning("Error fetching products %s: %s", payload(product_ids), e)
+    return {}, []
+
+
+def enrich_product(product_item, product_data):
+    """
+    Merge product details with the quantity from an order line item,
+    falling back to "Unknown Product" when the details are not available
+    """
+    if product_data is None:
+        return {
+            "productId": product_item.get("productId"),
+            "name": "Unknown Product",
+            "price": 0,
+            "quantity": product_item.get("quantity", 0)
+        }
+    return {
+        "productId": product_item.get("productId"),
+        "name": product_data.get("name", "Unknown"),
+        "price": product_data.get("price", 0),
+        "quantity": product_item.get("quantity", 0)
+    }
+
+
+def build_profile_with_orders(client, user_id, concurrency=None, with_orders=True, with_products=True):
+    """
+    Build the all-details composite for a user, or None if the user does not exist.
+
+    The user and their orders are fetched in parallel, then the unique product
+    IDs are resolved in batches with at most `concurrency` calls in flight. The
+    order of orders and line items in the result matches the Order Service
+    response.
+
+    Without `with_orders` the composite has no "orders" and the Order Service
+    is not called; without `with_products` the Product Service is not called
+    and line items only have "productId" and "quantity".
+    """
+    if concurrency is None:
+        concurrency = PRODUCT_FETCH_CONCURRENCY
+
+    if concurrency <= 1 or not with_orders:
+        return _build(client, user_id, with_orders, with_products, map)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return _build(client, user_id, with_orders, with_products, executor.map, executor.submit)
+
+
+def _build(client, user_id, with_orders, with_products, map_fn, submit_fn=None):
+    # Step 1 & 2: Fetch user data and orders (in parallel when an executor is available)
+    if submit_fn is not None:
+        orders_future = submit_fn(fetch_orders, client, user_id)
+        user_data = fetch_user(client, user_id)
+        orders = orders_future.result()
+    else:
+        user_data = fetch_user(client, user_id)
+        orders = fetch_orders(client, user_id) if user_data is not None and with_orders else []
+
+    if user_data is None:
+        return None
+    logger.debug("User data retrieved: %s", payload(user_data))
+    profile = _profile_header(user_data)
+    if not with_orders:
+        return profile
+
+    # Step 3: Resolve every unique product across all orders and enrich the orders
+    products = _resolve_products(client, orders, map_fn) if with_products else None
+    with stage("enrich_orders"):
+        enriched_orders = [_enrich_order(order, products) for order in orders]
+
+    # Step 4: Combine everything into the final response
+    profile["orders"] = enriched_orders
+    return profile
+
+
+def stream_profile_with_orders(client, user_id, concurrency=None, page_size=None,
+                               with_orders=True, with_products=True):
+    """
+    Streaming variant of build_profile_with_orders.
+
+    Returns None if the user does not exist. Otherwise returns a generator that
+    yields the profile without its orders first and then every enriched order,
+    in Order Service order. Orders are read and enriched one page at a time, so
+    memory use does not grow with the number of orders a user has.
+    `with_orders` and `with_products` are as for build_profile_with_orders.
+    """
+    if concurrency is None:
+        concurrency = PRODUCT_FETCH_CONCURRENCY
+    if page_size is None:
+        page_size = ORDER_STREAM_PAGE_SIZE
+
+    user_data = fetch_user(client, user_id)
+    if user_data is None:
+        return None
+    logger.debug("User data retrieved: %s", payload(user_data))
+    return _stream(client, user_id, user_data, concurrency, page_size, with_orders, with_products)
+
+
+def _stream(client, user_id, user_data, concurrency, page_size, with_orders, with_products):
+    yield _profile_header(user_data)
+    if not with_orders:
+        return
+
+    if concurrency <= 1:
+        orders, cursor = fetch_orders_page(client, user_id, page_size)
+        while True:
+            products = _resolve_products(client, orders, map) if with_products else None
+            for order in orders:
+                yield _enrich_order(order, products)
+            if cursor is None:
+                return
+            orders, cursor = fetch_orders_page(client, user_id, page_size, cursor)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        orders, cursor = fetch_orders_page(client, user_id, page_size)
+        while True:
+            # Read the next page while the products of this one are resolved
+            next_page = executor.submit(fetch_orders_page, client, user_id, page_size, cursor) if cursor else None
+            products = _resolve_products(client, orders, executor.map) if with_products else None
+            for order in orders:
+                yield _enrich_order(order, products)
+            if next_page is None:
+                return
+            orders, cursor = next_page.result()
+
+
+@timed("resolve_products")
+def _resolve_products(client, orders, map_fn):
+    """
+    Resolve the unique products of `orders`, from the product cache where
+    possible and in batches from the Product Service otherwise
+    """
+    product_ids = list(dict.fromkeys(
+        product_item["productId"]
+        for order in orders
+        for product_item in order.get("products", [])
+        if product_item.get("productId")
+    ))
+    products, missing, generation = product_cache.get_many(product_ids)
+    batches = [
+        missing[i:i + PRODUCT_BATCH_SIZE]
+        for i in range(0, len(missing), PRODUCT_BATCH_SIZE)
+    ]
+    for fetched, not_found in map_fn(lambda batch: fetch_products(client, batch), batches):
+        products.update(fetched)
+        product_cache.put_many(fetched, not_found, generation)
+    return products
+
+
+def _enrich_order(order, products):
+    # products is None when product details were not requested
+    return {
+        "orderId": order.get("orderId"),
+        "orderDate": order.get("orderDate"),
+        "totalAmount": order.get("totalAmount"),
+        "products": [
+            enrich_product(product_item, products.get(product_item["productId"])) if products is not None
+            else {"productId": product_item["productId"], "quantity": product_item.get("quantity", 0)}
+            for product_item in order.get("products", [])
+            if product_item.get("productId")
+        ]
+    }
+
+
+def _profile_header(user_data):
+    return {
+        "userId": user_data.get("userId"),
+        "name": user_data.get("name"),
+        "email": user_data.get("email")
+    }
@@ -1,133 +1,181 @@
 import json
 import os
 import logging
-import sys
-from flask import Flask, request, jsonify
-from dapr.clients import DaprClient
+from flask import Flask, Response, request, jsonify
+from dapr_client import dapr_client, init_client
+from compression import compressible
+from fast_json import dumps, json_response
+from metrics import install_metrics, stage
+from logging_setup import configure_logging, install_correlation_ids
+from aggregator import build_profile_with_orders, stream_profile_with_orders, upstream_needs, PRODUCT_FETCH_CONCURRENCY
+from projection import parse_fields, project, project_records
+from product_cache import product_cache
+from single_flight import SingleFlight
+from resilience import CircuitOpen, Deadline, ResilientClient, UpstreamTimeout, request_deadline, upstream_stats
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
 
 # Dapr configuration
 DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
-logger.info(f"Using Dapr HTTP port: {DAPR_HTTP_PORT}")
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+PUBSUB_NAME = "product-pubsub"
+PRODUCT_UPDATES_TOPIC = "product-updates"
+NDJSON_MIMETYPE = "application/x-ndjson"
+logger.info("Using product fetch concurrency: %s", PRODUCT_FETCH_CONCURRENCY)
+logger.info("Using product cache with max entries: %s", product_cache.max_entries)
+
+# Concurrent requests for the same user (and the same upstream data) share one fan-out
+composite_flights = SingleFlight("composite")
+
+def wants_ndjson():
+    """
+    Whether the client asked for a streamed response with
+    `Accept: application/x-ndjson` or `?stream=true`
+    """
+    if request.args.get("stream", "").lower() == "true":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def ndjson_lines(records, user_id):
+    """
+    Encode records as newline-delimited JSON. Once the response has started the
+    status can no longer change, so a failure is reported as a final error line.
+    """
+    count = 0
+    try:
+        for record in records:
+            count += 1
+            yield dumps(record) + b"\n"
+        logger.info("Successfully streamed %s orders for user: %s", count - 1, user_id)
+    except Exception as e:
+        logger.error("Error streaming profile for user %s after %s records: %s", user_id, count, e, exc_info=True)
+        yield dumps({"error": str(e)}) + b"\n"
 
 @app.route('/users/<user_id>/all-details-direct', methods=['GET'])
+@compressible
 def get_profile_with_orders(user_id):
     """
     Retrieve a user's profile with their order history and product details
     Example: GET /users/123/all-details-direct
+    
+    With `Accept: application/x-ndjson` (or `?stream=true`) the profile is sent
+    as one JSON line without "orders", followed by one line per order as
+    each page of orders is enriched.
+    
+    `?fields=` limits the response to a comma-separated list of fields, e.g.
+    `fields=userId,name,orders.orderId,orders.totalAmount`. Upstream calls
+    for data that was not selected are skipped: no Order Service call without
+    an order field, and no Product Service call unless a line item's "name"
+    or "price" is selected.
+    
+    Upstream calls share a deadline of UPSTREAM_DEADLINE_MS (streamed
+    responses only have per-call timeouts). Products that cannot be fetched
+    in time are sent as "Unknown Product"; if the user or their orders cannot
+    be, the request fails with 504, or 503 while the circuit is open.
+    
+    JSON responses are compressed according to Accept-Encoding.
     """
-    logger.info(f"GET /users/{user_id}/all-details-direct request")
+    logger.info("GET /users/%s/all-details-direct request", user_id)
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        logger.warning("Invalid fields for user %s: %s", user_id, e)
+        return jsonify({"error": str(e)}), 400
+    with_orders, with_products = upstream_needs(fields)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            # Step 1: Fetch User Data from User Service
-            logger.debug(f"Fetching user data for user ID: {user_id}")
-            user_resp = client.invoke_method(
-                app_id="user-service",
-                method_name=f"users/{user_id}",
-                http_verb="GET"
-            )
+            if wants_ndjson():
+                records = stream_profile_with_orders(
+                    ResilientClient(client, Deadline(None)), user_id, with_orders=with_orders, with_products=with_products
+                )
+                if records is None:
+                    logger.warning("User not found: %s", user_id)
+                    return jsonify({"error": "User not found"}), 404
+                if fields is not None:
+                    records = project_records(records, fields)
+                return Response(ndjson_lines(records, user_id), mimetype=NDJSON_MIMETYPE), 200
             
-            # Check if we have user data
-            if not user_resp.data:
-                logger.warning(f"User not found: {user_id}")
-                return jsonify({"error": "User not found"}), 404
-            
-            user_data = json.loads(user_resp.data.decode('utf-8'))
-            logger.debug(f"User data retrieved: {user_data}")
-            
-            # Step 2: Fetch Orders from Order Service
-            logger.debug(f"Fetching orders for user ID: {user_id}")
-            orders_resp = client.invoke_method(
-                app_id="order-service",
-                method_name=f"orders?userId={user_id}",
-                http_verb="GET"
+            profile_with_orders = composite_flights.do(
+                (user_id, with_orders, with_products),
+                lambda: build_profile_with_orders(
+                    ResilientClient(client, request_deadline()), user_id, with_orders=with_orders, with_products=with_products
+                )
             )
+            if profile_with_orders is None:
+                logger.warning("User not found: %s", user_id)
+                return jsonify({"error": "User not found"}), 404
+            if fields is not None:
+                profile_with_orders = project(profile_with_orders, fields)
             
-            # Check if we have orders data
-            if not orders_resp.data:
-                logger.warning(f"No orders found for user: {user_id}")
-                orders = []
-            else:
-                orders = json.loads(orders_resp.data.decode('utf-8'))
-                logger.debug(f"Retrieved {len(orders)} orders")
-            
-            # Step 3: Fetch Product Details for each product in the orders
-            enriched_orders = []
-            for order in orders:
-                enriched_products = []
-                for product_item in order.get("products", []):
-                    product_id = product_item.get("productId")
-                    if product_id:
-                        logger.debug(f"Fetching product details for product ID: {product_id}")
-                        try:
-                            product_resp = client.invoke_method(
-                                app_id="product-service",
-                                method_name=f"products/{product_id}",
-                                http_verb="GET"
-                            )
-                            
-                            if product_resp.data:
-                                product_data = json.loads(product_resp.data.decode('utf-8'))
-                                # Merge product details with quantity from order
-                                enriched_product = {
-                                    "productId": product_id,
-                                    "name": product_data.get("name", "Unknown"),
-                                    "price": product_data.get("price", 0),
-                                    "quantity": product_item.get("quantity", 0)
-                                }
-                                enriched_products.append(enriched_product)
-                            else:
-                                logger.warning(f"Product not found: {product_id}")
-                                # Include basic info if product details not found
-                                enriched_products.append({
-                                    "productId": product_id,
-                                    "name": "Unknown Product",
-                                    "price": 0,
-                                    "quantity": product_item.get("quantity", 0)
-                                })
-                        except Exception as e:
-                            logger.warning(f"Error fetching product {product_id}: {str(e)}")
-                            enriched_products.append({
-                                "productId": product_id,
-                                "name": "Unknown Product",
-                                "price": 0,
-                                "quantity": product_item.get("quantity", 0)
-                            })
-                
-                # Create enriched order with detailed product information
-                enriched_order = {
-                    "orderId": order.get("orderId"),
-                    "orderDate": order.get("orderDate"),
-                    "totalAmount": order.get("totalAmount"),
-                    "products": enriched_products
-                }
-                enriched_orders.append(enriched_order)
-            
-            # Step 4: Combine everything into the final response
-            profile_with_orders = {
-                "userId": user_data.get("userId"),
-                "name": user_data.get("name"),
-                "email": user_data.get("email"),
-                "orders": enriched_orders
-            }
-            
-            logger.info(f"Successfully retrieved profile with orders for user: {user_id}")
-            return jsonify(profile_with_orders), 200
+            with stage("serialize"):
+                response = json_response(profile_with_orders)
+            logger.info("Successfully retrieved profile with orders for user: %s", user_id)
+            return response, 200
         
+        except UpstreamTimeout as e:
+            logger.warning("Upstream timeout for user %s: %s", user_id, e)
+            return jsonify({"error": str(e)}), 504
+        except CircuitOpen as e:
+            logger.warning("Upstream unavailable for user %s: %s", user_id, e)
+            return jsonify({"error": str(e)}), 503
         except Exception as e:
-            logger.error(f"Error in get_profile_with_orders: {str(e)}", exc_info=True)
+            logger.error("Error in get_profile_with_orders: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
+@app.route('/dapr/subscribe', methods=['GET'])
+def subscribe():
+    """
+    Programmatic Dapr subscription to product change events
+    """
+    return jsonify([{
+        "pubsubname": PUBSUB_NAME,
+        "topic": PRODUCT_UPDATES_TOPIC,
+        "route": "/events/product-updates"
+    }]), 200
+
+@app.route('/events/product-updates', methods=['POST'])
+def on_product_updated():
+    """
+    Evict a changed product from the product cache
+    Example CloudEvent data:
+    {
+      "productId": "p1"
+    }
+    """
+    event = request.json or {}
+    data = event.get("data") or {}
+    if isinstance(data, str):
+        data = json.loads(data)
+    product_id = data.get("productId")
+    logger.info("Product update event received for product: %s", product_id)
+    
+    if product_id:
+        product_cache.invalidate(product_id)
+    else:
+        logger.warning("Product update event without productId: %s", event.get('id'))
+    return jsonify({"status": "SUCCESS"}), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    Product cache hit, miss and eviction counters
+    """
+    return jsonify(product_cache.stats()), 200
+
+@app.route('/upstream/stats', methods=['GET'])
+def upstream_stats_route():
+    """
+    Circuit breaker state and hedging counters per upstream app ID
+    """
+    return jsonify(upstream_stats()), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
@@ -144,5 +192,6 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting all-details-direct Service application")
-    logger.info(f"Server running on 0.0.0.0:5000")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000)
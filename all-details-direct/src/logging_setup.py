@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import queue
+import uuid
+import random
+import atexit
+import logging
+import threading
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# Root log level, e.g. DEBUG, INFO, WARNING
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Longest rendering of a request or state payload in a log line; 0 logs only its shape
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "256"))
+# Fraction of payloads rendered at all; the rest are logged by shape only
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+# Records waiting for the writer thread; further records below ERROR are dropped,
+# not waited on, and ERROR and above are written by the caller instead
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+CORRELATION_HEADER = "X-Correlation-ID"
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+
+
+class _CorrelationFilter(logging.Filter):
+    # Runs in the thread that emitted the record, where the request context is visible
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread without waiting for it. Records below
+    ERROR that do not fit in the queue are counted and dropped; ERROR and
+    above are written to `fallback` by the caller, so errors are never lost.
+    """
+
+    def __init__(self, log_queue, fallback):
+        super().__init__(log_queue)
+        self.fallback = fallback
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments now, so objects mutated after the call cannot
+        # change the message. Formatting, including tracebacks, is left to
+        # the writer thread; the queue never leaves the process.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                # The writer thread shares the handler and its lock, so lines do not interleave
+                self.fallback.handle(record)
+            else:
+                self.dropped += 1
+
+
+def configure_logging():
+    """
+    Send all log records through a bounded queue to a background thread that
+    writes them to stdout. Safe to call more than once; a process that was
+    forked after configuring starts its own writer thread.
+    """
+    global _listener, _handler
+    with _lock:
+        if _listener is not None and _listener.pid == os.getpid():
+            return
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler = _DroppingQueueHandler(log_queue, stream_handler)
+        handler.addFilter(_CorrelationFilter())
+
+        root = logging.getLogger()
+        if _handler is not None:
+            root.removeHandler(_handler)
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+
+        listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        listener.pid = os.getpid()
+        listener.start()
+        _listener, _handler = listener, handler
+
+
+def flush_logging():
+    """
+    Stop the writer thread after it has written every queued record
+    """
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None and listener.pid == os.getpid():
+        listener.stop()
+
+
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
+
+
+atexit.register(flush_logging)
+
+
+def payload(value):
+    """
+    Lazily rendered, size-capped view of a payload for log messages:
+    logger.debug("User data retrieved: %s", payload(user_data))
+
+    Nothing is serialized unless the record is actually emitted.
+    """
+    return _Payload(value)
+
+
+class _Payload:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if LOG_PAYLOAD_MAX_CHARS <= 0 or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+            return _shape(value)
+        parts = []
+        size = 0
+        # Stop walking the payload once the cap is reached, so a large payload
+        # costs no more to log than a small one
+        for part in _iter_json(value):
+            parts.append(part)
+            size += len(part)
+            if size > LOG_PAYLOAD_MAX_CHARS:
+                return f"{''.join(parts)[:LOG_PAYLOAD_MAX_CHARS]}... ({_shape(value)})"
+        return ''.join(parts)
+
+
+def _iter_json(value):
+    if isinstance(value, dict):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield f"{', ' if i else ''}{json.dumps(str(key))}: "
+            yield from _iter_json(item)
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from _iter_json(item)
+        yield "]"
+    elif isinstance(value, bytes):
+        yield json.dumps(value[:LOG_PAYLOAD_MAX_CHARS + 1].decode('utf-8', 'replace'))
+    elif isinstance(value, str):
+        yield json.dumps(value[:LOG_PAYLOAD_MAX_CHARS + 1])
+    elif value is None or isinstance(value, (bool, int, float)):
+        yield json.dumps(value)
+    else:
+        yield json.dumps(str(value))
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return f"<dict with {len(value)} keys>"
+    if isinstance(value, (list, tuple)):
+        return f"<{type(value).__name__} with {len(value)} items>"
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} of length {len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def install_correlation_ids(app):
+    """
+    Tag every log record of a request with its correlation ID. The ID is taken
+    from the X-Correlation-ID request header, or generated, and is echoed in
+    the response.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _bind_correlation_id():
+        incoming = request.headers.get(CORRELATION_HEADER, "")
+        g.correlation_token = correlation_id.set(incoming[:64] or uuid.uuid4().hex[:16])
+
+    @app.after_request
+    def _echo_correlation_id(response):
+        response.headers[CORRELATION_HEADER] = correlation_id.get()
+        return response
+
+    @app.teardown_request
+    def _unbind_correlation_id(exc):
+        token = g.pop("correlation_token", None)
+        if token is not None:
+            correlation_id.reset(token)
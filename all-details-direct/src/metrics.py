@@ -0,0 +1,193 @@
+import os
+import time
+import logging
+import functools
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Set to "false" to turn all instrumentation into no-ops
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Directory shared by gunicorn workers for multi-process metrics; unset for a single process
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+
+# Latency buckets from 0.5ms to 10s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Size buckets from 128 bytes to 16MiB
+SIZE_BUCKETS = tuple(128 * 4 ** i for i in range(10))
+
+# Metrics every service records; those of features only some services have
+# are defined next to the feature
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests currently being handled",
+    ["route"], multiprocess_mode="livesum"
+)
+REQUEST_SIZE = Histogram(
+    "http_request_size_bytes", "Size of request bodies",
+    ["route"], buckets=SIZE_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Size of non-streamed response bodies",
+    ["route"], buckets=SIZE_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds", "Time spent in a stage of request processing",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+DAPR_CALL_LATENCY = Histogram(
+    "dapr_call_duration_seconds", "Latency of calls to the Dapr sidecar",
+    ["operation", "target", "outcome"], buckets=LATENCY_BUCKETS
+)
+DAPR_CALL_ERRORS = Counter(
+    "dapr_call_errors", "Calls to the Dapr sidecar that raised",
+    ["operation", "target"]
+)
+DAPR_PAYLOAD_SIZE = Histogram(
+    "dapr_payload_size_bytes", "Size of payloads sent to and received from the Dapr sidecar",
+    ["operation", "direction"], buckets=SIZE_BUCKETS
+)
+
+# Request arguments carrying the payload that is sent, per client method
+_SENT_PAYLOADS = {"save_state": "value", "invoke_method": "data", "publish_event": "data"}
+
+_children = {}
+
+
+def labelled(metric, *labels):
+    """
+    The child of `metric` for `labels`. metric.labels() validates and locks
+    on every call; label sets are few, so each one is resolved once.
+    """
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+    return child
+
+
+@contextmanager
+def _timed_stage(name):
+    child = labelled(STAGE_LATENCY, name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        child.observe(time.perf_counter() - start)
+
+
+def stage(name):
+    """
+    Time a block as one stage of request processing:
+    with stage("fetch_user"):
+        ...
+    """
+    if not METRICS_ENABLED:
+        return nullcontext()
+    return _timed_stage(name)
+
+
+def timed(name):
+    """
+    Decorator that times every call of a function as stage `name`
+    """
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _timed_stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe_dapr_call(operation, kwargs, elapsed, result=None, failed=False):
+    """
+    Record one client call. Called by dapr_client for every call made
+    through the shared clients.
+    """
+    if not METRICS_ENABLED:
+        return
+    target = kwargs.get("store_name") or kwargs.get("app_id") or kwargs.get("pubsub_name") or ""
+    labelled(DAPR_CALL_LATENCY, operation, target, "error" if failed else "ok").observe(elapsed)
+    if failed:
+        labelled(DAPR_CALL_ERRORS, operation, target).inc()
+        return
+    sent = kwargs.get(_SENT_PAYLOADS.get(operation, ""))
+    if sent:
+        labelled(DAPR_PAYLOAD_SIZE, operation, "sent").observe(len(sent))
+    received = getattr(result, "data", None)
+    if isinstance(received, (bytes, str)):
+        labelled(DAPR_PAYLOAD_SIZE, operation, "received").observe(len(received))
+
+
+def install_metrics(app):
+    """
+    Record latency, in-flight count and body sizes for every request of
+    `app` and serve them from GET /metrics
+    """
+    from flask import Response, g, request
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """
+        Prometheus metrics in the text exposition format
+        """
+        if PROMETHEUS_MULTIPROC_DIR:
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+    if not METRICS_ENABLED:
+        return
+
+    def route_label():
+        rule = request.url_rule
+        return rule.rule if rule is not None else "unmatched"
+
+    @app.before_request
+    def _start_request():
+        route = route_label()
+        g.metrics_route = route
+        g.metrics_start = time.perf_counter()
+        labelled(REQUESTS_IN_FLIGHT, route).inc()
+        if request.content_length:
+            labelled(REQUEST_SIZE, route).observe(request.content_length)
+
+    @app.after_request
+    def _finish_request(response):
+        route = g.pop("metrics_route", None)
+        if route is None:
+            return response
+        labelled(REQUESTS_IN_FLIGHT, route).dec()
+        labelled(REQUEST_LATENCY, route, request.method, str(response.status_code)).observe(
+            time.perf_counter() - g.pop("metrics_start")
+        )
+        if not response.is_streamed and response.content_length is not None:
+            labelled(RESPONSE_SIZE, route).observe(response.content_length)
+        return response
+
+    @app.teardown_request
+    def _abandon_request(exc):
+        # Requests that raised past the route never reach after_request
+        route = g.pop("metrics_route", None)
+        if route is not None:
+            labelled(REQUESTS_IN_FLIGHT, route).dec()
+            labelled(REQUEST_LATENCY, route, request.method, "500").observe(
+                time.perf_counter() - g.pop("metrics_start")
+            )
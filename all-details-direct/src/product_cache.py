@@ -0,0 +1,196 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of products held in memory; 0 disables the cache
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "10000"))
+# Seconds a fetched product stays valid
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "300"))
+# Seconds a "product not found" answer stays valid
+PRODUCT_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL_SECONDS", "30"))
+# File through which the worker processes of one pod share product invalidations;
+# empty to keep them per process
+PRODUCT_CACHE_VERSIONS_FILE = os.getenv("PRODUCT_CACHE_VERSIONS_FILE", "")
+# Number of version counters in that file; products are hashed onto them
+PRODUCT_CACHE_VERSION_SLOTS = int(os.getenv("PRODUCT_CACHE_VERSION_SLOTS", "65536"))
+
+_VERSION = struct.Struct("<Q")
+
+
+class SharedVersions:
+    """
+    Product version counters shared by the processes that map the same file.
+
+    Invalidating a product bumps its counter; a cached entry is only valid
+    while the counter still has the value it was fetched under, so an
+    invalidation received by one gunicorn worker evicts the product from the
+    caches of all of them. Products share counters by hash, which can only
+    cause extra misses.
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = slots * _VERSION.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED)
+
+    def _offset(self, product_id):
+        return (zlib.crc32(product_id.encode("utf-8")) % self.slots) * _VERSION.size
+
+    def get(self, product_id):
+        return _VERSION.unpack_from(self._map, self._offset(product_id))[0]
+
+    def bump(self, product_id):
+        offset = self._offset(product_id)
+        # Serialize bumps across processes so none is lost
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            _VERSION.pack_into(self._map, offset, _VERSION.unpack_from(self._map, offset)[0] + 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class ProductCache:
+    """
+    Bounded, thread-safe LRU cache of product documents with a per-entry TTL.
+
+    A cached value of None records that the Product Service reported the
+    product as missing (negative caching), which expires after `negative_ttl`.
+    With `versions` (SharedVersions), invalidations made by other processes
+    also evict entries.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl, clock=time.monotonic, versions=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._versions = versions
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get_many(self, product_ids):
+        """
+        Look up several products at once.
+
+        Returns (cached, missing, generation): a dict of productId -> product
+        (or None for a cached miss), the IDs that must be fetched, and a token
+        to pass to put_many for the fetched results.
+        """
+        cached = {}
+        missing = []
+        versions = {}
+        now = self._clock()
+        with self._lock:
+            for product_id in product_ids:
+                entry = self._entries.get(product_id)
+                if entry is not None and entry[1] <= now:
+                    del self._entries[product_id]
+                    self.expirations += 1
+                    entry = None
+                if self._versions is not None:
+                    versions[product_id] = self._versions.get(product_id)
+                    if entry is not None and entry[2] != versions[product_id]:
+                        # Invalidated by another process
+                        del self._entries[product_id]
+                        self.invalidations += 1
+                        entry = None
+                if entry is None:
+                    self.misses += 1
+                    missing.append(product_id)
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(product_id)
+                    cached[product_id] = entry[0]
+            return cached, missing, (self._generation, versions)
+
+    def put_many(self, products, not_found, generation):
+        """
+        Store fetched products and confirmed misses.
+
+        Results are dropped if any invalidation happened since the matching
+        get_many call, so a fetch that raced with an update cannot re-insert
+        stale data. Entries keep the shared versions read by get_many, so an
+        invalidation made by another process in the meantime evicts them on
+        their next lookup.
+        """
+        if not self.enabled:
+            return
+        generation, versions = generation
+        now = self._clock()
+        with self._lock:
+            if generation != self._generation:
+                logger.debug("Skipping product cache fill after concurrent invalidation")
+                return
+            for product_id, product_data in products.items():
+                self._set(product_id, product_data, now + self.ttl, versions.get(product_id, 0))
+            for product_id in not_found:
+                self._set(product_id, None, now + self.negative_ttl, versions.get(product_id, 0))
+
+    def _set(self, product_id, value, expires_at, version):
+        self._entries[product_id] = (value, expires_at, version)
+        self._entries.move_to_end(product_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, product_id):
+        """
+        Drop a product from the cache after it has been changed upstream, in
+        this process and, with shared versions, in every other one
+        """
+        with self._lock:
+            self._generation += 1
+            if self._versions is not None:
+                self._versions.bump(product_id)
+            if self._entries.pop(product_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+
+product_cache = ProductCache(
+    max_entries=PRODUCT_CACHE_MAX_ENTRIES,
+    ttl=PRODUCT_CACHE_TTL_SECONDS,
+    negative_ttl=PRODUCT_CACHE_NEGATIVE_TTL_SECONDS,
+    versions=(
+        SharedVersions(PRODUCT_CACHE_VERSIONS_FILE, PRODUCT_CACHE_VERSION_SLOTS)
+        if PRODUCT_CACHE_VERSIONS_FILE and PRODUCT_CACHE_MAX_ENTRIES > 0 else None
+    )
+)
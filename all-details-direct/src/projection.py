@@ -0,0 +1,102 @@
+# Fields of the all-details composite that `fields=` can select. None marks a
+# leaf; a nested dict lists the fields of each element of an array or object.
+COMPOSITE_FIELDS = {
+    "userId": None,
+    "name": None,
+    "email": None,
+    "orders": {
+        "orderId": None,
+        "orderDate": None,
+        "totalAmount": None,
+        "products": {
+            "productId": None,
+            "name": None,
+            "price": None,
+            "quantity": None
+        }
+    }
+}
+
+
+def parse_fields(value):
+    """
+    Parse a `fields` query parameter, a comma-separated list of dotted paths
+    such as "userId,name,orders.orderId,orders.totalAmount", into a tree of
+    selected fields in which True selects a field with everything under it.
+
+    Returns None when the parameter is absent, meaning the whole composite.
+    Raises ValueError for an empty list or a path that is not in the
+    composite.
+    """
+    if value is None:
+        return None
+    paths = [path.strip() for path in value.split(",") if path.strip()]
+    if not paths:
+        raise ValueError("fields must list at least one field")
+    selected = {}
+    for path in paths:
+        names = path.split(".")
+        schema = COMPOSITE_FIELDS
+        node = selected
+        for i, name in enumerate(names):
+            if schema is None or name not in schema:
+                raise ValueError(f"Unknown field: {path}")
+            schema = schema[name]
+            if node.get(name) is True:
+                break
+            if i == len(names) - 1:
+                # Selecting a field selects everything under it
+                node[name] = True
+            else:
+                node = node.setdefault(name, {})
+    return selected
+
+
+def selects(fields, *path):
+    """
+    Whether a projection keeps any part of the field at `path`
+    """
+    node = fields
+    for name in path:
+        if node is None or node is True:
+            return True
+        node = node.get(name)
+        if node is None:
+            return False
+    return True
+
+
+def project(value, fields):
+    """
+    Keep only the selected fields of a composite, an order or a line item,
+    applying the selection to each element of arrays. The value is not
+    modified.
+    """
+    if fields is None or fields is True:
+        return value
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: project(item, fields[key]) for key, item in value.items() if key in fields}
+    return value
+
+
+def project_records(records, fields):
+    """
+    Apply a projection to streamed records: the profile without its orders
+    first, then one record per order. When no order field is selected the
+    stream ends after the profile, without reading the orders.
+    """
+    records = iter(records)
+    profile = next(records, None)
+    if profile is None:
+        return
+    yield project(profile, fields)
+    if not selects(fields, "orders"):
+        close = getattr(records, "close", None)
+        if close is not None:
+            close()
+        return
+    order_fields = None if fields is None else fields["orders"]
+    for order in records:
+        yield project(order, order_fields)
@@ -0,0 +1,366 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import grpc
+from prometheus_client import Counter, Gauge
+
+from metrics import METRICS_ENABLED, labelled
+
+logger = logging.getLogger(__name__)
+
+# Time budget in milliseconds for all upstream calls of one request; 0 disables the deadline
+UPSTREAM_DEADLINE_MS = float(os.getenv("UPSTREAM_DEADLINE_MS", "5000"))
+# Longest a single upstream call may take in milliseconds, within what is left of the deadline
+UPSTREAM_CALL_TIMEOUT_MS = float(os.getenv("UPSTREAM_CALL_TIMEOUT_MS", "2000"))
+# Consecutive failed calls to an app ID that open its circuit
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit fails calls immediately before letting one trial call through
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "10"))
+# Set to "true" to send a second copy of a read that is slower than usual
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+# Percentile of an app ID's recent call latencies after which a read is hedged
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Lower bound in milliseconds of the hedge delay, so fast reads are never doubled
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "5"))
+# Threads running hedged calls, shared by all requests of a process
+HEDGE_MAX_THREADS = int(os.getenv("HEDGE_MAX_THREADS", "32"))
+
+# Recent latencies kept per app ID, and calls seen before hedging starts
+LATENCY_WINDOW = 512
+HEDGE_MIN_SAMPLES = 50
+# Read-only methods invoked with POST, as safe to repeat as a GET
+IDEMPOTENT_METHODS = {"products:batchGet"}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+_TIMEOUT_CODES = (grpc.StatusCode.DEADLINE_EXCEEDED,)
+
+UPSTREAM_EVENTS = Counter(
+    "upstream_events", "Upstream call timeouts, circuit breaker rejections and hedged calls",
+    ["target", "event"]
+)
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state", "Circuit breaker state per target: 0 closed, 1 half-open, 2 open",
+    ["target"], multiprocess_mode="max"
+)
+
+_CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def observe_upstream(target, event):
+    """
+    Count a timeout, circuit breaker rejection or hedged call for a target
+    """
+    if not METRICS_ENABLED:
+        return
+    labelled(UPSTREAM_EVENTS, target, event).inc()
+
+
+def set_circuit_state(target, state):
+    """
+    Record a target's circuit breaker state (CLOSED, HALF_OPEN or OPEN)
+    """
+    if not METRICS_ENABLED:
+        return
+    labelled(CIRCUIT_STATE, target).set(_CIRCUIT_STATES[state])
+
+
+class UpstreamTimeout(Exception):
+    """
+    An upstream call did not finish within its timeout or the request deadline
+    """
+
+
+class CircuitOpen(Exception):
+    """
+    An upstream call was not attempted because the target's circuit is open
+    """
+
+
+class Deadline:
+    """
+    Point in time by which all upstream calls of a request must finish.
+    A budget of None never expires.
+    """
+
+    def __init__(self, budget, clock=time.monotonic):
+        self._clock = clock
+        self.expires_at = None if budget is None else clock() + budget
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - self._clock()
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an app ID immediately after `threshold` consecutive
+    failures. After `open_seconds` one trial call is let through: its success
+    closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, target, threshold, open_seconds, clock=time.monotonic):
+        self.target = target
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+
+    def allow(self):
+        """
+        Raise CircuitOpen unless a call may be made now
+        """
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and self._clock() - self.opened_at >= self.open_seconds:
+                logger.info("Circuit for %s half-open, letting a trial call through", self.target)
+                self._set_state(HALF_OPEN)
+                return
+            self.rejected += 1
+        observe_upstream(self.target, "rejected")
+        raise CircuitOpen(f"Circuit for {self.target} is open")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                logger.info("Circuit for %s closed", self.target)
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and 0 < self.threshold <= self.failures):
+                logger.warning("Circuit for %s open after %s consecutive failures", self.target, self.failures)
+                self.opened_at = self._clock()
+                self._set_state(OPEN)
+
+    def _set_state(self, state):
+        # Callers hold self._lock
+        self.state = state
+        set_circuit_state(self.target, state)
+
+
+class LatencyTracker:
+    """
+    Recent call latencies of an app ID, used to pick the hedge delay
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._cached = {}
+
+    def add(self, elapsed):
+        with self._lock:
+            self._samples.append(elapsed)
+            self._count += 1
+
+    def percentile(self, p):
+        """
+        Latency below which p percent of recent calls finished, or None
+        before enough calls have been seen. Recomputed every 32 calls.
+        """
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            cached = self._cached.get(p)
+            if cached is not None and self._count - cached[0] < 32:
+                return cached[1]
+            samples = sorted(self._samples)
+            value = samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+            self._cached[p] = (self._count, value)
+            return value
+
+
+class Upstream:
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.breaker = CircuitBreaker(app_id, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS)
+        self.latency = LatencyTracker()
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def count_hedge(self, won=False):
+        # Hedges of concurrent requests finish on different threads
+        with self.breaker._lock:
+            if won:
+                self.hedges_won += 1
+            else:
+                self.hedged += 1
+
+    def hedge_delay(self):
+        threshold = self.latency.percentile(HEDGE_PERCENTILE)
+        if threshold is None:
+            return None
+        return max(threshold, HEDGE_MIN_DELAY_MS / 1000)
+
+    def stats(self):
+        delay = self.hedge_delay()
+        return {
+            "circuit": self.breaker.state,
+            "consecutiveFailures": self.breaker.failures,
+            "rejected": self.breaker.rejected,
+            "hedged": self.hedged,
+            "hedgesWon": self.hedges_won,
+            "hedgeDelayMs": None if delay is None else round(delay * 1000, 2)
+        }
+
+
+_lock = threading.Lock()
+_upstreams = {}
+_hedge_pool = None
+_hedge_pool_pid = None
+
+
+def upstream_for(app_id):
+    upstream = _upstreams.get(app_id)
+    if upstream is None:
+        with _lock:
+            upstream = _upstreams.setdefault(app_id, Upstream(app_id))
+    return upstream
+
+
+def request_deadline():
+    """
+    Deadline for the upstream calls of a request starting now
+    """
+    return Deadline(UPSTREAM_DEADLINE_MS / 1000 if UPSTREAM_DEADLINE_MS > 0 else None)
+
+
+def upstream_stats():
+    """
+    Circuit state and hedging counters per app ID
+    """
+    return {app_id: upstream.stats() for app_id, upstream in list(_upstreams.items())}
+
+
+def _hedge_executor():
+    global _hedge_pool, _hedge_pool_pid
+    with _lock:
+        # Threads do not survive fork(); start the pool in the process that uses it
+        if _hedge_pool is None or _hedge_pool_pid != os.getpid():
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_THREADS, thread_name_prefix="hedge")
+            _hedge_pool_pid = os.getpid()
+        return _hedge_pool
+
+
+def _is_timeout(e):
+    if isinstance(e, TimeoutError):
+        return True
+    return isinstance(e, grpc.RpcError) and e.code() in _TIMEOUT_CODES
+
+
+class ResilientClient:
+    """
+    Wraps a Dapr client for the upstream calls of one request.
+
+    Every invoke_method call is bounded by the request's deadline and by
+    UPSTREAM_CALL_TIMEOUT_MS, fails fast while the target's circuit is open,
+    and, when hedging is enabled, is repeated once for reads still running
+    after the target's HEDGE_PERCENTILE latency; the first answer wins.
+    Other client methods are passed through unchanged.
+    """
+
+    def __init__(self, client, deadline):
+        self._client = client
+        self.deadline = deadline
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _timeout(self, app_id):
+        timeout = UPSTREAM_CALL_TIMEOUT_MS / 1000 if UPSTREAM_CALL_TIMEOUT_MS > 0 else None
+        remaining = self.deadline.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                observe_upstream(app_id, "deadline_exceeded")
+                raise UpstreamTimeout(f"Request deadline exceeded before calling {app_id}")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def invoke_method(self, app_id, method_name, http_verb=None, **kwargs):
+        upstream = upstream_for(app_id)
+        timeout = self._timeout(app_id)
+        upstream.breaker.allow()
+        if HEDGE_ENABLED and (http_verb == "GET" or method_name in IDEMPOTENT_METHODS):
+            delay = upstream.hedge_delay()
+            if delay is not None and (timeout is None or delay < timeout):
+                return self._hedged(upstream, delay, timeout, method_name, http_verb, kwargs)
+        return self._attempt(upstream, timeout, method_name, http_verb, kwargs)
+
+    def _attempt(self, upstream, timeout, method_name, http_verb, kwargs, settled=None):
+        """
+        One call to the upstream. `settled` is set once another copy of a
+        hedged call has answered; a copy failing after that says nothing about
+        the upstream the winner did not already, so it is not counted.
+        """
+        start = time.perf_counter()
+        try:
+            result = self._client.invoke_method(
+                app_id=upstream.app_id, method_name=method_name, http_verb=http_verb, timeout=timeout, **kwargs
+            )
+        except Exception as e:
+            if settled is not None and settled.is_set():
+                raise
+            upstream.breaker.record_failure()
+            if _is_timeout(e):
+                observe_upstream(upstream.app_id, "timeout")
+                raise UpstreamTimeout(f"Call to {upstream.app_id} timed out") from e
+            raise
+        upstream.latency.add(time.perf_counter() - start)
+        upstream.breaker.record_success()
+        return result
+
+    def _hedged(self, upstream, delay, timeout, method_name, http_verb, kwargs):
+        executor = _hedge_executor()
+        started = time.monotonic()
+        settled = threading.Event()
+        primary = executor.submit(self._attempt, upstream, timeout, method_name, http_verb, kwargs, settled)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        # Still running after the usual latency: send a second copy, unless the
+        # circuit has opened or too little time is left for it to help
+        try:
+            hedge_timeout = self._timeout(upstream.app_id)
+            upstream.breaker.allow()
+        except (CircuitOpen, UpstreamTimeout):
+            return primary.result()
+        logger.debug("Hedging %s %s after %.1fms", upstream.app_id, method_name, delay * 1000)
+        upstream.count_hedge()
+        observe_upstream(upstream.app_id, "hedged")
+        hedge = executor.submit(self._attempt, upstream, hedge_timeout, method_name, http_verb, kwargs, settled)
+
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            remaining = None if timeout is None else timeout - (time.monotonic() - started)
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                # The losing calls finish in the background within their own timeouts
+                observe_upstream(upstream.app_id, "timeout")
+                raise UpstreamTimeout(f"Hedged call to {upstream.app_id} timed out")
+            for future in done:
+                if future.exception() is None:
+                    settled.set()
+                    if future is hedge:
+                        upstream.count_hedge(won=True)
+                        observe_upstream(upstream.app_id, "hedge_won")
+                    return future.result()
+                error = error or future.exception()
+        raise error
@@ -0,0 +1,146 @@
+import os
+import logging
+import threading
+
+from prometheus_client import Counter
+
+from metrics import METRICS_ENABLED, labelled
+
+logger = logging.getLogger(__name__)
+
+# Set to "false" to run every call on its own instead of sharing in-flight ones
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls", "Calls through a single-flight group, run or shared with one in flight",
+    ["group", "role"]
+)
+
+
+def observe_single_flight(group, executed, shared):
+    """
+    Count the keys a single-flight group fetched and those it shared
+    """
+    if not METRICS_ENABLED:
+        return
+    if executed:
+        labelled(SINGLE_FLIGHT_CALLS, group, "executed").inc(executed)
+    if shared:
+        labelled(SINGLE_FLIGHT_CALLS, group, "shared").inc(shared)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key within a process.
+
+    The first caller for a key (the leader) runs the fetch; callers that
+    arrive while it is in flight wait for it and receive the same result, or
+    the same exception. Once the fetch finishes the key is forgotten, so
+    nothing is cached beyond the calls that overlapped with it. Results are
+    shared between callers and must not be mutated.
+    """
+
+    def __init__(self, name, enabled=None):
+        self.name = name
+        self.enabled = SINGLE_FLIGHT_ENABLED if enabled is None else enabled
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def _join(self, keys):
+        # Returns (calls led by this caller, calls led by others) per key
+        led = {}
+        joined = {}
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    led[key] = self._calls[key] = _Call()
+                else:
+                    joined[key] = call
+            self.executed += len(led)
+            self.shared += len(joined)
+        observe_single_flight(self.name, len(led), len(joined))
+        return led, joined
+
+    def _finish(self, led):
+        with self._lock:
+            for key in led:
+                del self._calls[key]
+        for call in led.values():
+            call.done.set()
+
+    @staticmethod
+    def _wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, fetch):
+        """
+        Return fetch(), sharing it with concurrent calls for the same key
+        """
+        if not self.enabled:
+            return fetch()
+        led, joined = self._join([key])
+        if joined:
+            logger.debug("Joining in-flight %s call for %s", self.name, key)
+            return self._wait(joined[key])
+        call = led[key]
+        try:
+            call.result = fetch()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(led)
+
+    def do_many(self, keys, fetch_many):
+        """
+        Resolve several keys at once. fetch_many(keys) is called only for the
+        keys that are not already in flight and must return a dict with an
+        entry for each of them; the others are taken from the calls in flight.
+        Returns a dict of key -> result.
+        """
+        if not self.enabled:
+            return fetch_many(list(keys))
+        led, joined = self._join(list(dict.fromkeys(keys)))
+        results = {}
+        if led:
+            # Fetch this caller's own keys before waiting on anyone else's, so
+            # two callers leading each other's keys cannot wait on each other
+            try:
+                fetched = fetch_many(list(led))
+                for key, call in led.items():
+                    call.result = results[key] = fetched.get(key)
+            except BaseException as e:
+                for call in led.values():
+                    call.error = e
+                raise
+            finally:
+                self._finish(led)
+        if joined:
+            logger.debug("Joining %s in-flight %s calls", len(joined), self.name)
+        for key, call in joined.items():
+            results[key] = self._wait(call)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "executed": self.executed,
+                "deduplicated": self.shared,
+                "inFlight": len(self._calls),
+            }
@@ -1,52 +1,184 @@
-import json
 import os
 import logging
-import sys
-from flask import Flask, request, jsonify
-from dapr.clients import DaprClient
+from flask import Flask, Response, request, jsonify
+from dapr_client import dapr_client, init_client
+from compression import accepts, compressible
+from fast_json import conditional_json_response, dumps, loads
+from metrics import install_metrics
+from logging_setup import configure_logging, install_correlation_ids, payload
+from composite_stream import iter_composite
+from projection import parse_fields, project, project_records
+from read_repair import READ_REPAIR_ENABLED, observe_composite_read, repair_composite
+from state_codec import decode, to_json
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
 
 # Dapr configuration
 DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
-DAPR_STORE_NAME = "composite-state-store"
-logger.info(f"Using Dapr HTTP port: {DAPR_HTTP_PORT}")
-logger.info(f"Using Dapr store name: {DAPR_STORE_NAME}")
+DAPR_STORE_NAME = "drasi-state-store"
+# Cache-Control of GET /users/<id>/all-details-drasi. "no-cache" lets clients keep the
+# composite but revalidate it with If-None-Match, answered with 304 while it is unchanged
+COMPOSITE_CACHE_CONTROL = os.getenv("COMPOSITE_CACHE_CONTROL", "private, no-cache")
+NDJSON_MIMETYPE = "application/x-ndjson"
+# Response headers carrying the freshness stamp the materializer stores next to each composite
+FRESHNESS_HEADERS = {
+    "source": "X-Composite-Source",
+    "sourceUpdatedAt": "X-Composite-Source-Updated-At",
+    "materializedAt": "X-Composite-Materialized-At"
+}
+# Set to "false" to compress every response on the fly instead of sending the
+# gzip copy the materializer stores next to each composite
+PRECOMPRESSED_COMPOSITES_ENABLED = os.getenv("PRECOMPRESSED_COMPOSITES_ENABLED", "true").lower() == "true"
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+logger.info("Using Dapr store name: %s", DAPR_STORE_NAME)
+logger.info("Using read repair: %s", READ_REPAIR_ENABLED)
+logger.info("Using precompressed composites: %s", PRECOMPRESSED_COMPOSITES_ENABLED)
+
+def wants_ndjson():
+    """
+    Whether the client asked for a streamed response with
+    `Accept: application/x-ndjson` or `?stream=true`
+    """
+    if request.args.get("stream", "").lower() == "true":
+        return True
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def freshness_headers(stamp):
+    """
+    Headers for a `freshness:{userId}` stamp: the source write the composite
+    last reflected, when it was made and when the composite was stored
+    """
+    if not stamp:
+        return {}
+    try:
+        stamp = decode(stamp)
+    except ValueError:
+        logger.warning("Ignoring unreadable freshness stamp: %s", payload(stamp))
+        return {}
+    return {header: str(stamp[field]) for field, header in FRESHNESS_HEADERS.items() if stamp.get(field)}
+
+def read_composite(client, user_id, precompressed):
+    """
+    Read a composite and its freshness stamp in one bulk state read; returns
+    (data, gzipped, stamp). With `precompressed` the stored gzip copy is read
+    instead of the JSON, and the JSON only if there is no copy (e.g. for a
+    composite stored before copies were).
+    """
+    composite_key = f"user:{user_id}"
+    gzip_key = f"user-gzip:{user_id}"
+    freshness_key = f"freshness:{user_id}"
+    keys = [gzip_key if precompressed else composite_key, freshness_key]
+    logger.debug("Getting state for keys: %s", keys)
+    resp = client.get_bulk_state(store_name=DAPR_STORE_NAME, keys=keys)
+    items = {item.key: item.data for item in resp.items}
+    stamp = items.get(freshness_key)
+    if not precompressed:
+        return items.get(composite_key), None, stamp
+    if items.get(gzip_key):
+        return None, items[gzip_key], stamp
+    logger.debug("No gzip copy of %s, getting state for key: %s", user_id, composite_key)
+    return client.get_state(store_name=DAPR_STORE_NAME, key=composite_key).data, None, stamp
+
+def ndjson_lines(records, user_id):
+    """
+    Encode records as newline-delimited JSON. Once the response has started the
+    status can no longer change, so a failure is reported as a final error line.
+    """
+    count = 0
+    try:
+        for record in records:
+            count += 1
+            yield dumps(record) + b"\n"
+        logger.info("Successfully streamed %s orders for user: %s", count - 1, user_id)
+    except Exception as e:
+        logger.error("Error streaming profile for user %s after %s records: %s", user_id, count, e, exc_info=True)
+        yield dumps({"error": str(e)}) + b"\n"
 
 @app.route('/users/<user_id>/all-details-drasi', methods=['GET'])
+@compressible
 def get_profile_with_orders(user_id):
     """
     Retrieve a precomputed user profile with order history and product details
     Example: GET /users/123/all-details-drasi
+    
+    With `Accept: application/x-ndjson` (or `?stream=true`) the profile is sent
+    as one JSON line without "orders", followed by one line per order.
+    
+    JSON responses carry an ETag; a request whose If-None-Match matches it
+    gets 304 Not Modified without a body.
+    
+    X-Composite-Source, X-Composite-Source-Updated-At and
+    X-Composite-Materialized-At tell which user, order or product write the
+    composite last reflected, when it was made and when the composite was stored.
+    
+    JSON responses are compressed according to Accept-Encoding. A client
+    that accepts gzip gets the gzip copy stored next to the composite, so
+    nothing is compressed per request.
+    
+    `?fields=` limits the response to a comma-separated list of fields, e.g.
+    `fields=userId,name,orders.orderId,orders.totalAmount`.
+    
+    With READ_REPAIR_ENABLED a missing composite is built from the User,
+    Order and Product services instead of returning 404, and handed to the
+    Composite Materializer to store in the background.
     """
-    logger.info(f"GET /users/{user_id}/all-details-drasi request")
-    composite_key = f"user:{user_id}"
-    logger.debug(f"Looking up composite data with key: {composite_key}")
+    logger.info("GET /users/%s/all-details-drasi request", user_id)
+    try:
+        fields = parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        logger.warning("Invalid fields for user %s: %s", user_id, e)
+        return jsonify({"error": str(e)}), 400
+    streamed = wants_ndjson()
+    # The stored gzip copy only fits whole, non-streamed responses
+    precompressed = PRECOMPRESSED_COMPOSITES_ENABLED and fields is None and not streamed and accepts("gzip")
+    logger.debug("Looking up composite data for user: %s", user_id)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            # Retrieve precomputed data from the state store
-            logger.debug(f"Getting state for key: {composite_key}")
-            resp = client.get_state(store_name=DAPR_STORE_NAME, key=composite_key)
-            if not resp.data:
-                logger.warning(f"Composite data not found for user: {user_id}")
+            # Retrieve precomputed data and its freshness stamp
+            data, gzipped, stamp = read_composite(client, user_id, precompressed)
+            headers = freshness_headers(stamp) if data or gzipped else {}
+            observe_composite_read(bool(data or gzipped))
+            if gzipped:
+                logger.info("Successfully retrieved gzipped profile with orders for user: %s", user_id)
+                response = conditional_json_response(gzipped, COMPOSITE_CACHE_CONTROL)
+                response.headers["Content-Encoding"] = "gzip"
+                response.headers.update(headers)
+                return response
+            if not data and READ_REPAIR_ENABLED:
+                logger.info("Composite data missing for user %s, building it from the source services", user_id)
+                data = repair_composite(client, user_id)
+            if not data:
+                logger.warning("Composite data not found for user: %s", user_id)
                 return jsonify({"error": "User profile not found"}), 404
+            # JSON bytes of the composite; those of a composite stored as JSON are used as is
+            data = to_json(data)
+            
+            if streamed:
+                # Decode and send one order at a time instead of the whole document
+                records = iter_composite(data.decode('utf-8'))
+                if fields is not None:
+                    # Stops after the profile line when no order field is selected
+                    records = project_records(records, fields)
+                return Response(ndjson_lines(records, user_id), mimetype=NDJSON_MIMETYPE, headers=headers), 200
             
-            composite_data = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Composite data retrieved: {composite_data}")
-            logger.info(f"Successfully retrieved profile with orders for user: {user_id}")
-            return jsonify(composite_data), 200
+            # Send the composite as is unless projected
+            logger.debug("Composite data retrieved: %s", payload(data))
+            if fields is not None:
+                data = dumps(project(loads(data), fields))
+            logger.info("Successfully retrieved profile with orders for user: %s", user_id)
+            response = conditional_json_response(data, COMPOSITE_CACHE_CONTROL)
+            response.headers.update(headers)
+            return response
         
         except Exception as e:
-            logger.error(f"Error in get_profile_with_orders: {str(e)}", exc_info=True)
+            logger.error("Error in get_profile_with_orders: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -65,5 +197,6 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting All-Details-Drasi Service application")
-    logger.info(f"Server running on 0.0.0.0:5000")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,97 @@
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+# Everything up to the next square bracket outside a string
+_NO_BRACKETS = re.compile(r'[^"\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]]*)*')
+
+
+def _skip(text, pos, expected=None):
+    while pos < len(text) and text[pos] in _WHITESPACE:
+        pos += 1
+    if expected is not None:
+        if text[pos:pos + 1] != expected:
+            raise ValueError(f"Expected {expected!r} at position {pos} of composite document")
+        pos += 1
+    return pos
+
+
+def _iter_array(text, pos, end):
+    # Decode the array starting at `pos` one element at a time; the position
+    # after its closing bracket is stored in end[0]
+    pos = _skip(text, pos, "[")
+    pos = _skip(text, pos)
+    if text[pos:pos + 1] != "]":
+        while True:
+            value, pos = _decoder.raw_decode(text, pos)
+            yield value
+            pos = _skip(text, pos)
+            if text[pos:pos + 1] == "]":
+                break
+            pos = _skip(text, pos, ",")
+            pos = _skip(text, pos)
+    end[0] = pos + 1
+
+
+def _skip_array(text, pos):
+    # Position after the array starting at `pos`, found by matching its
+    # brackets without decoding the elements
+    depth = 0
+    while True:
+        pos = _NO_BRACKETS.match(text, pos).end()
+        bracket = text[pos:pos + 1]
+        if bracket == "[":
+            depth += 1
+        elif bracket == "]":
+            depth -= 1
+        else:
+            raise ValueError(f"Unterminated array at position {pos} of composite document")
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def iter_composite(text):
+    """
+    Decode a stored composite document incrementally.
+
+    Yields the composite without its "orders" first and then each order, so
+    only one order is held in decoded form at a time. Any key order works.
+    When the profile fields come first, as the materializer writes them,
+    orders are streamed in one pass. Otherwise, as in PostgreSQL's jsonb,
+    which sorts keys by length and puts "orders" before "userId", the orders
+    array is skipped by matching its brackets until the rest of the document
+    has been read, then decoded in a second pass.
+    """
+    header = {}
+    orders_pos = None
+    pos = _skip(text, 0, "{")
+    pos = _skip(text, pos)
+    if text[pos:pos + 1] != "}":
+        while True:
+            key, pos = _decoder.raw_decode(text, pos)
+            pos = _skip(text, pos, ":")
+            pos = _skip(text, pos)
+            if key == "orders" and text[pos:pos + 1] == "[":
+                if all(field in header for field in ("userId", "name", "email")):
+                    yield header
+                    yield from _iter_array(text, pos, [pos])
+                    return
+                orders_pos = pos
+                pos = _skip_array(text, pos)
+            else:
+                value, pos = _decoder.raw_decode(text, pos)
+                header[key] = value
+            pos = _skip(text, pos)
+            if text[pos:pos + 1] == "}":
+                break
+            pos = _skip(text, pos, ",")
+            pos = _skip(text, pos)
+
+    yield header
+    if orders_pos is not None:
+        yield from _iter_array(text, orders_pos, [orders_pos])
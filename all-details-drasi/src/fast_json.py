@@ -0,0 +1,69 @@
+import hashlib
+
+import orjson
+from flask import Response, request
+
+JSON_MIMETYPE = "application/json"
+
+
+def dumps(value):
+    """
+    Encode a value as compact UTF-8 JSON bytes
+    """
+    return orjson.dumps(value)
+
+
+def loads(data):
+    """
+    Decode JSON from bytes or str (bytes need no separate decode step)
+    """
+    return orjson.loads(data)
+
+
+def json_response(value, status=200):
+    """
+    Like jsonify, with a faster encoder and without sorting keys
+    """
+    return Response(orjson.dumps(value), status=status, mimetype=JSON_MIMETYPE)
+
+
+def raw_json_response(data, status=200):
+    """
+    Send a JSON document that is already encoded, e.g. as read from the state
+    store, without decoding and re-encoding it
+    """
+    return Response(data, status=status, mimetype=JSON_MIMETYPE)
+
+
+def conditional_json_response(data, cache_control=None):
+    """
+    Send an encoded JSON document with an ETag and answer a matching
+    If-None-Match with 304 Not Modified and no body.
+
+    The ETag is a hash of the document rather than the state store's ETag:
+    store versions (e.g. Redis) start over at 1 when a key is deleted and
+    written again, so a version alone could match a different document.
+    """
+    etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = raw_json_response(data)
+    response.set_etag(etag)
+    if cache_control:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def join_array(items):
+    """
+    Splice already encoded JSON values into a JSON array
+    """
+    return b"[" + b",".join(items) + b"]"
+
+
+def join_object(fields):
+    """
+    Splice (key, encoded JSON value) pairs into a JSON object
+    """
+    return b"{" + b",".join(orjson.dumps(key) + b":" + value for key, value in fields) + b"}"
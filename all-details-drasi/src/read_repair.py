@@ -0,0 +1,120 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Counter
+
+from composite_builder import build_composite
+from dapr_client import dapr_client
+from fast_json import dumps, loads
+from metrics import METRICS_ENABLED, labelled
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Set to "true" to build a missing composite from the source services instead of returning 404
+READ_REPAIR_ENABLED = os.getenv("READ_REPAIR_ENABLED", "false").lower() == "true"
+# App ID of the Composite Materializer, which stores repaired composites
+MATERIALIZER_APP_ID = os.getenv("MATERIALIZER_APP_ID", "composite-materializer")
+
+# Threads writing repaired composites back through the materializer
+_WRITE_BACK_THREADS = 2
+
+COMPOSITE_READS = Counter(
+    "composite_reads", "Precomputed composite reads that found the composite (hit) or not (miss)",
+    ["result"]
+)
+READ_REPAIRS = Counter(
+    "read_repairs", "Composites built on demand after a miss and their write-back",
+    ["outcome"]
+)
+
+# Concurrent misses for the same user share one repair
+repair_flights = SingleFlight("read_repair")
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_pending = set()
+
+
+def observe_composite_read(hit):
+    """
+    Count a precomputed composite read as a hit or a miss
+    """
+    if not METRICS_ENABLED:
+        return
+    labelled(COMPOSITE_READS, "hit" if hit else "miss").inc()
+
+
+def observe_read_repair(outcome):
+    """
+    Count a read repair outcome: built, not_found or failed for the build,
+    stored, skipped or write_failed for the write-back
+    """
+    if not METRICS_ENABLED:
+        return
+    labelled(READ_REPAIRS, outcome).inc()
+
+
+def repair_composite(client, user_id):
+    """
+    Build a missing composite on demand and hand it to the materializer to
+    store in the background. Returns the encoded composite, or None if the
+    user does not exist upstream either. Concurrent misses for the same user
+    share one build.
+    """
+    return repair_flights.do(user_id, lambda: _repair(client, user_id))
+
+
+def _repair(client, user_id):
+    try:
+        composite = build_composite(client, user_id)
+    except Exception:
+        observe_read_repair("failed")
+        raise
+    if composite is None:
+        observe_read_repair("not_found")
+        return None
+    observe_read_repair("built")
+    _schedule_write_back(composite)
+    return dumps(composite)
+
+
+def _schedule_write_back(composite):
+    global _executor, _executor_pid
+    user_id = composite["userId"]
+    with _lock:
+        if user_id in _pending:
+            logger.debug("Write-back of composite for user %s already pending", user_id)
+            return
+        _pending.add(user_id)
+        # Threads do not survive fork(); start the pool in the process that uses it
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=_WRITE_BACK_THREADS, thread_name_prefix="read-repair")
+            _executor_pid = os.getpid()
+        executor = _executor
+    executor.submit(_write_back, composite)
+
+
+def _write_back(composite):
+    user_id = composite["userId"]
+    try:
+        with dapr_client() as client:
+            resp = client.invoke_method(
+                app_id=MATERIALIZER_APP_ID,
+                method_name="composites:repair",
+                data=dumps(composite),
+                content_type="application/json",
+                http_verb="POST"
+            )
+        repaired = bool(resp.data) and loads(resp.data).get("repaired", False)
+        logger.debug("Write-back of composite for user %s %s", user_id, "stored" if repaired else "skipped")
+        observe_read_repair("stored" if repaired else "skipped")
+    except Exception as e:
+        logger.warning("Error writing back composite for user %s: %s", user_id, e)
+        observe_read_repair("write_failed")
+    finally:
+        with _lock:
+            _pending.discard(user_id)
@@ -0,0 +1,93 @@
+"""
+Compare loading orders and users one POST at a time with the :bulk routes.
+
+Each service is driven in-process through Flask's test client against
+FakeDaprClient with a simulated per-call delay. The one-at-a-time path is
+the existing POST /orders (or /users); the bulk path sends the same records
+as one NDJSON body to POST /orders:bulk (or /users:bulk).
+
+Usage:
+    python benchmarks/bench_bulk_ingest.py --records 2000 --users 100 --batch-size 500 --latency 0.001
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+
+
+def load_service(service, client):
+    # Both services have modules named app, bulk_ingest and so on; load one at a time.
+    # single_flight is the same in both and registers metrics, so it is loaded once
+    for name in ("app", "dapr_client", "bulk_ingest", "fast_json"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(BENCH_DIR, '..', service, 'src'))
+    try:
+        importlib.import_module("dapr_client").set_client_factory(lambda: client)
+        return importlib.import_module("app").app, importlib.import_module("bulk_ingest")
+    finally:
+        sys.path.pop(0)
+
+
+def make_records(kind, count, users):
+    if kind == "users":
+        return [{"userId": f"u{i}", "name": f"User {i}", "email": f"user{i}@example.com"} for i in range(count)]
+    return [
+        {
+            "orderId": f"o{i}",
+            "userId": f"u{i % users}",
+            "orderDate": "2025-01-01",
+            "totalAmount": 100.0,
+            "products": [{"productId": f"p{i % 50}", "quantity": 1}]
+        }
+        for i in range(count)
+    ]
+
+
+def run(service, kind, records, args, bulk):
+    client = FakeDaprClient(latency=args.latency)
+    app, bulk_ingest = load_service(service, client)
+    bulk_ingest.BULK_INGEST_BATCH_SIZE = args.batch_size
+    test_client = app.test_client()
+    start = time.perf_counter()
+    if bulk:
+        body = "\n".join(json.dumps(record) for record in records)
+        resp = test_client.post(f"/{kind}:bulk", data=body, content_type="application/x-ndjson")
+        if resp.status_code != 200 or resp.json["created"] != len(records):
+            raise RuntimeError(f"Bulk ingest failed: {resp.status_code} {resp.data[:200]}")
+    else:
+        for record in records:
+            resp = test_client.post(f"/{kind}", json=record)
+            if resp.status_code != 201:
+                raise RuntimeError(f"POST /{kind} failed: {resp.status_code}")
+    return time.perf_counter() - start, client.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100, help="users the orders are spread over")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.001, help="simulated seconds per sidecar call")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"records={args.records} users={args.users} batch-size={args.batch_size} "
+          f"latency={args.latency * 1000:.1f}ms")
+    print(f"{'records':>8} {'path':>8} {'records/s':>10} {'sidecar calls':>14}")
+    for service, kind in (("user-service", "users"), ("order-service", "orders")):
+        records = make_records(kind, args.records, args.users)
+        for bulk in (False, True):
+            elapsed, calls = run(service, kind, records, args, bulk)
+            print(f"{kind:>8} {'bulk' if bulk else 'single':>8} {len(records) / elapsed:>10.0f} {calls:>14}")
+
+
+if __name__ == '__main__':
+    main()
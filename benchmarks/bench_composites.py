@@ -0,0 +1,593 @@
+"""
+Load-test all-details-direct against all-details-drasi without a cluster.
+
+For every scale a synthetic dataset of users x orders x products is generated
+from a fixed seed. Each service then runs under gunicorn in its own process
+with its own gunicorn.conf.py, the way it is deployed, and its Dapr client is
+replaced by FakeDaprClient (simulated delay per sidecar call):
+
+    direct  all-details-direct, plus user-service, order-service and
+            product-service, each seeded with its own records; service
+            invocation is forwarded over HTTP to the other processes
+    drasi   all-details-drasi, seeded with one precomputed composite per user
+
+Load comes from client processes, either with a fixed number of keep-alive
+connections issuing requests back to back (--mode concurrency) or with
+requests scheduled at a fixed arrival rate (--mode rate). In rate mode the
+latency of a request is measured from when it was scheduled, so a server
+that falls behind is charged for the queueing too. Users are picked uniformly
+at random. Requests in the first --warmup seconds are not recorded; the
+product cache of all-details-direct warms up during that time.
+
+Memory is the proportional set size (resident set size where that is not
+available) of all processes behind the endpoint, sampled while idle (after
+seeding) and throughout the run. It includes the in-memory state store,
+which lives outside the services in a cluster.
+
+Before the load starts, --verify users are read from each endpoint and the
+responses are compared across endpoints, so both serve the same composites.
+
+Results are printed as a table and, with --output, written as JSON.
+
+Scales are names from SCALES or USERSxORDERSxPRODUCTS, e.g. 500x20x2000
+(ORDERS is the mean number of orders per user).
+
+Usage:
+    python benchmarks/bench_composites.py --scales small medium --mode concurrency --concurrency 16 \\
+        --duration 10 --output results.json
+    python benchmarks/bench_composites.py --scales large --mode rate --rate 50 --latency 0.002
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import runpy
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'order-service', 'src'))
+sys.path.insert(1, os.path.join(REPO_DIR, 'composite-materializer', 'src'))
+
+from fake_dapr import FakeDaprClient, http_app  # noqa: E402
+from order_store import INDEX_KEY, ORDER_INDEX_SEGMENT_SIZE, SEGMENT_KEY  # noqa: E402
+from materializer import enrich_product  # noqa: E402
+
+# name -> (users, mean orders per user, products)
+SCALES = {
+    "small": (100, 5, 100),
+    "medium": (1000, 20, 1000),
+    "large": (1000, 100, 10000),
+}
+
+# endpoint -> (service, path, services it invokes)
+ENDPOINTS = {
+    "direct": (
+        "all-details-direct",
+        "/users/{}/all-details-direct",
+        ("user-service", "order-service", "product-service")
+    ),
+    "drasi": ("all-details-drasi", "/users/{}/all-details-drasi", ()),
+}
+
+# Port of each service relative to --port
+PORT_OFFSETS = {
+    "all-details-direct": 0,
+    "all-details-drasi": 0,
+    "user-service": 1,
+    "order-service": 2,
+    "product-service": 3,
+}
+
+
+def parse_scale(name):
+    if name in SCALES:
+        return name, SCALES[name]
+    try:
+        users, orders, products = (int(part) for part in name.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{name} is not one of {', '.join(SCALES)} or USERSxORDERSxPRODUCTS")
+    return name, (users, orders, products)
+
+
+# Dataset
+
+def make_dataset(users, orders_per_user, products, items_per_order, seed):
+    """
+    Generate users, products and orders; the same arguments always produce
+    the same dataset. Returns (users, products, orders_by_user).
+    """
+    rng = random.Random(seed)
+    catalog = {}
+    for i in range(products):
+        product_id = f"p{i}"
+        catalog[product_id] = {
+            "productId": product_id,
+            "name": f"Product {i}",
+            "description": f"Description of product {i}",
+            "price": round(rng.uniform(1, 1000), 2),
+        }
+    product_ids = list(catalog)
+
+    profiles = {}
+    orders_by_user = {}
+    for i in range(users):
+        user_id = f"u{i}"
+        profiles[user_id] = {"userId": user_id, "name": f"User {i}", "email": f"user{i}@example.com"}
+        orders = []
+        for j in range(rng.randint(orders_per_user // 2, orders_per_user + orders_per_user // 2)):
+            items = [
+                {"productId": product_id, "quantity": rng.randint(1, 5)}
+                for product_id in rng.sample(product_ids, min(items_per_order, len(product_ids)))
+            ]
+            orders.append({
+                "orderId": f"{user_id}-o{j}",
+                "userId": user_id,
+                "orderDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "totalAmount": round(sum(catalog[item["productId"]]["price"] * item["quantity"] for item in items), 2),
+                "products": items,
+            })
+        orders_by_user[user_id] = orders
+    return profiles, catalog, orders_by_user
+
+
+def service_state(service, dataset):
+    """
+    The {store_name: {key: value}} a service's sidecar is seeded with
+    """
+    profiles, catalog, orders_by_user = dataset
+    if service == "user-service":
+        return {"user-state-store": {f"user:{user_id}": user for user_id, user in profiles.items()}}
+    if service == "product-service":
+        return {"product-state-store": {f"product:{product_id}": p for product_id, p in catalog.items()}}
+    if service == "order-service":
+        # Segmented user-orders index, as written by order_store.insert_order
+        state = {}
+        size = ORDER_INDEX_SEGMENT_SIZE
+        for user_id, orders in orders_by_user.items():
+            order_ids = [order["orderId"] for order in orders]
+            sealed = len(order_ids) // size
+            for i in range(sealed):
+                state[SEGMENT_KEY.format(user_id, i)] = order_ids[i * size:(i + 1) * size]
+            state[INDEX_KEY.format(user_id)] = {"segmentSize": size, "sealed": sealed, "tail": order_ids[sealed * size:]}
+            for order in orders:
+                state[f"order:{order['orderId']}"] = order
+        return {"order-state-store": state}
+    if service == "all-details-drasi":
+        # Composites as the materializer maintains them
+        composites = {}
+        for user_id, user in profiles.items():
+            composites[f"user:{user_id}"] = {
+                "userId": user_id,
+                "name": user["name"],
+                "email": user["email"],
+                "orders": [
+                    {
+                        "orderId": order["orderId"],
+                        "orderDate": order["orderDate"],
+                        "totalAmount": order["totalAmount"],
+                        "products": [enrich_product(item, catalog.get(item["productId"])) for item in order["products"]]
+                    }
+                    for order in orders_by_user[user_id]
+                ]
+            }
+        return {"drasi-state-store": composites}
+    return {}
+
+
+# Services
+
+def serve(service, port, apps, state, args):
+    # Keep the services' logging cost but not their output
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    src = os.path.join(REPO_DIR, service, 'src')
+    sys.path.insert(0, src)
+    os.chdir(src)
+
+    from gunicorn.app.base import BaseApplication
+
+    def make_fake_client():
+        client = FakeDaprClient(latency=args.latency, jitter=args.jitter)
+        for store_name, items in state.items():
+            client.seed(store_name, items)
+        for app_id, app_port in apps.items():
+            client.register_app(app_id, http_app(app_port))
+        return client
+
+    class BenchApplication(BaseApplication):
+        def load_config(self):
+            settings = runpy.run_path(os.path.join(src, 'gunicorn.conf.py'))
+            for name, value in settings.items():
+                if name in self.cfg.settings and value is not None:
+                    self.cfg.set(name, value)
+            self.cfg.set("bind", f"127.0.0.1:{port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("errorlog", "-")
+
+            service_post_fork = settings["post_fork"]
+
+            def post_fork(server, worker):
+                import dapr_client
+                client = make_fake_client()
+                dapr_client.set_client_factory(lambda: client)
+                service_post_fork(server, worker)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            import app
+            return app.app
+
+    BenchApplication().run()
+
+
+def wait_until_ready(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def process_tree(pid):
+    """
+    `pid` and its child processes (the gunicorn arbiter and its workers)
+    """
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; the parent PID follows it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def memory_bytes(pids):
+    """
+    Proportional set size of the processes where the kernel reports it, so
+    pages shared between the arbiter and its workers are counted once;
+    resident set size otherwise
+    """
+    total = 0
+    for pid in pids:
+        for path, field in ((f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')):
+            try:
+                with open(path) as f:
+                    found = next((line for line in f if line.startswith(field)), None)
+            except OSError:
+                continue
+            if found:
+                total += int(found.split()[1]) * 1024
+                break
+    return total
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the combined memory of a set of process trees until stopped
+    """
+
+    def __init__(self, pids, interval=0.1):
+        super().__init__(daemon=True)
+        self.pids = {pid: process_tree(pid) for pid in pids}
+        self.interval = interval
+        self.idle = {pid: memory_bytes(tree) for pid, tree in self.pids.items()}
+        self.peak = dict(self.idle)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            for pid, tree in self.pids.items():
+                self.peak[pid] = max(self.peak[pid], memory_bytes(tree))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+# Load
+
+def get(conn_holder, port, path):
+    conn = conn_holder.get("conn")
+    if conn is None:
+        conn = conn_holder["conn"] = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        body = resp.read()
+    except (http.client.HTTPException, OSError):
+        conn.close()
+        conn_holder["conn"] = None
+        raise
+    if resp.getheader("Connection", "").lower() == "close":
+        conn.close()
+        conn_holder["conn"] = None
+    return resp.status, body
+
+
+def client_process(port, path, user_ids, mode, load, args, seed, results):
+    """
+    Drive one share of the load and report (samples, errors, completed, unsent).
+    A sample is (latency, response bytes) of a request that started after the
+    warm-up; `completed` counts those that finished before the run ended.
+    """
+    lock = threading.Lock()
+    samples = []
+    counts = {"errors": 0, "completed": 0, "unsent": 0}
+    begin = time.perf_counter()
+    measure_from = begin + args.warmup
+    end = measure_from + args.duration
+
+    def record(scheduled, status, body):
+        done = time.perf_counter()
+        if scheduled < measure_from:
+            return
+        with lock:
+            if status != 200:
+                counts["errors"] += 1
+                return
+            samples.append((done - scheduled, len(body)))
+            if done <= end:
+                counts["completed"] += 1
+
+    def send(holder, rng, scheduled):
+        try:
+            status, body = get(holder, port, path.format(rng.choice(user_ids)))
+        except (http.client.HTTPException, OSError):
+            status, body = None, b''
+        record(scheduled, status, body)
+
+    def closed_loop(index):
+        rng = random.Random(seed * 1000 + index)
+        holder = {}
+        while time.perf_counter() < end:
+            send(holder, rng, time.perf_counter())
+
+    def open_loop(index, schedule):
+        rng = random.Random(seed * 1000 + index)
+        holder = {}
+        while True:
+            scheduled = schedule.get()
+            if scheduled is None:
+                return
+            if time.perf_counter() >= end:
+                # The server fell behind: requests still queued at the end are never sent
+                with lock:
+                    counts["unsent"] += scheduled >= measure_from
+                continue
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send(holder, rng, scheduled)
+
+    if mode == "concurrency":
+        threads = [threading.Thread(target=closed_loop, args=(i,)) for i in range(load)]
+        for thread in threads:
+            thread.start()
+    else:
+        schedule = queue.Queue()
+        threads = [threading.Thread(target=open_loop, args=(i, schedule)) for i in range(args.max_connections)]
+        for thread in threads:
+            thread.start()
+        interval = 1.0 / load
+        scheduled = begin
+        while scheduled < end:
+            schedule.put(scheduled)
+            scheduled += interval
+            delay = scheduled - time.perf_counter() - interval
+            if delay > 0:
+                time.sleep(delay)
+        for _ in threads:
+            schedule.put(None)
+    for thread in threads:
+        thread.join()
+    results.put((samples, counts["errors"], counts["completed"], counts["unsent"]))
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def response_digests(port, path, user_ids):
+    holder = {}
+    digests = []
+    for user_id in user_ids:
+        status, body = get(holder, port, path.format(user_id))
+        canonical = json.dumps(json.loads(body) if status == 200 else status, sort_keys=True)
+        digests.append(hashlib.sha256(canonical.encode('utf-8')).hexdigest())
+    return digests
+
+
+def run(args, endpoint, dataset, verify_ids):
+    service, path, downstream = ENDPOINTS[endpoint]
+    ports = {name: args.port + PORT_OFFSETS[name] for name in (service,) + downstream}
+    servers = {
+        name: multiprocessing.Process(
+            target=serve,
+            args=(name, ports[name], {app_id: ports[app_id] for app_id in downstream} if name == service else {},
+                  service_state(name, dataset), args)
+        )
+        for name in ports
+    }
+    for server in servers.values():
+        server.start()
+    try:
+        for port in ports.values():
+            wait_until_ready(port)
+        digests = response_digests(ports[service], path, verify_ids)
+
+        shares = split(args.concurrency if args.mode == "concurrency" else args.rate, args.client_processes)
+        user_ids = list(dataset[0])
+        sampler = MemorySampler([server.pid for server in servers.values()])
+        sampler.start()
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(ports[service], path, user_ids, args.mode, share, args, args.seed + i, results)
+            )
+            for i, share in enumerate(shares) if share
+        ]
+        for client in clients:
+            client.start()
+        samples, errors, completed, unsent = [], 0, 0, 0
+        for _ in clients:
+            client_samples, client_errors, client_completed, client_unsent = results.get()
+            samples.extend(client_samples)
+            errors += client_errors
+            completed += client_completed
+            unsent += client_unsent
+        for client in clients:
+            client.join()
+        sampler.stop()
+    finally:
+        for server in servers.values():
+            server.terminate()
+        for server in servers.values():
+            server.join()
+
+    latencies = sorted(latency for latency, _ in samples)
+    memory = {
+        name: {"idleBytes": sampler.idle[server.pid], "peakBytes": sampler.peak[server.pid]}
+        for name, server in servers.items()
+    }
+    result = {
+        "endpoint": endpoint,
+        "requests": len(samples),
+        "errors": errors,
+        "unsent": unsent,
+        "throughput": completed / args.duration,
+        "latencyMs": {
+            "mean": sum(latencies) / len(latencies) * 1000,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000,
+        } if latencies else None,
+        "responseBytes": sum(size for _, size in samples) / len(samples) if samples else None,
+        "memory": {
+            "idleBytes": sum(m["idleBytes"] for m in memory.values()),
+            "peakBytes": sum(m["peakBytes"] for m in memory.values()),
+            "processes": memory,
+        },
+    }
+    return result, digests
+
+
+def split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=parse_scale, nargs='+', default=[parse_scale("small"), parse_scale("medium")],
+                        help=f"{', '.join(SCALES)} or USERSxORDERSxPRODUCTS")
+    parser.add_argument("--items", type=int, default=3, help="products per order")
+    parser.add_argument("--endpoints", choices=sorted(ENDPOINTS), nargs='+', default=["direct", "drasi"])
+    parser.add_argument("--mode", choices=["concurrency", "rate"], default="concurrency")
+    parser.add_argument("--concurrency", type=int, default=16, help="connections in concurrency mode")
+    parser.add_argument("--rate", type=int, default=100, help="requests per second in rate mode")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="connections per client process in rate mode")
+    parser.add_argument("--client-processes", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unrecorded seconds before each run")
+    parser.add_argument("--latency", type=float, default=0.001, help="simulated seconds per sidecar call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds per sidecar call")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers per service")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verify", type=int, default=5, help="users compared across endpoints before each run")
+    parser.add_argument("--port", type=int, default=5070, help="first of four consecutive ports")
+    parser.add_argument("--output", help="write results as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "benchmark": "composites",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {
+            name: value for name, value in vars(args).items() if name not in ("scales", "output")
+        },
+        "results": [],
+    }
+
+    load = f"concurrency={args.concurrency}" if args.mode == "concurrency" else f"rate={args.rate}/s"
+    print(f"{load} duration={args.duration}s latency={args.latency * 1000:.1f}ms "
+          f"workers={args.workers} threads={args.threads} cpus={os.cpu_count()}", file=sys.stderr)
+    print(f"{'scale':>16} {'endpoint':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'errors':>7} {'peak MiB':>9}", file=sys.stderr)
+    for name, (users, orders, products) in args.scales:
+        dataset = make_dataset(users, orders, products, args.items, args.seed)
+        verify_ids = random.Random(args.seed).sample(list(dataset[0]), min(args.verify, users))
+        digests = {}
+        for endpoint in args.endpoints:
+            result, digests[endpoint] = run(args, endpoint, dataset, verify_ids)
+            result.update({
+                "scale": name,
+                "users": users,
+                "ordersPerUser": orders,
+                "products": products,
+                "orders": sum(len(user_orders) for user_orders in dataset[2].values()),
+            })
+            report["results"].append(result)
+            latency = result["latencyMs"] or {}
+            print(f"{name:>16} {endpoint:>8} {result['throughput']:>8.1f} {latency.get('p50', 0):>8.1f} "
+                  f"{latency.get('p95', 0):>8.1f} {latency.get('p99', 0):>8.1f} "
+                  f"{result['errors'] + result['unsent']:>7} {result['memory']['peakBytes'] / 2 ** 20:>9.1f}",
+                  file=sys.stderr)
+        consistent = len({tuple(d) for d in digests.values()}) == 1
+        for result in report["results"]:
+            if result["scale"] == name:
+                result["consistent"] = consistent
+        if not consistent:
+            print(f"{name}: endpoints returned different composites for users {verify_ids}", file=sys.stderr)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Measure response size and serving time of all-details-drasi per content coding.
+
+Composites of growing size are stored in FakeDaprClient together with the
+gzip copy the materializer writes next to each one. Each mode requests the
+composite with a different Accept-Encoding:
+
+- identity: no compression (how responses were sent before)
+- gzip: compressed per request at COMPRESSION_GZIP_LEVEL
+- gzip-stored: the stored gzip copy, sent as is
+- br / zstd: compressed per request, if brotli / zstandard are installed
+
+The last column is what the materializer spends compressing the stored copy
+once per composite write.
+
+Usage:
+    python benchmarks/bench_compression.py --orders 10 100 1000 5000 --iterations 50
+"""
+import argparse
+import gzip
+import logging
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'all-details-drasi', 'src'))
+
+from bench_logging import composite  # noqa: E402
+from fake_dapr import FakeDaprClient  # noqa: E402
+
+# Same level as the materializer's default COMPOSITE_GZIP_LEVEL
+STORED_GZIP_LEVEL = 6
+
+MODES = {
+    "identity": ("identity", False),
+    "gzip": ("gzip", False),
+    "gzip-stored": ("gzip", True),
+    "br": ("br", False),
+    "zstd": ("zstd", False),
+}
+
+
+def median_of(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    client = FakeDaprClient()
+    import dapr_client
+    dapr_client.set_client_factory(lambda: client)
+    import app
+    import compression
+    logging.disable(logging.CRITICAL)
+    test_client = app.app.test_client()
+    modes = {
+        mode: settings for mode, settings in MODES.items()
+        if settings[0] in ("identity", "gzip") or settings[0] in compression.AVAILABLE_ENCODINGS
+    }
+
+    print("columns per mode: response KiB / median request us")
+    print(f"{'orders':>8} " + " ".join(f"{mode:>17}" for mode in modes) + f" {'store gzip us':>14}")
+    for count in args.orders:
+        data = app.dumps(composite(count))
+        stored_gzip = median_of(lambda: gzip.compress(data, STORED_GZIP_LEVEL, mtime=0), max(args.iterations // 5, 1))
+        client.seed("drasi-state-store", {
+            "user:u1": data,
+            "user-gzip:u1": gzip.compress(data, STORED_GZIP_LEVEL, mtime=0)
+        })
+        cells = []
+        for mode, (encoding, precompressed) in modes.items():
+            app.PRECOMPRESSED_COMPOSITES_ENABLED = precompressed
+            headers = {"Accept-Encoding": encoding}
+            resp = test_client.get("/users/u1/all-details-drasi", headers=headers)
+            if resp.status_code != 200 or resp.headers.get("Content-Encoding", "identity") != encoding:
+                raise RuntimeError(f"Unexpected response for {mode}: {resp.status_code} {resp.headers}")
+            elapsed = median_of(lambda: test_client.get("/users/u1/all-details-drasi", headers=headers).data,
+                                args.iterations)
+            cells.append(f"{len(resp.data) / 1024:>8.1f} / {elapsed * 1e6:>6.0f}")
+        print(f"{count:>8} " + " ".join(f"{cell:>17}" for cell in cells) + f" {stored_gzip * 1e6:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
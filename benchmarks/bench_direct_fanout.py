@@ -0,0 +1,173 @@
+"""
+Compare the all-details-direct aggregation paths.
+
+- per-product: the original path, one GET products/{id} call per line item,
+  made serially (concurrency 1, the baseline) or from a thread pool
+- batched: the service's path, unique product IDs resolved with
+  products:batchGet in batches of --batch-size. All batches of a request are
+  in flight at once up to the concurrency, so the concurrency only changes
+  anything when there are more unique products than --batch-size.
+
+Every upstream call is served by FakeDaprClient with a simulated per-call
+delay, so the numbers reflect the number of sequential round trips rather
+than the speed of any real service. Speedups are relative to the serial
+per-product path.
+
+Usage:
+    python benchmarks/bench_direct_fanout.py --orders 50 --items 5 --latency 0.002
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'all-details-direct', 'src'))
+
+from fake_dapr import FakeDaprClient, json_app  # noqa: E402
+import aggregator  # noqa: E402
+from aggregator import build_profile_with_orders, enrich_product, fetch_orders, fetch_user  # noqa: E402
+from product_cache import product_cache  # noqa: E402
+
+
+def catalog_app(catalog):
+    """
+    Serve GET products/{id} and POST products:batchGet from a product dict
+    """
+    single = json_app(catalog, lambda m: m.split('/', 1)[1])
+
+    def handler(method_name, http_verb, data):
+        if method_name != "products:batchGet":
+            return single(method_name, http_verb, data)
+        product_ids = json.loads(data)["productIds"]
+        return json.dumps({
+            "products": {pid: catalog[pid] for pid in product_ids if pid in catalog},
+            "notFound": [pid for pid in product_ids if pid not in catalog]
+        }).encode('utf-8')
+    return handler
+
+
+def make_client(orders, items, products, latency):
+    client = FakeDaprClient(latency=latency)
+    users = {"u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}}
+    user_orders = {"u1": [
+        {
+            "orderId": f"o{i}",
+            "userId": "u1",
+            "orderDate": "2025-01-01",
+            "totalAmount": 100.0,
+            "products": [
+                {"productId": f"p{(i * items + j) % products}", "quantity": 1}
+                for j in range(items)
+            ]
+        }
+        for i in range(orders)
+    ]}
+    catalog = {
+        f"p{i}": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)}
+        for i in range(products)
+    }
+    client.register_app("user-service", json_app(users, lambda m: m.split('/', 1)[1]))
+    client.register_app("order-service", json_app(user_orders, lambda m: m.split('userId=', 1)[1]))
+    client.register_app("product-service", catalog_app(catalog))
+    return client
+
+
+def build_profile_per_product(client, user_id, concurrency):
+    """
+    The original aggregation: user, then orders, then one call per line item
+    """
+    user_data = fetch_user(client, user_id)
+    orders = fetch_orders(client, user_id)
+
+    def fetch_product(product_id):
+        resp = client.invoke_method(app_id="product-service", method_name=f"products/{product_id}", http_verb="GET")
+        return json.loads(resp.data) if resp.data else None
+
+    product_ids = [item["productId"] for order in orders for item in order.get("products", [])]
+    if concurrency <= 1:
+        fetched = list(map(fetch_product, product_ids))
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            fetched = list(executor.map(fetch_product, product_ids))
+    products = iter(fetched)
+    return {
+        "userId": user_data.get("userId"),
+        "name": user_data.get("name"),
+        "email": user_data.get("email"),
+        "orders": [
+            {
+                "orderId": order.get("orderId"),
+                "orderDate": order.get("orderDate"),
+                "totalAmount": order.get("totalAmount"),
+                "products": [enrich_product(item, next(products)) for item in order.get("products", [])]
+            }
+            for order in orders
+        ]
+    }
+
+
+PATHS = {"per-product": build_profile_per_product, "batched": build_profile_with_orders}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(client, build, concurrency, iterations):
+    samples = []
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = build(client, "u1", concurrency)
+        samples.append(time.perf_counter() - start)
+    return samples, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--items", type=int, default=5, help="line items per order")
+    parser.add_argument("--products", type=int, default=100, help="distinct products in the catalog")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per sidecar call")
+    parser.add_argument("--batch-size", type=int, default=aggregator.PRODUCT_BATCH_SIZE,
+                        help="unique product IDs per batchGet call")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the product cache enabled (disabled by default to measure the fan-out)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8, 16, 32])
+    args = parser.parse_args()
+
+    aggregator.PRODUCT_BATCH_SIZE = args.batch_size
+    if not args.cache:
+        product_cache.max_entries = 0
+    client = make_client(args.orders, args.items, args.products, args.latency)
+    print(f"orders={args.orders} items/order={args.items} products={args.products} "
+          f"batch-size={args.batch_size} latency={args.latency * 1000:.1f}ms iterations={args.iterations}")
+    print(f"{'path':>12} {'concurrency':>12} {'calls/req':>10} {'p50 ms':>10} {'p99 ms':>10} {'speedup':>8}")
+
+    baseline = None
+    reference = None
+    for path, build in PATHS.items():
+        # The serial per-product run is the baseline of every row
+        for concurrency in sorted(set([1] + args.concurrency) if path == "per-product" else args.concurrency):
+            client.calls = 0
+            samples, result = run(client, build, concurrency, args.iterations)
+            calls = client.calls // args.iterations
+            if reference is None:
+                reference = result
+            elif result != reference:
+                raise SystemExit(f"{path} with concurrency={concurrency} produced a different composite")
+            p50 = percentile(samples, 50)
+            p99 = percentile(samples, 99)
+            if baseline is None:
+                baseline = p50
+            print(f"{path:>12} {concurrency:>12} {calls:>10} {p50 * 1000:>10.1f} {p99 * 1000:>10.1f} "
+                  f"{baseline / p50:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
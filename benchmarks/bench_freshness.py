@@ -0,0 +1,189 @@
+"""
+Measure how stale the precomputed composites get under a steady write load.
+
+Orders and product price changes are written at a fixed rate. Each write
+becomes a change event stamped with its write time ("ts"), as the CDC
+source would deliver it, and is applied by a pool of threads, as the
+materializer applies POST /changes. Composites are stored through
+DaprStateStore on FakeDaprClient with a simulated delay per sidecar call,
+either written through or with write-behind.
+
+The reported lag is the materializer's composite_freshness_lag_seconds:
+the time from a write to the composite reflecting it being stored. A
+product change is counted once per composite it rewrites.
+
+Usage:
+    python benchmarks/bench_freshness.py --rates 20 50 100 --duration 5 --modes write-through write-behind
+"""
+import argparse
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.join(BENCH_DIR, '..', 'composite-materializer', 'src'))
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+import materializer  # noqa: E402
+import write_behind  # noqa: E402
+from materializer import DaprStateStore, Materializer  # noqa: E402
+from write_behind import WriteBehindStore  # noqa: E402
+
+
+class LagRecorder:
+    """
+    Collects every freshness lag the stores observe, next to the metric
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self._observe = materializer.observe_freshness_lag
+
+    def install(self):
+        materializer.observe_freshness_lag = self.observe
+        write_behind.observe_freshness_lag = self.observe
+
+    def observe(self, entity, lag):
+        self._observe(entity, lag)
+        with self.lock:
+            self.samples.append((entity, max(lag, 0.0)))
+
+    def take(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def seed(m, users, products, orders_per_user, rng):
+    for i in range(products):
+        m.apply({"op": "upsert", "key": f"product:p{i}",
+                 "value": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)}})
+    for i in range(users):
+        m.apply({"op": "upsert", "key": f"user:u{i}",
+                 "value": {"userId": f"u{i}", "name": f"User {i}", "email": f"user{i}@example.com"}})
+    order_id = 0
+    for i in range(users):
+        for _ in range(orders_per_user):
+            m.apply(order_event(order_id, f"u{i}", products, rng))
+            order_id += 1
+    return order_id
+
+
+def order_event(order_id, user_id, products, rng, ts=None):
+    items = [{"productId": f"p{rng.randrange(products)}", "quantity": rng.randint(1, 3)} for _ in range(3)]
+    event = {"op": "upsert", "key": f"order:{order_id}", "value": {
+        "orderId": str(order_id), "userId": user_id, "orderDate": "2025-01-01",
+        "totalAmount": 100.0, "products": items
+    }}
+    if ts is not None:
+        event["ts"] = ts
+    return event
+
+
+def run(m, args, rate, rng, next_order_id):
+    """
+    Write at `rate` per second for `args.duration` seconds; returns the
+    number of writes, how long they took to apply and the next order ID
+    """
+    events = queue.Queue()
+
+    def applier():
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            m.apply(event)
+
+    appliers = [threading.Thread(target=applier) for _ in range(args.threads)]
+    for t in appliers:
+        t.start()
+
+    writes = int(rate * args.duration)
+    start = time.perf_counter()
+    for i in range(writes):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        ts = time.time() * 1000
+        if rng.random() < args.product_fraction:
+            product = rng.randrange(args.products)
+            events.put({"op": "upsert", "key": f"product:p{product}", "ts": ts, "value": {
+                "productId": f"p{product}", "name": f"Product {product}", "price": round(rng.uniform(1, 1000), 2)
+            }})
+        else:
+            events.put(order_event(next_order_id, f"u{rng.randrange(args.users)}", args.products, rng, ts))
+            next_order_id += 1
+    for _ in appliers:
+        events.put(None)
+    for t in appliers:
+        t.join()
+    return writes, time.perf_counter() - start, next_order_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", type=float, nargs='+', default=[20, 50, 100], help="writes per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of writes per run")
+    parser.add_argument("--modes", nargs='+', default=["write-through", "write-behind"],
+                        choices=["write-through", "write-behind"])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--orders-per-user", type=int, default=4)
+    parser.add_argument("--product-fraction", type=float, default=0.2, help="share of writes that change a product")
+    parser.add_argument("--threads", type=int, default=4, help="threads applying change events")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per sidecar call")
+    parser.add_argument("--flush-interval-ms", type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    recorder = LagRecorder()
+    recorder.install()
+
+    print(f"users={args.users} products={args.products} product-writes={args.product_fraction:.0%} "
+          f"threads={args.threads} latency={args.latency * 1000:.1f}ms duration={args.duration:.0f}s")
+    print(f"{'mode':>14} {'rate/s':>7} {'done/s':>7} {'samples':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'order p99':>10} {'product p99':>12}")
+    for mode in args.modes:
+        for rate in args.rates:
+            rng = random.Random(42)
+            fake = FakeDaprClient()
+            store = DaprStateStore(lambda: fake, "drasi-state-store")
+            if mode == "write-behind":
+                store = WriteBehindStore(store, flush_interval_ms=args.flush_interval_ms)
+            m = Materializer(store)
+            next_order_id = seed(m, args.users, args.products, args.orders_per_user, rng)
+            if mode == "write-behind":
+                store.flush()
+            recorder.take()
+
+            fake.latency = args.latency
+            writes, elapsed, _ = run(m, args, rate, rng, next_order_id)
+            if mode == "write-behind":
+                store.close()
+            samples = recorder.take()
+            lags = [lag for _, lag in samples]
+            by_entity = {
+                entity: [lag for e, lag in samples if e == entity] for entity in ("order", "product")
+            }
+
+            def p99(values):
+                return f"{percentile(values, 99) * 1000:.1f}" if values else "-"
+            print(f"{mode:>14} {rate:>7.0f} {writes / elapsed:>7.0f} {len(lags):>8} "
+                  f"{percentile(lags, 50) * 1000:>8.1f} {percentile(lags, 95) * 1000:>8.1f} "
+                  f"{percentile(lags, 99) * 1000:>8.1f} {max(lags) * 1000:>8.1f} "
+                  f"{p99(by_entity['order']):>10} {p99(by_entity['product']):>12}")
+
+
+if __name__ == '__main__':
+    main()
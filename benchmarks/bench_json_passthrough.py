@@ -0,0 +1,57 @@
+"""
+Measure what the decode/re-encode round trip used to cost on read endpoints.
+
+For composites of growing size, compare building the response the original
+way (json.loads of the stored bytes, then jsonify) with sending the stored
+bytes as they are, and jsonify with fast_json.json_response for responses
+that all-details-direct has to encode.
+
+Usage:
+    python benchmarks/bench_json_passthrough.py --orders 10 100 1000 5000 --iterations 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'all-details-drasi', 'src'))
+
+from flask import Flask, jsonify  # noqa: E402
+from bench_logging import composite  # noqa: E402
+from fast_json import json_response, raw_json_response  # noqa: E402
+
+
+def best_of(fn, iterations):
+    best = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    print(f"{'orders':>8} {'KiB':>8} {'loads+jsonify us':>17} {'passthrough us':>15} "
+          f"{'jsonify us':>11} {'json_response us':>17}")
+    with app.test_request_context():
+        for count in args.orders:
+            value = composite(count)
+            data = json.dumps(value).encode('utf-8')
+            round_trip = best_of(lambda: jsonify(json.loads(data.decode('utf-8'))).get_data(), args.iterations)
+            passthrough = best_of(lambda: raw_json_response(data).get_data(), args.iterations)
+            encode_before = best_of(lambda: jsonify(value).get_data(), args.iterations)
+            encode_after = best_of(lambda: json_response(value).get_data(), args.iterations)
+            print(f"{count:>8} {len(data) / 1024:>8.0f} {round_trip * 1e6:>17.0f} {passthrough * 1e6:>15.0f} "
+                  f"{encode_before * 1e6:>11.0f} {encode_after * 1e6:>17.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Measure the per-request cost of logging in all-details-drasi and user-service.
+
+Each service is driven in-process through Flask's test client, with the Dapr
+client replaced by FakeDaprClient (no simulated delay), so the time per
+request is dominated by Flask, JSON and logging. Log output goes to a
+temporary file, which stands in for the container's stdout.
+
+Configurations:
+    none            logging disabled, the floor for comparison
+    before          the original setup: DEBUG, synchronous stdout handler,
+                    payloads rendered in full with str() like the old f-strings
+    after-debug     LOG_LEVEL=DEBUG through the queue handler, payloads
+                    capped at LOG_PAYLOAD_MAX_CHARS
+    after-info      LOG_LEVEL=INFO (the default) through the queue handler
+
+Usage:
+    python benchmarks/bench_logging.py --requests 2000 --rounds 3 --orders 200
+"""
+import argparse
+import importlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+
+CONFIGURATIONS = ("none", "before", "after-debug", "after-info")
+
+
+def composite(orders):
+    return {
+        "userId": "u1",
+        "name": "Bench User",
+        "email": "bench@example.com",
+        "orders": [
+            {
+                "orderId": f"o{i}",
+                "orderDate": "2025-01-01",
+                "totalAmount": 100.0,
+                "products": [
+                    {"productId": f"p{j}", "name": f"Product {j}", "price": float(j), "quantity": 1}
+                    for j in range(5)
+                ]
+            }
+            for i in range(orders)
+        ]
+    }
+
+
+def load_service(service, store_name, state):
+    # Both services have modules named app and dapr_client; load one at a time
+    for name in ("app", "dapr_client", "logging_setup"):
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(BENCH_DIR, '..', service, 'src'))
+    try:
+        client = FakeDaprClient()
+        client.seed(store_name, state)
+        dapr_client = importlib.import_module("dapr_client")
+        dapr_client.set_client_factory(lambda: client)
+        app = importlib.import_module("app")
+        return app.app, importlib.import_module("logging_setup")
+    finally:
+        sys.path.pop(0)
+
+
+def configure(name, logging_setup, log_file, payload_str):
+    logging_setup.flush_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    logging.disable(logging.NOTSET)
+    sys.stdout = log_file
+
+    logging_setup._Payload.__str__ = payload_str
+    if name == "none":
+        logging.disable(logging.CRITICAL)
+    elif name == "before":
+        logging_setup._Payload.__str__ = lambda self: str(self.value)
+        handler = logging.StreamHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+    else:
+        logging_setup.LOG_LEVEL = "DEBUG" if name == "after-debug" else "INFO"
+        logging_setup.configure_logging()
+
+
+def measure(test_client, path, requests, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(requests):
+            resp = test_client.get(path)
+            if resp.status_code != 200:
+                raise RuntimeError(f"GET {path} returned {resp.status_code}")
+        elapsed = (time.perf_counter() - start) / requests
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3, help="best of this many runs is reported")
+    parser.add_argument("--orders", type=int, default=200, help="orders in the all-details-drasi composite")
+    args = parser.parse_args()
+
+    scenarios = (
+        ("user-service", "/users/u1", "user-state-store",
+         {"user:u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}}),
+        ("all-details-drasi", "/users/u1/all-details-drasi", "drasi-state-store",
+         {"user:u1": composite(args.orders)}),
+    )
+
+    stdout = sys.stdout
+    results = []
+    with tempfile.TemporaryFile(mode="w") as log_file:
+        sys.stdout = log_file
+        for service, path, store_name, state in scenarios:
+            app, logging_setup = load_service(service, store_name, state)
+            payload_str = logging_setup._Payload.__str__
+            test_client = app.test_client()
+            for name in CONFIGURATIONS:
+                configure(name, logging_setup, log_file, payload_str)
+                log_file.seek(0)
+                log_file.truncate()
+                per_request = measure(test_client, path, args.requests, args.rounds)
+                logging_setup.flush_logging()
+                results.append((service, name, per_request, log_file.tell() / (args.requests * args.rounds)))
+            logging.disable(logging.CRITICAL)
+    sys.stdout = stdout
+
+    print(f"requests={args.requests} composite orders={args.orders}")
+    print(f"{'service':>18} {'logging':>12} {'us/request':>11} {'log bytes/request':>18}")
+    for service, name, per_request, log_bytes in results:
+        print(f"{service:>18} {name:>12} {per_request * 1e6:>11.0f} {log_bytes:>18.0f}")
+
+
+if __name__ == '__main__':
+    main()
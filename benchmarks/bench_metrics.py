@@ -0,0 +1,105 @@
+"""
+Measure the per-request cost of the Prometheus instrumentation.
+
+all-details-direct is driven in-process through Flask's test client against
+FakeDaprClient (no simulated delay), so the time per request is dominated by
+Flask, JSON and instrumentation. Each request records a route histogram, an
+in-flight gauge, several stage histograms and one histogram per sidecar call.
+METRICS_ENABLED and PROMETHEUS_MULTIPROC_DIR are read at import time, so
+every configuration runs in its own process:
+
+    off             METRICS_ENABLED=false
+    on              in-memory metrics (a single process)
+    multiprocess    metrics in memory-mapped files shared by gunicorn workers
+
+Usage:
+    python benchmarks/bench_metrics.py --requests 2000 --rounds 3 --orders 20
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def child(requests, rounds, orders):
+    sys.path.insert(0, BENCH_DIR)
+    from fake_dapr import FakeDaprClient, json_app
+    from bench_direct_fanout import catalog_app
+    from bench_streaming import make_orders, orders_app
+    # bench_streaming puts all-details-drasi first on the path; app must be all-details-direct's
+    sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'all-details-direct', 'src'))
+
+    client = FakeDaprClient()
+    client.register_app("user-service", json_app(
+        {"u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}},
+        lambda m: m.split('/', 1)[1]
+    ))
+    client.register_app("order-service", orders_app(make_orders(orders, 3, 50)))
+    client.register_app("product-service", catalog_app({
+        f"p{i}": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)} for i in range(50)
+    }))
+    import dapr_client
+    dapr_client.set_client_factory(lambda: client)
+    import app
+    from product_cache import product_cache
+    # Every request fans out to the Product Service instead of hitting the cache
+    product_cache.max_entries = 0
+    logging.disable(logging.CRITICAL)
+
+    test_client = app.app.test_client()
+    path = "/users/u1/all-details-direct"
+    test_client.get(path)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(requests):
+            if test_client.get(path).status_code != 200:
+                raise RuntimeError(f"GET {path} failed")
+        elapsed = (time.perf_counter() - start) / requests
+        best = elapsed if best is None else min(best, elapsed)
+    print(json.dumps({"perRequest": best}))
+
+
+def run(args, name):
+    env = dict(os.environ, METRICS_ENABLED="false" if name == "off" else "true")
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        if name == "multiprocess":
+            env["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--requests", str(args.requests),
+             "--rounds", str(args.rounds), "--orders", str(args.orders)],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+    return json.loads(out.strip().splitlines()[-1])["perRequest"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3, help="best of this many runs is reported")
+    parser.add_argument("--orders", type=int, default=20, help="orders per user")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.requests, args.rounds, args.orders)
+        return
+
+    print(f"requests={args.requests} orders={args.orders}")
+    print(f"{'metrics':>13} {'us/request':>11} {'overhead us':>12}")
+    baseline = None
+    for name in ("off", "on", "multiprocess"):
+        per_request = run(args, name)
+        baseline = per_request if baseline is None else baseline
+        print(f"{name:>13} {per_request * 1e6:>11.0f} {(per_request - baseline) * 1e6:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Compare the original four-call order creation with the transactional one.
+
+Many threads create orders for the same user at once. The original path
+(existence check, save order, read index, save index) loses index entries
+when two requests interleave; the transactional path (one bulk read, one
+transaction) retries on an ETag conflict instead. Both run against
+FakeDaprClient with a simulated delay.
+
+The store starts with every order-claims key in place, as in a store that
+has been taking orders for a while; with --cold the first create of each
+claim key also creates it, which costs a write and a second read.
+
+Usage:
+    python benchmarks/bench_order_create.py --orders 200 --threads 16 --latency 0.001
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'order-service', 'src'))
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+from order_store import CLAIM_KEY, ORDER_CLAIM_STRIPES, insert_order, read_index  # noqa: E402
+
+STORE_NAME = "order-state-store"
+
+
+def insert_order_sequential(client, store_name, order_data):
+    order_id = order_data["orderId"]
+    order_key = f"order:{order_id}"
+    if client.get_state(store_name=store_name, key=order_key).data:
+        raise ValueError(f"Order already exists: {order_id}")
+    client.save_state(store_name=store_name, key=order_key, value=json.dumps(order_data))
+    index_key = f"user-orders:{order_data['userId']}"
+    index_resp = client.get_state(store_name=store_name, key=index_key)
+    order_ids = json.loads(index_resp.data.decode('utf-8')) if index_resp.data else []
+    if order_id not in order_ids:
+        order_ids.append(order_id)
+    client.save_state(store_name=store_name, key=index_key, value=json.dumps(order_ids))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run(insert, orders, threads, latency, cold):
+    client = FakeDaprClient(latency=latency, jitter=latency)
+    if not cold:
+        client.seed(STORE_NAME, {CLAIM_KEY.format(i): {} for i in range(ORDER_CLAIM_STRIPES)})
+    samples = []
+
+    def create(i):
+        order = {"orderId": f"o{i}", "userId": "u1", "orderDate": "2025-01-01",
+                 "totalAmount": 10.0, "products": [{"productId": "p1", "quantity": 1}]}
+        start = time.perf_counter()
+        insert(client, STORE_NAME, order)
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(create, range(orders)))
+    elapsed = time.perf_counter() - start
+
+    index, _ = read_index(client, STORE_NAME, "u1")
+    return samples, elapsed, client.calls, orders - len(set(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent creates for the same user")
+    parser.add_argument("--latency", type=float, default=0.001, help="simulated seconds per sidecar call")
+    parser.add_argument("--cold", action="store_true", help="start without order-claims keys")
+    args = parser.parse_args()
+
+    print(f"orders={args.orders} threads={args.threads} latency={args.latency * 1000:.1f}ms (+ same jitter)")
+    print(f"{'path':>14} {'p50 ms':>8} {'p99 ms':>8} {'orders/s':>9} {'calls':>7} {'lost index entries':>19}")
+    for name, insert in (("sequential", insert_order_sequential), ("transactional", insert_order)):
+        samples, elapsed, calls, lost = run(insert, args.orders, args.threads, args.latency, args.cold)
+        print(f"{name:>14} {percentile(samples, 50) * 1000:>8.1f} {percentile(samples, 99) * 1000:>8.1f} "
+              f"{args.orders / elapsed:>9.0f} {calls:>7} {lost:>19}")
+
+
+if __name__ == '__main__':
+    main()
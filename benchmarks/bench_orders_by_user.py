@@ -0,0 +1,78 @@
+"""
+Compare per-key and chunked bulk state reads for GET /orders?userId.
+
+The per-key path mirrors the original loop of one get_state per order ID.
+The bulk path is order_store.get_orders from order-service. Both run
+against FakeDaprClient with a simulated per-call delay.
+
+Usage:
+    python benchmarks/bench_orders_by_user.py --orders 10 100 1000 10000 --latency 0.0005
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'order-service', 'src'))
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+from order_store import get_orders  # noqa: E402
+
+STORE_NAME = "order-state-store"
+
+
+def get_orders_per_key(client, store_name, order_ids):
+    orders = []
+    for order_id in order_ids:
+        resp = client.get_state(store_name=store_name, key=f"order:{order_id}")
+        if resp.data:
+            orders.append(json.loads(resp.data.decode('utf-8')))
+    return orders
+
+
+def best_of(fn, iterations):
+    best = None
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help="orders per user")
+    parser.add_argument("--latency", type=float, default=0.0005, help="simulated seconds per sidecar call")
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"latency={args.latency * 1000:.2f}ms chunk-size={args.chunk_size} "
+          f"concurrency={args.concurrency} iterations={args.iterations}")
+    print(f"{'orders':>8} {'per-key ms':>12} {'bulk ms':>10} {'speedup':>8}")
+
+    for count in args.orders:
+        client = FakeDaprClient(latency=args.latency)
+        order_ids = [f"o{i}" for i in range(count)]
+        client.seed(STORE_NAME, {
+            f"order:{order_id}": {"orderId": order_id, "userId": "u1", "totalAmount": 10.0, "products": []}
+            for order_id in order_ids
+        })
+
+        per_key, expected = best_of(lambda: get_orders_per_key(client, STORE_NAME, order_ids), args.iterations)
+        bulk, actual = best_of(
+            lambda: get_orders(client, STORE_NAME, order_ids, chunk_size=args.chunk_size, concurrency=args.concurrency),
+            args.iterations
+        )
+        if actual != expected:
+            raise SystemExit(f"bulk read returned different orders for {count} orders")
+        print(f"{count:>8} {per_key * 1000:>12.1f} {bulk * 1000:>10.1f} {per_key / bulk:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Measure the composite rebuild job against in-memory service tables.
+
+A synthetic dataset (seeded like bench_composites.py) is loaded into
+in-memory stand-ins for the user, order and product state tables, with
+keys prefixed as Dapr stores them ("user:||user:u1"), and
+composites are written through DaprStateStore to FakeDaprClient with a
+simulated delay per bulk save.
+
+First a single-process run is interrupted halfway and resumed from its
+checkpoint, and the result is compared with the composites the
+materializer would hold. Then the full rebuild is timed for each worker
+count (writes made by worker processes stay in their copy of the fake).
+
+Usage:
+    python benchmarks/bench_rebuild.py --scale 2000x20x1000 --workers 1 2 4 --latency 0.002
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_composites import make_dataset, parse_scale, service_state  # noqa: E402
+from fake_dapr import FakeDaprClient  # noqa: E402
+import rebuild  # noqa: E402
+from materializer import DaprStateStore  # noqa: E402
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingStore:
+    """
+    Passes writes through and fails once `limit` composites have been written
+    """
+
+    def __init__(self, store, limit):
+        self.store = store
+        self.limit = limit
+        self.composites = 0
+
+    def save_many(self, items):
+        self.composites += sum(1 for key, _ in items if key.startswith("user:"))
+        if self.composites > self.limit:
+            raise Interrupted()
+        self.store.save_many(items)
+
+
+def tables(dataset):
+    def table(service, store_name, key_prefix):
+        rows = {key_prefix + key: value for key, value in service_state(service, dataset)[store_name].items()}
+        return rebuild.InMemoryTable(rows, key_prefix)
+    return (
+        table("user-service", "user-state-store", rebuild.REBUILD_USER_KEY_PREFIX),
+        table("order-service", "order-state-store", rebuild.REBUILD_ORDER_KEY_PREFIX),
+        table("product-service", "product-state-store", rebuild.REBUILD_PRODUCT_KEY_PREFIX),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", default="2000x20x1000", help="USERSxORDERSxPRODUCTS")
+    parser.add_argument("--items", type=int, default=3, help="line items per order")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per sidecar call")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    _, (users, orders, products) = parse_scale(args.scale)
+    dataset = make_dataset(users, orders, products, args.items, seed=1)
+    expected = service_state("all-details-drasi", dataset)["drasi-state-store"]
+    user_table, order_table, product_table = tables(dataset)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Interrupted and resumed single-process run, checked against the expected composites
+        fake = FakeDaprClient()
+        store = DaprStateStore(lambda: fake, "drasi-state-store")
+        checkpoint_path = os.path.join(tmp, "resume.jsonl")
+        try:
+            rebuild.rebuild(user_table, order_table, product_table, InterruptingStore(store, users // 2),
+                            rebuild.Checkpoint(checkpoint_path), workers=1, chunk_size=args.chunk_size)
+        except Interrupted:
+            pass
+        resumed_from = len(rebuild.Checkpoint(checkpoint_path).chunks)
+        summary = rebuild.rebuild(user_table, order_table, product_table, store,
+                                  rebuild.Checkpoint(checkpoint_path), workers=1, chunk_size=args.chunk_size)
+        written = fake.stores["drasi-state-store"]
+        mismatched = [
+            key for key, composite in expected.items()
+            if rebuild.loads(written.get(key, b"null")) != composite
+        ]
+        print(f"resume: {resumed_from} chunks done before the interruption, {summary['users']} users "
+              f"rebuilt after it, {len(expected) - len(mismatched)}/{len(expected)} composites match")
+        if mismatched:
+            raise RuntimeError(f"Composites differ from the expected ones, e.g. {mismatched[0]}")
+
+        # Tables read with the wrong key prefix find no users and leave the checkpoint open
+        wrong_prefix = rebuild.InMemoryTable(user_table.rows, "user-service||")
+        checkpoint = rebuild.Checkpoint(os.path.join(tmp, "wrong-prefix.jsonl"))
+        summary = rebuild.rebuild(wrong_prefix, order_table, product_table, store, checkpoint, workers=1)
+        print(f"wrong key prefix: {summary['users']} users rebuilt, checkpoint done={checkpoint.done}")
+        if summary["users"] or checkpoint.done:
+            raise RuntimeError("A rebuild that found no users was recorded as finished")
+
+        print(f"scale={args.scale} items={args.items} chunk-size={args.chunk_size} "
+              f"latency={args.latency * 1000:.1f}ms cpus={os.cpu_count()}")
+        print(f"{'workers':>8} {'users':>7} {'orders':>8} {'seconds':>8} {'rows/s':>9}")
+        for workers in args.workers:
+            fake = FakeDaprClient(latency=args.latency)
+            summary = rebuild.rebuild(
+                user_table, order_table, product_table, DaprStateStore(lambda: fake, "drasi-state-store"),
+                rebuild.Checkpoint(os.path.join(tmp, f"run-{workers}.jsonl")),
+                workers=workers, chunk_size=args.chunk_size
+            )
+            print(f"{workers:>8} {summary['users']:>7} {summary['orders']:>8} "
+                  f"{summary['seconds']:>8.2f} {summary['rowsPerSecond']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
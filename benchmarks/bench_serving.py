@@ -0,0 +1,221 @@
+"""
+Compare request throughput of Flask's development server and gunicorn with
+different worker counts.
+
+The service runs in a child process with its own gunicorn.conf.py, and its
+Dapr client is replaced with FakeDaprClient in the post_fork hook before the
+service's own hook initializes it. Load comes from several client processes
+holding keep-alive connections. Worker processes only help when the machine
+has spare cores, so run this on a multi-core box and keep --workers at or
+below the core count minus the cores used by the clients.
+
+Usage:
+    python benchmarks/bench_serving.py --service user-service --workers 1 2 4 --threads 4 --duration 5
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import runpy
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dapr import FakeDaprClient  # noqa: E402
+
+# service -> (path to request, state store, seeded state)
+SCENARIOS = {
+    "user-service": (
+        "/users/u1",
+        "user-state-store",
+        {"user:u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}}
+    ),
+    "all-details-drasi": (
+        "/users/u1/all-details-drasi",
+        "drasi-state-store",
+        {"user:u1": {
+            "userId": "u1",
+            "name": "Bench User",
+            "email": "bench@example.com",
+            "orders": [
+                {
+                    "orderId": f"o{i}",
+                    "orderDate": "2025-01-01",
+                    "totalAmount": 100.0,
+                    "products": [
+                        {"productId": f"p{j}", "name": f"Product {j}", "price": float(j), "quantity": 1}
+                        for j in range(5)
+                    ]
+                }
+                for i in range(20)
+            ]
+        }}
+    )
+}
+
+
+def make_fake_client(service, latency):
+    _, store_name, state = SCENARIOS[service]
+    client = FakeDaprClient(latency=latency)
+    client.seed(store_name, state)
+    return client
+
+
+def serve(service, mode, workers, threads, port, latency):
+    # The services log every request at DEBUG; keep that cost but not the output
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    src = os.path.join(BENCH_DIR, '..', service, 'src')
+    sys.path.insert(0, src)
+    os.chdir(src)
+
+    if mode == "development":
+        import dapr_client
+        dapr_client.set_client_factory(lambda: make_fake_client(service, latency))
+        import app
+        app.app.run(host='127.0.0.1', port=port, threaded=True)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class BenchApplication(BaseApplication):
+        def load_config(self):
+            settings = runpy.run_path(os.path.join(src, 'gunicorn.conf.py'))
+            for name, value in settings.items():
+                if name in self.cfg.settings and value is not None:
+                    self.cfg.set(name, value)
+            self.cfg.set("bind", f"127.0.0.1:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("errorlog", "-")
+
+            service_post_fork = settings["post_fork"]
+
+            def post_fork(server, worker):
+                import dapr_client
+                dapr_client.set_client_factory(lambda: make_fake_client(service, latency))
+                service_post_fork(server, worker)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            import app
+            return app.app
+
+    BenchApplication().run()
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def client_process(port, path, connections, duration, results):
+    counts = []
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def run():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        while time.time() < deadline:
+            start = time.perf_counter()
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                raise RuntimeError(f"GET {path} returned {resp.status}")
+            local.append(time.perf_counter() - start)
+            if resp.getheader("Connection", "").lower() == "close":
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.close()
+        with lock:
+            counts.append(len(local))
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=run) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((sum(counts), latencies))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def run(args, mode, workers):
+    path = SCENARIOS[args.service][0]
+    server = multiprocessing.Process(
+        target=serve,
+        args=(args.service, mode, workers, args.threads, args.port, args.latency)
+    )
+    server.start()
+    try:
+        wait_until_ready(args.port)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(args.port, path, args.connections, args.duration, results)
+            )
+            for _ in range(args.client_processes)
+        ]
+        for client in clients:
+            client.start()
+        total = 0
+        latencies = []
+        for _ in clients:
+            count, samples = results.get()
+            total += count
+            latencies.extend(samples)
+        for client in clients:
+            client.join()
+        return total / args.duration, latencies
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", choices=sorted(SCENARIOS), default="user-service")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4], help="gunicorn worker counts to compare")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--connections", type=int, default=8, help="keep-alive connections per client process")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of load per configuration")
+    parser.add_argument("--latency", type=float, default=0.001, help="simulated seconds per sidecar call")
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    print(f"service={args.service} cores={os.cpu_count()} threads={args.threads} "
+          f"connections={args.client_processes * args.connections} latency={args.latency * 1000:.1f}ms")
+    print(f"{'server':>12} {'workers':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    configurations = [("development", 1)] + [("gunicorn", workers) for workers in args.workers]
+    for mode, workers in configurations:
+        throughput, latencies = run(args, mode, workers)
+        print(f"{mode:>12} {workers:>8} {throughput:>8.0f} "
+              f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 99) * 1000:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure request coalescing in all-details-direct under a burst for one user.
+
+Threads issue requests for the same user at once through Flask's test
+client, with upstream services served by FakeDaprClient handlers and a
+simulated delay per sidecar call. The product cache is disabled so every
+fan-out reaches the Product Service. With single-flight on, requests that
+arrive while a fan-out for the user is in flight share its result.
+
+Usage:
+    python benchmarks/bench_single_flight.py --threads 1 8 32 --requests 20 --orders 50 --latency 0.002
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dapr import FakeDaprClient, json_app  # noqa: E402
+from bench_direct_fanout import catalog_app  # noqa: E402
+from bench_streaming import make_orders, orders_app  # noqa: E402
+
+# bench_streaming puts all-details-drasi first on the path; app must be all-details-direct's
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'all-details-direct', 'src'))
+
+
+def burst(test_client, threads, requests):
+    barrier = threading.Barrier(threads)
+
+    def run():
+        barrier.wait()
+        for _ in range(requests):
+            resp = test_client.get("/users/u1/all-details-direct")
+            if resp.status_code != 200:
+                raise RuntimeError(f"Request failed with {resp.status_code}")
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs='+', default=[1, 8, 32], help="concurrent requesters")
+    parser.add_argument("--requests", type=int, default=20, help="requests per thread")
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per sidecar call")
+    args = parser.parse_args()
+
+    client = FakeDaprClient(latency=args.latency)
+    client.register_app("user-service", json_app(
+        {"u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}},
+        lambda m: m.split('/', 1)[1]
+    ))
+    client.register_app("order-service", orders_app(make_orders(args.orders, 3, 200)))
+    client.register_app("product-service", catalog_app({
+        f"p{i}": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)} for i in range(200)
+    }))
+    import dapr_client
+    dapr_client.set_client_factory(lambda: client)
+    import app
+    from product_cache import product_cache
+    product_cache.max_entries = 0
+    logging.disable(logging.CRITICAL)
+    test_client = app.app.test_client()
+
+    print(f"orders={args.orders} latency={args.latency * 1000:.1f}ms requests/thread={args.requests}")
+    print(f"{'threads':>8} {'single-flight':>14} {'req/s':>8} {'sidecar calls/req':>18} {'deduplicated':>13}")
+    for threads in args.threads:
+        for enabled in (False, True):
+            app.composite_flights.enabled = enabled
+            before_calls = client.calls
+            before = app.composite_flights.stats()["deduplicated"]
+            elapsed = burst(test_client, threads, args.requests)
+            total = threads * args.requests
+            deduplicated = app.composite_flights.stats()["deduplicated"] - before
+            print(f"{threads:>8} {'on' if enabled else 'off':>14} {total / elapsed:>8.0f} "
+                  f"{(client.calls - before_calls) / total:>18.1f} {deduplicated:>13}")
+
+
+if __name__ == '__main__':
+    main()
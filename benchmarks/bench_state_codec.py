@@ -0,0 +1,126 @@
+"""
+Measure the storage size and encode/decode time of state values per codec
+and compression.
+
+Each document (an order, and composites of growing size) is encoded with
+every combination state_codec supports that is installed. IDs, names,
+dates and amounts vary from order to order, so compression ratios are not
+inflated by repeated values. Columns:
+
+- bytes: the value as the service writes it
+- row: the value column of the Dapr PostgreSQL row; anything but plain JSON
+  is stored as a base64 JSON string, a third larger
+- encode / decode: median time to encode the document and to decode it back
+- to_json: median time to get JSON bytes to send, as GET endpoints do
+  (nothing to do for plain JSON, which is sent as stored)
+
+Usage:
+    python benchmarks/bench_state_codec.py --orders 10 100 1000 5000 --iterations 50
+"""
+import argparse
+import base64
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.join(BENCH_DIR, '..', 'composite-materializer', 'src'))
+
+import state_codec  # noqa: E402
+from state_codec import decode, encode, to_json  # noqa: E402
+
+ADJECTIVES = ["Classic", "Deluxe", "Compact", "Wireless", "Organic", "Premium", "Travel", "Eco"]
+
+COMBINATIONS = [
+    ("json", "none"), ("json", "gzip"), ("json", "zstd"),
+    ("msgpack", "none"), ("msgpack", "gzip"), ("msgpack", "zstd"),
+]
+
+
+def order(rng, order_id, user_id="u1"):
+    return {
+        "orderId": str(order_id), "userId": user_id,
+        "orderDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "totalAmount": round(rng.uniform(5, 2000), 2),
+        "products": [{"productId": f"p{rng.randrange(10000)}", "quantity": rng.randint(1, 5)}
+                     for _ in range(rng.randint(1, 5))]
+    }
+
+
+def composite(rng, orders):
+    return {
+        "userId": "u1", "name": "Bench User", "email": "bench@example.com",
+        "orders": [
+            {
+                "orderId": str(100000 + i),
+                "orderDate": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "totalAmount": round(rng.uniform(5, 2000), 2),
+                "products": [
+                    {"productId": f"p{product}", "name": f"Product {product} {rng.choice(ADJECTIVES)}",
+                     "price": round(rng.uniform(1, 500), 2), "quantity": rng.randint(1, 5)}
+                    for product in (rng.randrange(10000) for _ in range(rng.randint(1, 5)))
+                ]
+            }
+            for i in range(orders)
+        ]
+    }
+
+
+def median_of(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def available(codec, compression):
+    if codec == "msgpack" and state_codec.msgpack is None:
+        return False
+    return compression != "zstd" or state_codec.zstandard is not None
+
+
+def row_size(data):
+    if state_codec.envelope(data) == ("json", "none"):
+        return len(data)
+    # Quotes around the base64 string in the jsonb column
+    return len(base64.b64encode(data)) + 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--level", type=int, default=state_codec.STATE_COMPRESSION_LEVEL)
+    args = parser.parse_args()
+
+    combinations = [combination for combination in COMBINATIONS if available(*combination)]
+    rng = random.Random(42)
+    documents = [("order", order(rng, 1001))] + [
+        (f"composite/{count}", composite(rng, count)) for count in args.orders
+    ]
+    print(f"level={args.level}")
+    print(f"{'document':>16} {'codec':>15} {'bytes':>9} {'row':>9} {'ratio':>6} "
+          f"{'encode us':>10} {'decode us':>10} {'to_json us':>11}")
+    for name, document in documents:
+        baseline = None
+        for codec, compression in combinations:
+            data = encode(document, codec, compression, args.level)
+            if decode(data) != document:
+                raise RuntimeError(f"{codec}/{compression} did not round-trip {name}")
+            baseline = baseline or row_size(data)
+            iterations = args.iterations if len(data) < 100000 else max(args.iterations // 5, 1)
+            encode_time = median_of(lambda: encode(document, codec, compression, args.level), iterations)
+            decode_time = median_of(lambda: decode(data), iterations)
+            to_json_time = median_of(lambda: to_json(data), iterations)
+            print(f"{name:>16} {codec + '/' + compression:>15} {len(data):>9} {row_size(data):>9} "
+                  f"{row_size(data) / baseline:>6.2f} {encode_time * 1e6:>10.1f} {decode_time * 1e6:>10.1f} "
+                  f"{to_json_time * 1e6:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Compare buffered and NDJSON-streamed all-details responses.
+
+For each order count, reports the time until the first response line is
+ready and the peak memory allocated while producing the whole response
+(tracemalloc). The direct path runs against FakeDaprClient, with the Order
+Service paging handled like GET /orders?userId=&limit=&cursor=. The drasi
+path encodes a stored composite document, both as the materializer writes it
+(profile fields first) and in the key order PostgreSQL's jsonb returns it
+("orders" before "userId"); the streamed records are checked against the
+whole decoded document for both layouts before timing.
+
+Usage:
+    python benchmarks/bench_streaming.py --orders 100 1000 10000 --items 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'all-details-direct', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'all-details-drasi', 'src'))
+
+from fake_dapr import FakeDaprClient, json_app  # noqa: E402
+from bench_direct_fanout import catalog_app  # noqa: E402
+from aggregator import build_profile_with_orders, stream_profile_with_orders  # noqa: E402
+from composite_stream import iter_composite  # noqa: E402
+from product_cache import product_cache  # noqa: E402
+
+
+def make_orders(count, items, products):
+    return [
+        {
+            "orderId": f"o{i}",
+            "userId": "u1",
+            "orderDate": "2025-01-01",
+            "totalAmount": 100.0,
+            "products": [
+                {"productId": f"p{(i * items + j) % products}", "quantity": 1}
+                for j in range(items)
+            ]
+        }
+        for i in range(count)
+    ]
+
+
+def orders_app(orders):
+    """
+    Serve GET orders?userId= with the optional limit/cursor paging of the Order Service
+    """
+    def handler(method_name, http_verb, data):
+        params = parse_qs(method_name.split('?', 1)[1])
+        if "limit" not in params:
+            return json.dumps(orders).encode('utf-8')
+        start = int(params.get("cursor", ["0"])[0])
+        end = start + int(params["limit"][0])
+        return json.dumps({
+            "orders": orders[start:end],
+            "nextCursor": str(end) if end < len(orders) else None
+        }).encode('utf-8')
+    return handler
+
+
+def jsonb_layout(value):
+    """
+    `value` with object keys in jsonb's order: shorter keys first, then bytewise
+    """
+    if isinstance(value, dict):
+        return {
+            key: jsonb_layout(value[key])
+            for key in sorted(value, key=lambda k: (len(k.encode('utf-8')), k.encode('utf-8')))
+        }
+    if isinstance(value, list):
+        return [jsonb_layout(item) for item in value]
+    return value
+
+
+def check_iter_composite(text):
+    """
+    Fail unless iter_composite yields the profile and then every order of `text`
+    """
+    composite = json.loads(text)
+    expected = [{k: v for k, v in composite.items() if k != "orders"}] + composite["orders"]
+    records = list(iter_composite(text))
+    if records != expected:
+        raise AssertionError(f"iter_composite returned {len(records)} records that differ from the document")
+
+
+def measure(produce):
+    """
+    Run `produce` (an iterable of encoded chunks) to completion twice: once for
+    timing and once under tracemalloc, which slows allocation down. Returns
+    (seconds to first chunk, total seconds, peak bytes allocated)
+    """
+    start = time.perf_counter()
+    first = None
+    for _ in produce():
+        if first is None:
+            first = time.perf_counter() - start
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in produce():
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first, total, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, nargs='+', default=[100, 1000, 10000], help="orders per user")
+    parser.add_argument("--items", type=int, default=5, help="line items per order")
+    parser.add_argument("--products", type=int, default=200, help="distinct products in the catalog")
+    parser.add_argument("--latency", type=float, default=0.0005, help="simulated seconds per sidecar call")
+    args = parser.parse_args()
+
+    # Measure the aggregation itself, not product cache hits from earlier runs
+    product_cache.max_entries = 0
+
+    catalog = {
+        f"p{i}": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)}
+        for i in range(args.products)
+    }
+    print(f"items={args.items} products={args.products} latency={args.latency * 1000:.2f}ms")
+    print(f"{'path':>6} {'orders':>7} {'mode':>9} {'first ms':>9} {'total ms':>9} {'peak KiB':>9}")
+
+    for count in args.orders:
+        orders = make_orders(count, args.items, args.products)
+        client = FakeDaprClient(latency=args.latency)
+        client.register_app("user-service", json_app(
+            {"u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}},
+            lambda m: m.split('/', 1)[1]
+        ))
+        client.register_app("order-service", orders_app(orders))
+        client.register_app("product-service", catalog_app(catalog))
+
+        def direct_buffered():
+            yield json.dumps(build_profile_with_orders(client, "u1"))
+
+        def direct_streamed():
+            for record in stream_profile_with_orders(client, "u1"):
+                yield json.dumps(record) + "\n"
+
+        composite = build_profile_with_orders(client, "u1")
+        stored = json.dumps(composite).encode('utf-8')
+        stored_jsonb = json.dumps(jsonb_layout(composite)).encode('utf-8')
+        del composite
+        check_iter_composite(stored.decode('utf-8'))
+        check_iter_composite(stored_jsonb.decode('utf-8'))
+
+        def drasi_buffered():
+            yield json.dumps(json.loads(stored.decode('utf-8')))
+
+        def drasi_streamed():
+            for record in iter_composite(stored.decode('utf-8')):
+                yield json.dumps(record) + "\n"
+
+        def jsonb_buffered():
+            yield json.dumps(json.loads(stored_jsonb.decode('utf-8')))
+
+        def jsonb_streamed():
+            for record in iter_composite(stored_jsonb.decode('utf-8')):
+                yield json.dumps(record) + "\n"
+
+        for path, buffered, streamed in (("direct", direct_buffered, direct_streamed),
+                                         ("drasi", drasi_buffered, drasi_streamed),
+                                         ("jsonb", jsonb_buffered, jsonb_streamed)):
+            for mode, produce in (("buffered", buffered), ("ndjson", streamed)):
+                first, total, peak = measure(produce)
+                print(f"{path:>6} {count:>7} {mode:>9} {first * 1000:>9.1f} {total * 1000:>9.1f} {peak / 1024:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
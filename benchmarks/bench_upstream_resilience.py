@@ -0,0 +1,132 @@
+"""
+Measure all-details-direct latency when one Product Service replica is slow.
+
+Upstream services are served by FakeDaprClient handlers with a simulated
+delay per sidecar call; a fraction of Product Service calls take much
+longer, as if routed to a slow replica. The product cache is disabled so
+every request reaches the Product Service. Each mode is run against the
+same slow-call pattern:
+
+- none: no deadline, per-call timeout or hedging (how requests behaved before)
+- timeout: per-call timeout, slow product batches are sent as "Unknown Product"
+- hedge: a second product read is sent after the observed p95 latency
+
+Usage:
+    python benchmarks/bench_upstream_resilience.py --requests 400 --threads 1 --slow-fraction 0.05 --slow-ms 500
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dapr import FakeDaprClient, json_app  # noqa: E402
+from bench_direct_fanout import catalog_app  # noqa: E402
+from bench_streaming import make_orders, orders_app  # noqa: E402
+
+# bench_streaming puts all-details-drasi first on the path; app must be all-details-direct's
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'all-details-direct', 'src'))
+
+MODES = {
+    "none": dict(UPSTREAM_DEADLINE_MS=0, UPSTREAM_CALL_TIMEOUT_MS=0, HEDGE_ENABLED=False),
+    "timeout": dict(UPSTREAM_DEADLINE_MS=1000, UPSTREAM_CALL_TIMEOUT_MS=100, HEDGE_ENABLED=False),
+    "hedge": dict(UPSTREAM_DEADLINE_MS=1000, UPSTREAM_CALL_TIMEOUT_MS=100, HEDGE_ENABLED=True),
+}
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run(test_client, requests, threads):
+    latencies = []
+    degraded = [0]
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            resp = test_client.get("/users/u1/all-details-direct")
+            elapsed = time.perf_counter() - start
+            if resp.status_code != 200:
+                raise RuntimeError(f"Request failed with {resp.status_code}")
+            with lock:
+                latencies.append(elapsed)
+                if b"Unknown Product" in resp.data:
+                    degraded[0] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies, degraded[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per sidecar call")
+    parser.add_argument("--slow-fraction", type=float, default=0.05, help="share of Product Service calls that are slow")
+    parser.add_argument("--slow-ms", type=float, default=500, help="extra delay of a slow call")
+    parser.add_argument("--warmup", type=int, default=100, help="requests run first so hedging has latency samples")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    rng_lock = threading.Lock()
+
+    def slow_replica():
+        with rng_lock:
+            slow = rng.random() < args.slow_fraction
+        return args.slow_ms / 1000 if slow else 0.0
+
+    client = FakeDaprClient(latency=args.latency)
+    client.register_app("user-service", json_app(
+        {"u1": {"userId": "u1", "name": "Bench User", "email": "bench@example.com"}},
+        lambda m: m.split('/', 1)[1]
+    ))
+    client.register_app("order-service", orders_app(make_orders(args.orders, 3, 200)))
+    client.register_app("product-service", catalog_app({
+        f"p{i}": {"productId": f"p{i}", "name": f"Product {i}", "price": float(i)} for i in range(200)
+    }), delay=slow_replica)
+    import dapr_client
+    dapr_client.set_client_factory(lambda: client)
+    import app
+    import resilience
+    from product_cache import product_cache
+    product_cache.max_entries = 0
+    app.composite_flights.enabled = False
+    logging.disable(logging.CRITICAL)
+    test_client = app.app.test_client()
+
+    print(f"requests={args.requests} threads={args.threads} latency={args.latency * 1000:.1f}ms "
+          f"slow={args.slow_fraction:.0%} x {args.slow_ms:.0f}ms")
+    print(f"{'mode':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'degraded':>9} {'hedged':>7}")
+    for mode, settings in MODES.items():
+        for name, value in settings.items():
+            setattr(resilience, name, value)
+        resilience._upstreams.clear()
+        rng.seed(42)
+        run(test_client, args.warmup, args.threads)
+        rng.seed(7)
+        before = resilience.upstream_for("product-service").hedged
+        latencies, degraded = run(test_client, args.requests, args.threads)
+        hedged = resilience.upstream_for("product-service").hedged - before
+        print(f"{mode:>8} {percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 99) * 1000:>8.1f} "
+              f"{max(latencies) * 1000:>8.1f} {degraded:>9} {hedged:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+In-memory stand-in for dapr.clients.DaprClient used by the benchmarks.
+
+Every sidecar call sleeps for a configurable latency so that the cost of
+round trips to the sidecar dominates, the same way it does in a cluster.
+"""
+import http.client
+import json
+import random
+import threading
+import time
+
+
+class FakeResponse:
+    def __init__(self, data=b'', etag=''):
+        self.data = data
+        self.etag = etag
+
+
+class FakeBulkStateItem:
+    def __init__(self, key, data=b'', etag='', error=''):
+        self.key = key
+        self.data = data
+        self.etag = etag
+        self.error = error
+
+
+class FakeBulkStatesResponse:
+    def __init__(self, items):
+        self.items = items
+
+
+class FakeEtagMismatch(Exception):
+    def __init__(self, key):
+        super().__init__(f"possible etag mismatch for key {key}")
+
+
+class FakeTimeout(TimeoutError):
+    pass
+
+
+class FakeDaprClient:
+    """
+    Minimal DaprClient replacement with an in-memory state store and
+    pluggable service invocation handlers.
+
+    `latency` is the simulated round-trip time of each sidecar call in seconds
+    and `jitter` adds a uniformly distributed random delay on top of it.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.stores = {}
+        self.etags = {}
+        self.apps = {}
+        self.delays = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def close(self):
+        pass
+
+    def _round_trip(self, extra=0.0, timeout=None):
+        with self._lock:
+            self.calls += 1
+        delay = self.latency + extra + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise FakeTimeout(f"call timed out after {timeout:.3f}s")
+        if delay:
+            time.sleep(delay)
+
+    def register_app(self, app_id, handler, delay=None):
+        """
+        Register a handler(method_name, http_verb, data) -> bytes for an app ID.
+        `delay` is an optional callable returning extra seconds for each call,
+        e.g. to simulate a slow replica.
+        """
+        self.apps[app_id] = handler
+        if delay is not None:
+            self.delays[app_id] = delay
+
+    def seed(self, store_name, items):
+        """
+        Load {key: value} pairs into a store without simulated latency
+        """
+        with self._lock:
+            for key, value in items.items():
+                self._write(store_name, key, value if isinstance(value, bytes) else json.dumps(value), None)
+
+    def invoke_method(self, app_id, method_name, data='', content_type=None,
+                      metadata=None, http_verb=None, http_querystring=None, timeout=None):
+        delay = self.delays.get(app_id)
+        self._round_trip(delay() if delay else 0.0, timeout)
+        return FakeResponse(self.apps[app_id](method_name, http_verb, data))
+
+    def _etag(self, store_name, key):
+        version = self.etags.get((store_name, key))
+        return str(version) if version is not None else ''
+
+    def _write(self, store_name, key, value, etag):
+        # Callers hold self._lock; an ETag must match the stored version
+        if etag and etag != self._etag(store_name, key):
+            raise FakeEtagMismatch(key)
+        if value is None:
+            self.stores.get(store_name, {}).pop(key, None)
+            self.etags.pop((store_name, key), None)
+            return
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        self.stores.setdefault(store_name, {})[key] = value
+        self.etags[(store_name, key)] = self.etags.get((store_name, key), 0) + 1
+
+    def get_state(self, store_name, key, state_metadata=None, metadata=None):
+        self._round_trip()
+        with self._lock:
+            return FakeResponse(self.stores.get(store_name, {}).get(key, b''), self._etag(store_name, key))
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None, metadata=None):
+        self._round_trip()
+        with self._lock:
+            store = self.stores.get(store_name, {})
+            return FakeBulkStatesResponse([
+                FakeBulkStateItem(key, store.get(key, b''), self._etag(store_name, key)) for key in keys
+            ])
+
+    def save_state(self, store_name, key, value, etag=None, options=None,
+                   state_metadata=None, metadata=None):
+        self._round_trip()
+        with self._lock:
+            first_write = getattr(getattr(options, "concurrency", None), "name", None) == "first_write"
+            if first_write and not etag and self._etag(store_name, key):
+                raise FakeEtagMismatch(key)
+            self._write(store_name, key, value, etag)
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        self._round_trip()
+        with self._lock:
+            for state in states:
+                first_write = getattr(getattr(state.options, "concurrency", None), "name", None) == "first_write"
+                if first_write and not state.etag and self._etag(store_name, state.key):
+                    raise FakeEtagMismatch(state.key)
+            for state in states:
+                self._write(store_name, state.key, state.value, state.etag)
+
+    def execute_state_transaction(self, store_name, operations, transactional_metadata=None, metadata=None):
+        self._round_trip()
+        with self._lock:
+            for op in operations:
+                if op.etag and op.etag != self._etag(store_name, op.key):
+                    raise FakeEtagMismatch(op.key)
+            for op in operations:
+                deleted = getattr(op.operation_type, "name", None) == "delete"
+                self._write(store_name, op.key, None if deleted else op.data, None)
+
+
+def json_app(store, key_for):
+    """
+    Build an invocation handler that serves JSON documents from a dict.
+
+    `key_for(method_name)` maps the invoked method to a key in `store`;
+    unknown keys produce an empty response like a missing record does.
+    """
+    def handler(method_name, http_verb, data):
+        value = store.get(key_for(method_name))
+        return json.dumps(value).encode('utf-8') if value is not None else b''
+    return handler
+
+
+def http_app(port, host="127.0.0.1"):
+    """
+    Build an invocation handler that forwards calls over HTTP to a service
+    listening on `port`, the way the sidecar forwards to its app.
+
+    Each calling thread keeps its own keep-alive connection. The response
+    body is returned whatever the status, like Dapr does for HTTP apps.
+    """
+    local = threading.local()
+
+    def request(method_name, http_verb, data):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection(host, port, timeout=30)
+        headers = {"Content-Type": "application/json"} if data else {}
+        conn.request(http_verb or "POST", "/" + method_name, body=data or None, headers=headers)
+        return conn.getresponse().read()
+
+    def handler(method_name, http_verb, data):
+        try:
+            return request(method_name, http_verb, data)
+        except (http.client.HTTPException, ConnectionError):
+            # The app closed an idle keep-alive connection; reconnect once
+            local.conn.close()
+            local.conn = None
+            return request(method_name, http_verb, data)
+    return handler
@@ -0,0 +1,149 @@
+import os
+import atexit
+import logging
+from flask import Flask, request, jsonify
+from composite_builder import build_composite, fetch_products
+from dapr_client import dapr_client, init_client
+from metrics import install_metrics
+from logging_setup import configure_logging, install_correlation_ids
+from materializer import Materializer, DaprStateStore
+from write_behind import WriteBehindStore, WRITE_BEHIND_ENABLED
+
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
+
+# Dapr configuration
+DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
+DAPR_STORE_NAME = "drasi-state-store"
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+logger.info("Using Dapr store name: %s", DAPR_STORE_NAME)
+# Set to "false" to start composites of users without one from the first change instead
+# of building them from the User, Order and Product services
+BUILD_MISSING_COMPOSITES_ENABLED = os.getenv("BUILD_MISSING_COMPOSITES_ENABLED", "true").lower() == "true"
+logger.info("Building missing composites from the source services: %s", BUILD_MISSING_COMPOSITES_ENABLED)
+# Set to "false" to show products without a stored copy as "Unknown Product" until their
+# next change instead of fetching them from the Product Service
+FETCH_MISSING_PRODUCTS_ENABLED = os.getenv("FETCH_MISSING_PRODUCTS_ENABLED", "true").lower() == "true"
+logger.info("Fetching products without a stored copy: %s", FETCH_MISSING_PRODUCTS_ENABLED)
+
+composite_store = DaprStateStore(dapr_client, DAPR_STORE_NAME)
+write_behind = None
+if WRITE_BEHIND_ENABLED:
+    # Coalesce and batch composite, gzip copy and freshness stamp writes; indexes and product copies are written through
+    write_behind = WriteBehindStore(composite_store)
+    atexit.register(write_behind.close)
+    composite_store = write_behind
+logger.info("Using write-behind for composites: %s", WRITE_BEHIND_ENABLED)
+
+def build_from_sources(user_id):
+    with dapr_client() as client:
+        return build_composite(client, user_id)
+
+def fetch_from_product_service(product_ids):
+    with dapr_client() as client:
+        return fetch_products(client, product_ids)
+
+materializer = Materializer(
+    composite_store,
+    build_from_sources if BUILD_MISSING_COMPOSITES_ENABLED else None,
+    fetch_from_product_service if FETCH_MISSING_PRODUCTS_ENABLED else None
+)
+
+@app.route('/changes', methods=['POST'])
+def apply_changes():
+    """
+    Apply user, order and product change events to the composites
+    Example request body (a single event or a list of events):
+    [
+      { "op": "upsert", "key": "product:p1", "value": { "productId": "p1", "name": "Laptop", "price": 1000.00 } },
+      { "op": "delete", "key": "order:1001" }
+    ]
+    """
+    events = request.json
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list):
+        logger.warning("Change request body is not an event or a list of events")
+        return jsonify({"error": "Expected a change event or a list of change events"}), 400
+    logger.info("POST /changes request with %s events", len(events))
+    
+    applied = 0
+    skipped = 0
+    try:
+        for event in events:
+            if materializer.apply(event):
+                applied += 1
+            else:
+                skipped += 1
+        
+        logger.info("Applied %s changes, skipped %s", applied, skipped)
+        return jsonify({"applied": applied, "skipped": skipped}), 200
+    
+    except ValueError as e:
+        logger.warning("Invalid change event: %s", e)
+        return jsonify({"error": str(e), "applied": applied, "skipped": skipped}), 400
+    except Exception as e:
+        logger.error("Error in apply_changes: %s", e, exc_info=True)
+        return jsonify({"error": str(e), "applied": applied, "skipped": skipped}), 500
+
+@app.route('/composites:repair', methods=['POST'])
+def repair_composite():
+    """
+    Store a composite built on demand by all-details-drasi after a miss,
+    unless one exists by now
+    Example request body:
+    {
+      "userId": "123",
+      "name": "John Doe",
+      "email": "john@example.com",
+      "orders": [ { "orderId": "1001", "orderDate": "2025-01-01", "totalAmount": 1000.00, "products": [...] } ]
+    }
+    """
+    composite = request.json
+    if not isinstance(composite, dict) or not composite.get("userId") or not isinstance(composite.get("orders"), list):
+        logger.warning("Repair request body is not a composite")
+        return jsonify({"error": "Expected a composite with userId and orders"}), 400
+    logger.info("POST /composites:repair request for user: %s", composite["userId"])
+    
+    try:
+        repaired = materializer.repair(composite)
+        logger.info("Repair of composite for user %s %s", composite["userId"], "stored" if repaired else "skipped")
+        return jsonify({"repaired": repaired}), 200
+    
+    except Exception as e:
+        logger.error("Error in repair_composite: %s", e, exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/write-behind/stats', methods=['GET'])
+def write_behind_stats():
+    """
+    Write-behind queue depth, coalescing ratio and flush latency
+    """
+    if write_behind is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(write_behind.stats(), enabled=True)), 200
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """
+    Health check endpoint
+    """
+    logger.info("GET /health request received")
+    logger.debug("Performing health check")
+    
+    # You could add more comprehensive health checks here
+    # For example, checking if Dapr state store is accessible
+    
+    logger.info("Health check successful")
+    return jsonify({"status": "healthy"}), 200
+
+if __name__ == '__main__':
+    logger.info("Starting Composite Materializer application")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
+    app.run(host='0.0.0.0', port=5000)
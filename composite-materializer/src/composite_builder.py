@@ -0,0 +1,92 @@
+import os
+
+from fast_json import dumps, loads
+from metrics import timed
+
+# Number of unique product IDs resolved per POST /products:batchGet call.
+# Must not exceed BATCH_GET_MAX_IDS in the Product Service.
+PRODUCT_BATCH_SIZE = int(os.getenv("PRODUCT_BATCH_SIZE", "500"))
+
+# Name shown for products that could not be found or fetched
+UNKNOWN_PRODUCT = "Unknown Product"
+
+
+def enrich_product(product_item, product_data):
+    """
+    Same line item shape and "Unknown Product" fallback as all-details-direct
+    """
+    if product_data is None:
+        return {
+            "productId": product_item.get("productId"),
+            "name": UNKNOWN_PRODUCT,
+            "price": 0,
+            "quantity": product_item.get("quantity", 0)
+        }
+    return {
+        "productId": product_item.get("productId"),
+        "name": product_data.get("name", "Unknown"),
+        "price": product_data.get("price", 0),
+        "quantity": product_item.get("quantity", 0)
+    }
+
+
+@timed("fetch_products")
+def fetch_products(client, product_ids):
+    """
+    Product data of `product_ids` from the Product Service, in batches of
+    PRODUCT_BATCH_SIZE, as {productId: product}; unknown products are left out
+    """
+    products = {}
+    for i in range(0, len(product_ids), PRODUCT_BATCH_SIZE):
+        products_resp = client.invoke_method(
+            app_id="product-service",
+            method_name="products:batchGet",
+            data=dumps({"productIds": product_ids[i:i + PRODUCT_BATCH_SIZE]}),
+            content_type="application/json",
+            http_verb="POST"
+        )
+        if products_resp.data:
+            products.update(loads(products_resp.data).get("products", {}))
+    return products
+
+
+@timed("build_composite")
+def build_composite(client, user_id):
+    """
+    Build a user's composite from the User, Order and Product services, in
+    the shape the materializer stores, or None if the user does not exist
+    """
+    user_resp = client.invoke_method(app_id="user-service", method_name=f"users/{user_id}", http_verb="GET")
+    if not user_resp.data:
+        return None
+    user = loads(user_resp.data)
+
+    orders_resp = client.invoke_method(app_id="order-service", method_name=f"orders?userId={user_id}", http_verb="GET")
+    orders = loads(orders_resp.data) if orders_resp.data else []
+
+    product_ids = list(dict.fromkeys(
+        item["productId"]
+        for order in orders
+        for item in order.get("products", [])
+        if item.get("productId")
+    ))
+    products = fetch_products(client, product_ids)
+
+    return {
+        "userId": user_id,
+        "name": user.get("name"),
+        "email": user.get("email"),
+        "orders": [
+            {
+                "orderId": order.get("orderId"),
+                "orderDate": order.get("orderDate"),
+                "totalAmount": order.get("totalAmount"),
+                "products": [
+                    enrich_product(item, products.get(item["productId"]))
+                    for item in order.get("products", [])
+                    if item.get("productId")
+                ]
+            }
+            for order in orders
+        ]
+    }
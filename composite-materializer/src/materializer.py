@@ -0,0 +1,540 @@
+import os
+import copy
+import gzip
+import json
+import time
+import logging
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from dapr.clients.grpc._state import StateItem
+from prometheus_client import Histogram
+
+from composite_builder import UNKNOWN_PRODUCT, enrich_product
+from fast_json import dumps
+from metrics import METRICS_ENABLED, labelled, timed
+from state_codec import decode, decode_row, encode
+
+logger = logging.getLogger(__name__)
+
+# Keys maintained in the composite store next to the `user:{userId}` composites
+COMPOSITE_KEY = "user:{}"
+PRODUCT_KEY = "product:{}"
+PRODUCT_USERS_KEY = "product-users:{}"
+ORDER_OWNER_KEY = "order-owner:{}"
+# Which source write a composite last reflected, and when
+FRESHNESS_KEY = "freshness:{}"
+# The composite's JSON compressed with gzip, served to clients that accept gzip
+GZIP_COMPOSITE_KEY = "user-gzip:{}"
+
+# gzip level of the stored composite copies; each is compressed once per write and served on every read
+COMPOSITE_GZIP_LEVEL = int(os.getenv("COMPOSITE_GZIP_LEVEL", "6"))
+
+_LOCK_STRIPES = 64
+
+# The row a change event describes: entity, "entity:id" key and its write time
+# in seconds since the epoch, if the event carried one
+SourceWrite = namedtuple("SourceWrite", ["entity", "key", "time"])
+
+# Lag buckets from 10ms to 15 minutes
+LAG_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+FRESHNESS_LAG = Histogram(
+    "composite_freshness_lag_seconds", "Time from a source write to the composite reflecting it being stored",
+    ["entity"], buckets=LAG_BUCKETS
+)
+
+
+def observe_freshness_lag(entity, lag):
+    """
+    Record how long after a user, order or product write a composite
+    reflecting it was stored. Negative lags from clock skew count as 0.
+    """
+    if not METRICS_ENABLED:
+        return
+    labelled(FRESHNESS_LAG, entity).observe(max(lag, 0.0))
+
+
+class InMemoryStateStore:
+    """
+    Dict-backed state store with the same interface as DaprStateStore
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.writes = 0
+
+    def get(self, key):
+        return copy.deepcopy(self.data.get(key))
+
+    def save(self, key, value):
+        self.writes += 1
+        self.data[key] = copy.deepcopy(value)
+
+    def delete(self, key):
+        self.writes += 1
+        self.data.pop(key, None)
+
+    def save_many(self, items):
+        for key, value in items:
+            self.save(key, value)
+
+    def observe_lag(self, key, entity, written_at):
+        observe_freshness_lag(entity, time.time() - written_at)
+
+
+def _encode(value):
+    # Bytes (compressed composite copies) are stored as they are
+    return value if isinstance(value, bytes) else encode(value)
+
+
+class DaprStateStore:
+    """
+    Documents in a Dapr state store, encoded with state_codec and read and
+    written with a shared client
+    """
+
+    def __init__(self, client_factory, store_name):
+        self.client_factory = client_factory
+        self.store_name = store_name
+
+    def get(self, key):
+        with self.client_factory() as client:
+            resp = client.get_state(store_name=self.store_name, key=key)
+        if not resp.data:
+            return None
+        return decode(resp.data)
+
+    def save(self, key, value):
+        with self.client_factory() as client:
+            client.save_state(store_name=self.store_name, key=key, value=_encode(value))
+
+    def delete(self, key):
+        with self.client_factory() as client:
+            client.delete_state(store_name=self.store_name, key=key)
+
+    def save_many(self, items):
+        with self.client_factory() as client:
+            client.save_bulk_state(
+                store_name=self.store_name,
+                states=[StateItem(key=key, value=_encode(value)) for key, value in items]
+            )
+
+    def observe_lag(self, key, entity, written_at):
+        """
+        Record the freshness lag of a key that reflects a source write made
+        at `written_at`; saves are synchronous, so the key is stored by now
+        """
+        observe_freshness_lag(entity, time.time() - written_at)
+
+
+def parse_change(event):
+    """
+    Turn a change event into (entity, entity_id, op, value).
+
+    Events describe a row of a service state table:
+    {
+      "op": "upsert" | "delete",
+      "key": "order-service||order:1001",
+      "value": { ... }
+    }
+    The optional "<app-id>||" prefix Dapr adds to keys is ignored. Returns
+    None for keys the composites do not depend on (e.g. user-orders indexes).
+    An optional "ts" holds the time of the source write (see source_time).
+    With "isbinary": true, as on rows not stored as plain JSON, the value is
+    the row's base64 string and is decoded with state_codec.
+    """
+    key = event.get("key", "")
+    if "||" in key:
+        key = key.split("||", 1)[1]
+    entity, _, entity_id = key.partition(":")
+    if entity not in ("user", "order", "product") or not entity_id:
+        return None
+    op = event.get("op", "upsert")
+    if op not in ("upsert", "delete"):
+        raise ValueError(f"Unsupported change op: {op}")
+    value = event.get("value")
+    if event.get("isbinary"):
+        value = decode_row(value, True)
+    elif isinstance(value, str):
+        value = json.loads(value)
+    return entity, entity_id, op, value
+
+
+def source_time(event):
+    """
+    Time of the source write an event describes, in seconds since the epoch,
+    from its optional "ts" in milliseconds (e.g. the state row's updatedate
+    or the CDC event's ts_ms), or None
+    """
+    ts = event.get("ts")
+    if ts is None:
+        return None
+    if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+        raise ValueError(f"Change ts must be milliseconds since the epoch, got: {ts!r}")
+    return ts / 1000.0
+
+
+def composite_items(user_id, composite):
+    """
+    (key, value) pairs that store a composite: the JSON document and its
+    gzip-compressed encoding as bytes
+    """
+    return [
+        (COMPOSITE_KEY.format(user_id), composite),
+        (GZIP_COMPOSITE_KEY.format(user_id), gzip.compress(dumps(composite), COMPOSITE_GZIP_LEVEL, mtime=0))
+    ]
+
+
+def freshness_item(user_id, source_key, source_time=None):
+    """
+    (key, value) of the freshness stamp of a composite stored now that
+    reflects `source_key` (e.g. "order:1001", "repair" or "rebuild"), written
+    at `source_time` in seconds since the epoch if known
+    """
+    return (FRESHNESS_KEY.format(user_id), {
+        "source": source_key,
+        "sourceUpdatedAt": None if source_time is None else _timestamp(source_time),
+        "materializedAt": _timestamp(time.time())
+    })
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class Materializer:
+    """
+    Keeps `user:{userId}` composites up to date from user, order and product
+    change events, touching only the composites each change affects.
+
+    Besides the composites, the store holds a copy of every product, a
+    product -> users reverse index and an order -> user owner map, so that a
+    product change only rewrites the composites of users who ordered it.
+
+    Every composite written for a change event is stamped with a
+    `freshness:{userId}` document naming the source write it reflects, and
+    the time from that write to the composite being stored is recorded as
+    its freshness lag.
+
+    `build_composite`, if given, is called with a user ID to build the full
+    composite of a user who has none yet (e.g. after starting without a
+    backfill) from the source services, so that a change for that user does
+    not leave a composite holding only that change. It returns None for a
+    user who does not exist; an error fails the change event.
+
+    `fetch_products`, if given, is called with the IDs of products that have
+    no stored copy yet (e.g. products not changed since the materializer
+    started) and returns {productId: product} for those the Product Service
+    knows. The results are stored as copies, so a product is fetched once
+    rather than shown as "Unknown Product" until its next change. An error
+    fails the change event.
+    """
+
+    def __init__(self, store, build_composite=None, fetch_products=None):
+        self.store = store
+        self.build_composite = build_composite
+        self.fetch_products = fetch_products
+        # Composite locks are always taken before index and product locks, never the reverse
+        self._composite_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+        self._index_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+        self._product_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    @staticmethod
+    def _stripe(locks, key):
+        return locks[zlib.crc32(key.encode('utf-8')) % _LOCK_STRIPES]
+
+    def _composite_lock(self, composite_key):
+        return self._stripe(self._composite_locks, composite_key)
+
+    def _index_lock(self, index_key):
+        return self._stripe(self._index_locks, index_key)
+
+    def _product_lock(self, product_key):
+        return self._stripe(self._product_locks, product_key)
+
+    def apply(self, event):
+        """
+        Apply one change event. Returns False if the event was ignored.
+        """
+        change = parse_change(event)
+        if change is None:
+            logger.debug("Ignoring change for key: %s", event.get('key'))
+            return False
+        entity, entity_id, op, value = change
+        if op == "upsert" and not isinstance(value, dict):
+            raise ValueError(f"Upsert of {entity}:{entity_id} has no value")
+        deleted = op == "delete"
+        source = SourceWrite(entity, f"{entity}:{entity_id}", source_time(event))
+        logger.debug("Applying %s of %s:%s", op, entity, entity_id)
+        if entity == "user":
+            self.apply_user(entity_id, value, deleted, source)
+        elif entity == "order":
+            self.apply_order(entity_id, value, deleted, source)
+        else:
+            self.apply_product(entity_id, value, deleted, source)
+        return True
+
+    def apply_all(self, events):
+        """
+        Apply events in order, e.g. from an in-memory event source
+        """
+        return sum(1 for event in events if self.apply(event))
+
+    # Users
+
+    @timed("apply_user")
+    def apply_user(self, user_id, user, deleted=False, source=None):
+        composite_key = COMPOSITE_KEY.format(user_id)
+        with self._composite_lock(composite_key):
+            if deleted:
+                self.store.delete(composite_key)
+                self.store.delete(GZIP_COMPOSITE_KEY.format(user_id))
+                self.store.delete(FRESHNESS_KEY.format(user_id))
+                return
+            composite = self._load_composite(user_id)
+            composite["name"] = user.get("name")
+            composite["email"] = user.get("email")
+            self._save_composite(user_id, composite, source)
+
+    # Orders
+
+    @timed("apply_order")
+    def apply_order(self, order_id, order, deleted=False, source=None):
+        owner_key = ORDER_OWNER_KEY.format(order_id)
+        previous_owner = self.store.get(owner_key)
+        user_id = None if deleted else order.get("userId")
+
+        # An order that moved to another user (or was deleted) leaves its old composite
+        if previous_owner and previous_owner != user_id:
+            self._remove_order(previous_owner, order_id, source)
+        if deleted:
+            self.store.delete(owner_key)
+            return
+
+        composite_key = COMPOSITE_KEY.format(user_id)
+        with self._composite_lock(composite_key):
+            composite = self._load_composite(user_id)
+            product_ids = self._product_ids([order])
+
+            # Register the user in the reverse index before reading product copies,
+            # so a concurrent product change either sees the user or is seen here
+            for product_id in product_ids:
+                self._add_product_user(product_id, user_id)
+            products = self._product_copies(product_ids)
+
+            enriched_order = {
+                "orderId": order.get("orderId", order_id),
+                "orderDate": order.get("orderDate"),
+                "totalAmount": order.get("totalAmount"),
+                "products": [
+                    enrich_product(item, products[item["productId"]])
+                    for item in order.get("products", [])
+                    if item.get("productId")
+                ]
+            }
+            replaced = [o for o in composite["orders"] if o.get("orderId") == enriched_order["orderId"]]
+            if replaced:
+                composite["orders"] = [
+                    enriched_order if o.get("orderId") == enriched_order["orderId"] else o
+                    for o in composite["orders"]
+                ]
+            else:
+                composite["orders"].append(enriched_order)
+            self._save_composite(user_id, composite, source)
+            self._prune_product_users(composite, user_id, self._product_ids(replaced) - product_ids)
+
+        if previous_owner != user_id:
+            self.store.save(owner_key, user_id)
+
+    def _remove_order(self, user_id, order_id, source=None):
+        composite_key = COMPOSITE_KEY.format(user_id)
+        with self._composite_lock(composite_key):
+            composite = self.store.get(composite_key)
+            if composite is None:
+                return
+            removed = [o for o in composite["orders"] if o.get("orderId") == order_id]
+            composite["orders"] = [o for o in composite["orders"] if o.get("orderId") != order_id]
+            self._save_composite(user_id, composite, source)
+            self._prune_product_users(composite, user_id, self._product_ids(removed))
+
+    # Products
+
+    @timed("apply_product")
+    def apply_product(self, product_id, product, deleted=False, source=None):
+        product_key = PRODUCT_KEY.format(product_id)
+        with self._product_lock(product_key):
+            if deleted:
+                self.store.delete(product_key)
+            else:
+                self.store.save(product_key, product)
+
+        user_ids = self.store.get(PRODUCT_USERS_KEY.format(product_id)) or []
+        logger.debug("Product %s change affects %s composites", product_id, len(user_ids))
+        for user_id in user_ids:
+            self._update_product_in_composite(user_id, product_id, None if deleted else product, source)
+
+    def _product_copies(self, product_ids, known=None):
+        """
+        Stored copies of `product_ids`, None for unknown products. Missing
+        copies are taken from `known` ({productId: product} already at hand)
+        or else fetched, and stored, unless a change event stored one first.
+        """
+        products = {product_id: self.store.get(PRODUCT_KEY.format(product_id)) for product_id in product_ids}
+        missing = [product_id for product_id, product in products.items() if product is None]
+        found = {product_id: known[product_id] for product_id in missing if product_id in (known or {})}
+        unresolved = [product_id for product_id in missing if product_id not in found]
+        if unresolved and self.fetch_products is not None:
+            logger.debug("Fetching %s products without a stored copy", len(unresolved))
+            found.update(self.fetch_products(unresolved))
+        for product_id, product in found.items():
+            if product_id in products:
+                products[product_id] = self._store_product_copy(product_id, product)
+        return products
+
+    def _store_product_copy(self, product_id, product):
+        # A copy stored by a change event in the meantime is newer than the fetched one
+        product_key = PRODUCT_KEY.format(product_id)
+        with self._product_lock(product_key):
+            stored = self.store.get(product_key)
+            if stored is not None:
+                return stored
+            self.store.save(product_key, product)
+            return product
+
+    def _update_product_in_composite(self, user_id, product_id, product, source=None):
+        composite_key = COMPOSITE_KEY.format(user_id)
+        with self._composite_lock(composite_key):
+            composite = self.store.get(composite_key)
+            if composite is None:
+                return
+            changed = False
+            for order in composite["orders"]:
+                for i, item in enumerate(order["products"]):
+                    if item.get("productId") == product_id:
+                        updated = enrich_product(item, product)
+                        if updated != item:
+                            order["products"][i] = updated
+                            changed = True
+            if changed:
+                self._save_composite(user_id, composite, source)
+
+    # Read repair
+
+    @timed("apply_repair")
+    def repair(self, composite):
+        """
+        Store a composite that was built on demand from the source services,
+        unless the user already has one: a composite written by change events
+        is never replaced. The reverse index and owner map are filled in for
+        its orders so that later changes keep it up to date (see _adopt).
+        Returns False if the composite was skipped.
+        """
+        user_id = composite["userId"]
+        composite_key = COMPOSITE_KEY.format(user_id)
+        with self._composite_lock(composite_key):
+            if self.store.get(composite_key) is not None:
+                logger.debug("Skipping repair of %s, composite exists", composite_key)
+                return False
+            self._save_composite(user_id, self._adopt(user_id, composite), SourceWrite(None, "repair", None))
+        return True
+
+    def _load_composite(self, user_id):
+        # Callers hold the composite lock. A user without a composite gets one
+        # built from the source services, or an empty one without a builder.
+        composite = self.store.get(COMPOSITE_KEY.format(user_id))
+        if composite is not None:
+            return composite
+        if self.build_composite is not None:
+            composite = self.build_composite(user_id)
+            if composite is not None:
+                logger.info("Built missing composite for user %s from the source services", user_id)
+                return self._adopt(user_id, composite)
+        return self._empty_composite(user_id)
+
+    def _adopt(self, user_id, composite):
+        """
+        Fill in the reverse index and owner map for a composite built outside
+        the materializer. The user is registered in the reverse index before
+        the product copies are read, as in apply_order: a product change made
+        since the composite was built either finds the user and is applied to
+        the composite once it is stored, or its copy is applied here. Products
+        without a copy get one from the composite's own line items, and only
+        those it shows as "Unknown Product" are fetched.
+        """
+        product_ids = self._product_ids(composite["orders"])
+        for product_id in product_ids:
+            self._add_product_user(product_id, user_id)
+        owners = [
+            (ORDER_OWNER_KEY.format(order["orderId"]), user_id)
+            for order in composite["orders"]
+            if order.get("orderId")
+        ]
+        if owners:
+            self.store.save_many(owners)
+        resolved = {
+            item["productId"]: {"productId": item["productId"], "name": item.get("name"), "price": item.get("price")}
+            for order in composite["orders"]
+            for item in order.get("products", [])
+            if item.get("productId") and item.get("name") != UNKNOWN_PRODUCT
+        }
+        products = self._product_copies(product_ids, resolved)
+        for order in composite["orders"]:
+            order["products"] = [
+                enrich_product(item, products[item["productId"]]) if products.get(item.get("productId")) else item
+                for item in order.get("products", [])
+            ]
+        return composite
+
+    # Freshness
+
+    def _save_composite(self, user_id, composite, source):
+        # Callers hold the composite lock. The gzip copy and the stamp are
+        # written in the same bulk save as the composite.
+        items = composite_items(user_id, composite)
+        if source is not None:
+            items.append(freshness_item(user_id, source.key, source.time))
+        self.store.save_many(items)
+        if source is not None and source.time is not None:
+            self.store.observe_lag(COMPOSITE_KEY.format(user_id), source.entity, source.time)
+
+    # Reverse index
+
+    def _add_product_user(self, product_id, user_id):
+        index_key = PRODUCT_USERS_KEY.format(product_id)
+        with self._index_lock(index_key):
+            user_ids = self.store.get(index_key) or []
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+                self.store.save(index_key, user_ids)
+
+    def _prune_product_users(self, composite, user_id, product_ids):
+        # Only drop the user from products that no remaining order references
+        still_referenced = self._product_ids(composite["orders"])
+        for product_id in product_ids - still_referenced:
+            index_key = PRODUCT_USERS_KEY.format(product_id)
+            with self._index_lock(index_key):
+                user_ids = self.store.get(index_key) or []
+                if user_id in user_ids:
+                    user_ids.remove(user_id)
+                    self.store.save(index_key, user_ids)
+
+    @staticmethod
+    def _product_ids(orders):
+        return {
+            item["productId"]
+            for order in orders
+            for item in order.get("products", [])
+            if item.get("productId")
+        }
+
+    @staticmethod
+    def _empty_composite(user_id):
+        return {
+            "userId": user_id,
+            "name": None,
+            "email": None,
+            "orders": []
+        }
@@ -0,0 +1,167 @@
+"""
+Re-encode the values of a Dapr PostgreSQL state table with the current
+STATE_CODEC and STATE_COMPRESSION (or --codec and --compression).
+
+Values are read in key order, in batches of --batch-size rows, and every
+value not already in the target encoding is decoded and encoded again.
+Each rewrite is conditional on the row's xmin, which is what Dapr uses as
+the ETag, so a value written by a service while the batch was being
+encoded is left alone; like any other write, a rewrite makes ETags read
+before it stale. Plain JSON is stored as jsonb and anything else as a
+base64 JSON string with isbinary set, the way Dapr stores values.
+
+Services read every encoding, so the migration can run while they keep
+writing. Rewritten rows are new row versions and so produce change
+events, which the materializer applies again. The last key of every
+batch is logged; --after resumes from it. Keys are stored with the state
+store component's keyPrefix and "||" (e.g. "order:||order:1001").
+
+    python migrate_codec.py --dsn "host=order-postgres-service ..." --table order_state \\
+        --prefix "order:||order:" --codec msgpack --compression zstd
+"""
+import argparse
+import base64
+import logging
+import os
+import time
+
+from fast_json import dumps, loads
+from state_codec import (
+    CODECS, COMPRESSIONS, STATE_CODEC, STATE_COMPRESSION, STATE_COMPRESSION_LEVEL, decode, encode, envelope
+)
+
+logger = logging.getLogger(__name__)
+
+# Rows read and rewritten per transaction
+MIGRATE_BATCH_SIZE = int(os.getenv("MIGRATE_BATCH_SIZE", "500"))
+# Pause between batches, to limit the load on the database
+MIGRATE_PAUSE_MS = int(os.getenv("MIGRATE_PAUSE_MS", "0"))
+
+
+def stored_bytes(text, is_binary):
+    """
+    The bytes a service wrote for a row, from its value column as JSON text
+    """
+    if is_binary:
+        return base64.b64decode(loads(text))
+    return text.encode('utf-8')
+
+
+def column_value(data):
+    """
+    (value column JSON text, isbinary) that store `data` the way Dapr does
+    """
+    if envelope(data) == ("json", "none"):
+        return data.decode('utf-8'), False
+    return dumps(base64.b64encode(data).decode('ascii')).decode('utf-8'), True
+
+
+def migrate_batch(cursor, table, rows, codec, compression, level, dry_run, totals):
+    """
+    Re-encode the rows of one batch, given as (key, value text, isbinary, xmin)
+    """
+    for key, text, is_binary, xmin in rows:
+        totals["scanned"] += 1
+        totals["bytesBefore"] += len(text)
+        try:
+            data = stored_bytes(text, is_binary)
+            if envelope(data) == (codec, compression):
+                totals["unchanged"] += 1
+                totals["bytesAfter"] += len(text)
+                continue
+            new_text, new_binary = column_value(encode(decode(data), codec, compression, level))
+        except ValueError as e:
+            logger.warning("Skipping unreadable value of %s: %s", key, e)
+            totals["unreadable"] += 1
+            totals["bytesAfter"] += len(text)
+            continue
+        if dry_run:
+            totals["rewritten"] += 1
+            totals["bytesAfter"] += len(new_text)
+            continue
+        cursor.execute(
+            f"UPDATE {table} SET value = %s::jsonb, isbinary = %s, updatedate = now() "
+            "WHERE key = %s AND xmin::text = %s",
+            (new_text, new_binary, key, xmin)
+        )
+        if cursor.rowcount:
+            totals["rewritten"] += 1
+            totals["bytesAfter"] += len(new_text)
+        else:
+            logger.debug("%s changed while being re-encoded, left as written", key)
+            totals["changed"] += 1
+            totals["bytesAfter"] += len(text)
+
+
+def migrate(conn, table, prefix="", after=None, codec=STATE_CODEC, compression=STATE_COMPRESSION,
+            level=STATE_COMPRESSION_LEVEL, batch_size=MIGRATE_BATCH_SIZE, pause_ms=MIGRATE_PAUSE_MS,
+            dry_run=False):
+    """
+    Re-encode every value of `table` whose key starts with `prefix` and sorts
+    after `after`. Returns a summary of the rows scanned, rewritten, already
+    in the target encoding, changed concurrently or unreadable, and of the
+    size of their value columns before and after.
+    """
+    totals = {
+        "scanned": 0, "rewritten": 0, "unchanged": 0, "changed": 0, "unreadable": 0,
+        "bytesBefore": 0, "bytesAfter": 0
+    }
+    start = time.perf_counter()
+    last_key = after or prefix
+    while True:
+        # Each batch is one transaction, committed when the block exits
+        with conn, conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT key, value::text, isbinary, xmin::text FROM {table} "
+                "WHERE starts_with(key, %s) AND key > %s ORDER BY key LIMIT %s",
+                (prefix, last_key, batch_size)
+            )
+            rows = cursor.fetchall()
+            migrate_batch(cursor, table, rows, codec, compression, level, dry_run, totals)
+        if rows:
+            last_key = rows[-1][0]
+            logger.info("Re-encoded %s of %s rows, up to key: %s", totals["rewritten"], totals["scanned"], last_key)
+        if len(rows) < batch_size:
+            break
+        if pause_ms:
+            time.sleep(pause_ms / 1000.0)
+
+    totals["seconds"] = round(time.perf_counter() - start, 3)
+    if not totals["scanned"]:
+        logger.warning("No rows in %s have keys starting with %r; check the prefix", table, prefix)
+    logger.info("Migration finished: %s", totals)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="connection string of the state store database")
+    parser.add_argument("--table", required=True, help="state table, e.g. order_state")
+    parser.add_argument("--prefix", default="",
+                        help="only re-encode keys starting with this, e.g. order:|| (keyPrefix and \"||\")")
+    parser.add_argument("--after", help="resume after this key, as logged by an earlier run")
+    parser.add_argument("--codec", default=STATE_CODEC, choices=sorted(CODECS))
+    parser.add_argument("--compression", default=STATE_COMPRESSION, choices=sorted(COMPRESSIONS))
+    parser.add_argument("--level", type=int, default=STATE_COMPRESSION_LEVEL)
+    parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE)
+    parser.add_argument("--pause-ms", type=int, default=MIGRATE_PAUSE_MS, help="pause between batches")
+    parser.add_argument("--dry-run", action="store_true", help="count and size the rewrites without writing")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+
+    # Only the migration needs a database driver; the service itself does not
+    import psycopg2
+    conn = psycopg2.connect(args.dsn)
+    try:
+        summary = migrate(
+            conn, args.table, prefix=args.prefix, after=args.after, codec=args.codec,
+            compression=args.compression, level=args.level, batch_size=args.batch_size,
+            pause_ms=args.pause_ms, dry_run=args.dry_run
+        )
+    finally:
+        conn.close()
+    print(dumps(summary).decode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
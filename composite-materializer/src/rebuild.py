@@ -0,0 +1,457 @@
+"""
+Rebuild every user:{userId} composite from the service state stores.
+
+Users, user-orders indexes, orders and products are read straight from the
+PostgreSQL state tables of the User, Order and Product services (Dapr has
+no API to list keys). The product catalog is loaded once; users are then
+split into chunks that worker processes build and write to drasi-state-store
+with bulk saves, together with the gzip copies, freshness stamps (with
+"source": "rebuild"), reverse index, owner map and product copies the
+materializer keeps. Every finished chunk is appended to a checkpoint file,
+so an interrupted run picks up where it stopped.
+
+Rows are stored under the keyPrefix of each service's state store component
+followed by "||" (e.g. "user:||user:123"); --user-key-prefix,
+--order-key-prefix and --product-key-prefix default to the components in
+this repo.
+
+Run it with a Dapr sidecar (for the writes) and the materializer stopped,
+since change events applied during the rebuild may be overwritten:
+    dapr run --app-id composite-rebuild -- python rebuild.py --workers 4
+"""
+import argparse
+import bisect
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+from dapr_client import dapr_client
+from fast_json import dumps, loads
+from materializer import (
+    ORDER_OWNER_KEY, PRODUCT_KEY, PRODUCT_USERS_KEY, DaprStateStore, composite_items, enrich_product,
+    freshness_item
+)
+from state_codec import decode_row
+
+logger = logging.getLogger(__name__)
+
+# Users per chunk; a chunk is built, written and checkpointed as a whole
+REBUILD_CHUNK_SIZE = int(os.getenv("REBUILD_CHUNK_SIZE", "200"))
+# Worker processes building chunks; 1 builds them in the calling process
+REBUILD_WORKERS = int(os.getenv("REBUILD_WORKERS", str(os.cpu_count() or 1)))
+# Keys written per bulk save to the composite store
+REBUILD_WRITE_BATCH_SIZE = int(os.getenv("REBUILD_WRITE_BATCH_SIZE", "100"))
+
+DAPR_STORE_NAME = "drasi-state-store"
+
+# Prefix Dapr adds to the keys of each service table: the component's keyPrefix
+# and "||" (see */components/*-state-store.yaml)
+REBUILD_USER_KEY_PREFIX = os.getenv("REBUILD_USER_KEY_PREFIX", "user:||")
+REBUILD_ORDER_KEY_PREFIX = os.getenv("REBUILD_ORDER_KEY_PREFIX", "order:||")
+REBUILD_PRODUCT_KEY_PREFIX = os.getenv("REBUILD_PRODUCT_KEY_PREFIX", "product:||")
+
+# Keys of the service stores the composites are built from
+USER_KEY = "user:"
+ORDER_KEY = "order:{}"
+INDEX_KEY = "user-orders:{}"
+SEGMENT_KEY = "user-orders:{}:{}"
+
+# Rows per page when scanning a table or reading keys
+_READ_BATCH = 1000
+
+# Set in the parent before workers are forked, so they share one copy
+_catalog = {}
+_worker = {}
+
+
+class PostgresStateTable:
+    """
+    Read-only access to the rows of a Dapr PostgreSQL state table. Keys are
+    stored with the component's key prefix ("<keyPrefix>||"), added and
+    removed here.
+    Each process opens its own connection on first use.
+    """
+
+    def __init__(self, dsn, table, key_prefix):
+        self.dsn = dsn
+        self.table = table
+        self.key_prefix = key_prefix
+        self._conn = None
+        self._pid = None
+
+    def _cursor(self):
+        if self._conn is None or self._pid != os.getpid():
+            # Only the rebuild needs a database driver; the service itself does not
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+            self._conn.set_session(readonly=True, autocommit=True)
+            self._pid = os.getpid()
+        return self._conn.cursor()
+
+    def scan(self, prefix, after=None, limit=_READ_BATCH):
+        """
+        Rows whose key starts with `prefix` and sorts after `after`, in key
+        order, as (key, value) pairs
+        """
+        full_prefix = self.key_prefix + prefix
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"SELECT key, value, isbinary FROM {self.table} "
+                "WHERE starts_with(key, %s) AND key > %s ORDER BY key LIMIT %s",
+                (full_prefix, self.key_prefix + after if after else full_prefix, limit)
+            )
+            return [
+                (key[len(self.key_prefix):], decode_row(value, is_binary))
+                for key, value, is_binary in cursor.fetchall()
+            ]
+
+    def get_many(self, keys):
+        """
+        Values of the keys that exist, as a dict
+        """
+        result = {}
+        for i in range(0, len(keys), _READ_BATCH):
+            with self._cursor() as cursor:
+                cursor.execute(
+                    f"SELECT key, value, isbinary FROM {self.table} WHERE key = ANY(%s)",
+                    ([self.key_prefix + key for key in keys[i:i + _READ_BATCH]],)
+                )
+                for key, value, is_binary in cursor.fetchall():
+                    result[key[len(self.key_prefix):]] = decode_row(value, is_binary)
+        return result
+
+
+class InMemoryTable:
+    """
+    Dict-backed stand-in for PostgresStateTable, for running without a
+    database. `rows` are keyed as stored in the table, with the key prefix.
+    """
+
+    def __init__(self, rows, key_prefix=""):
+        self.rows = rows
+        self.key_prefix = key_prefix
+        self._keys = sorted(rows)
+
+    def scan(self, prefix, after=None, limit=_READ_BATCH):
+        full_prefix = self.key_prefix + prefix
+        if after:
+            start = bisect.bisect_right(self._keys, self.key_prefix + after)
+        else:
+            start = bisect.bisect_left(self._keys, full_prefix)
+        page = []
+        for key in self._keys[start:start + limit]:
+            if not key.startswith(full_prefix):
+                break
+            page.append((key[len(self.key_prefix):], self.rows[key]))
+        return page
+
+    def get_many(self, keys):
+        return {
+            key: self.rows[self.key_prefix + key] for key in keys if self.key_prefix + key in self.rows
+        }
+
+
+def iter_rows(table, prefix):
+    after = None
+    while True:
+        page = table.scan(prefix, after)
+        yield from page
+        if len(page) < _READ_BATCH:
+            return
+        after = page[-1][0]
+
+
+class Checkpoint:
+    """
+    Append-only JSON lines file with one line per finished chunk and a final
+    line once the rebuild is complete. A line cut short by a crash is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []
+        self.done = False
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        logger.warning("Ignoring incomplete checkpoint line in %s", path)
+                        continue
+                    if entry.get("done"):
+                        self.done = True
+                    else:
+                        self.chunks.append(entry)
+        self._ranges = sorted((chunk["first"], chunk["last"]) for chunk in self.chunks)
+
+    def covers(self, user_key):
+        """
+        Whether a finished chunk already contains this user
+        """
+        i = bisect.bisect_right(self._ranges, (user_key, "\uffff")) - 1
+        return i >= 0 and self._ranges[i][0] <= user_key <= self._ranges[i][1]
+
+    def _append(self, entry):
+        if not self.path:
+            return
+        with open(self.path, "ab") as f:
+            f.write(dumps(entry) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, chunk):
+        self.chunks.append(chunk)
+        self._append(chunk)
+
+    def finish(self, summary):
+        self.done = True
+        self._append(dict(summary, done=True))
+
+
+def iter_chunks(users, checkpoint, chunk_size):
+    """
+    Split the users that no finished chunk covers into lists of
+    (user key, user) pairs in key order
+    """
+    chunk = []
+    for key, user in iter_rows(users, USER_KEY):
+        if checkpoint.covers(key):
+            continue
+        chunk.append((key, user))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_catalog(products):
+    """
+    Read every product into memory, keyed by product ID
+    """
+    return {key.partition(":")[2]: product for key, product in iter_rows(products, PRODUCT_KEY.format(""))}
+
+
+def _order_ids(orders, users):
+    # Resolve each user's order IDs from their index head and sealed segments,
+    # in insertion order like GET /orders?userId
+    heads = orders.get_many([INDEX_KEY.format(user_id) for user_id in users])
+    segment_keys = []
+    for user_id in users:
+        head = heads.get(INDEX_KEY.format(user_id))
+        if isinstance(head, dict):
+            segment_keys.extend(SEGMENT_KEY.format(user_id, i) for i in range(head["sealed"]))
+    segments = orders.get_many(segment_keys) if segment_keys else {}
+
+    order_ids = {}
+    for user_id in users:
+        head = heads.get(INDEX_KEY.format(user_id))
+        if head is None:
+            order_ids[user_id] = []
+        elif isinstance(head, list):
+            # Flat index written before segmentation
+            order_ids[user_id] = head
+        else:
+            ids = []
+            for i in range(head["sealed"]):
+                ids.extend(segments.get(SEGMENT_KEY.format(user_id, i), []))
+            order_ids[user_id] = ids + head["tail"]
+    return order_ids
+
+
+def build_composites(orders, users, catalog):
+    """
+    Build the composites of a chunk of users. Returns (composites, owners,
+    product_users): composite per user ID, owning user per order ID and the
+    user IDs per product ID, as the materializer would have stored them.
+    """
+    users = {key.partition(":")[2]: user for key, user in users}
+    order_ids = _order_ids(orders, users)
+    order_docs = orders.get_many([ORDER_KEY.format(order_id) for ids in order_ids.values() for order_id in ids])
+
+    composites = {}
+    owners = {}
+    product_users = {}
+    for user_id, user in users.items():
+        enriched_orders = []
+        for order_id in order_ids[user_id]:
+            order = order_docs.get(ORDER_KEY.format(order_id))
+            if order is None:
+                # Indexed but deleted since; the composite never lists it
+                continue
+            items = [item for item in order.get("products", []) if item.get("productId")]
+            enriched_orders.append({
+                "orderId": order.get("orderId", order_id),
+                "orderDate": order.get("orderDate"),
+                "totalAmount": order.get("totalAmount"),
+                "products": [enrich_product(item, catalog.get(item["productId"])) for item in items]
+            })
+            owners[order_id] = user_id
+            for item in items:
+                users_of_product = product_users.setdefault(item["productId"], [])
+                if not users_of_product or users_of_product[-1] != user_id:
+                    users_of_product.append(user_id)
+        composites[user_id] = {
+            "userId": user_id,
+            "name": user.get("name"),
+            "email": user.get("email"),
+            "orders": enriched_orders
+        }
+    return composites, owners, product_users
+
+
+def write_batched(store, items, batch_size=None):
+    batch_size = batch_size or REBUILD_WRITE_BATCH_SIZE
+    for i in range(0, len(items), batch_size):
+        store.save_many(items[i:i + batch_size])
+
+
+def rebuild_chunk(users):
+    """
+    Build and write one chunk of users. Runs in a worker process.
+    """
+    orders, store = _worker["orders"], _worker["store"]
+    composites, owners, product_users = build_composites(orders, users, _catalog)
+    # Every composite is stamped, so no stamp of an earlier composite survives it
+    write_batched(store, [
+        item
+        for user_id, composite in composites.items()
+        for item in composite_items(user_id, composite) + [freshness_item(user_id, "rebuild")]
+    ])
+    write_batched(store, [(ORDER_OWNER_KEY.format(order_id), user_id) for order_id, user_id in owners.items()])
+    return {
+        "first": users[0][0],
+        "last": users[-1][0],
+        "users": len(composites),
+        "orders": len(owners),
+        "productUsers": product_users
+    }
+
+
+def _init_worker(orders, store):
+    _worker["orders"] = orders
+    _worker["store"] = store
+
+
+def rebuild(users, orders, products, store, checkpoint, workers=None, chunk_size=None):
+    """
+    Rebuild all composites into `store` (anything with save_many, e.g.
+    DaprStateStore), skipping users covered by `checkpoint`. Returns a
+    summary with counts and rows read per second.
+    """
+    global _catalog
+    workers = workers or REBUILD_WORKERS
+    chunk_size = chunk_size or REBUILD_CHUNK_SIZE
+    start = time.perf_counter()
+    if checkpoint.done:
+        logger.info("Checkpoint %s records a finished rebuild; nothing to do", checkpoint.path)
+        return {"users": 0, "orders": 0, "products": 0, "rows": 0, "seconds": 0.0, "rowsPerSecond": 0.0}
+    if checkpoint.chunks:
+        logger.info("Resuming after %s finished chunks", len(checkpoint.chunks))
+
+    _catalog = load_catalog(products)
+    logger.info("Loaded %s products in %.1fs", len(_catalog), time.perf_counter() - start)
+
+    totals = {"users": 0, "orders": 0}
+    last_report = [time.perf_counter()]
+
+    def finished(chunk):
+        checkpoint.record(chunk)
+        totals["users"] += chunk["users"]
+        totals["orders"] += chunk["orders"]
+        now = time.perf_counter()
+        if now - last_report[0] >= 5:
+            last_report[0] = now
+            rows = totals["users"] + totals["orders"]
+            logger.info("Rebuilt %s users with %s orders, %.0f rows/s",
+                        totals["users"], totals["orders"], rows / (now - start))
+
+    chunks = iter_chunks(users, checkpoint, chunk_size)
+    if workers <= 1:
+        _init_worker(orders, store)
+        for chunk in chunks:
+            finished(rebuild_chunk(chunk))
+    else:
+        # Workers are forked after the catalog is loaded and inherit it. At most
+        # two chunks per worker are in flight, so users are not all read up front.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork"),
+                                 initializer=_init_worker, initargs=(orders, store)) as executor:
+            pending = set()
+            for chunk in chunks:
+                pending.add(executor.submit(rebuild_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finished(future.result())
+            for future in pending:
+                finished(future.result())
+
+    # The reverse index spans every chunk, including those of earlier runs
+    product_users = {}
+    for chunk in checkpoint.chunks:
+        for product_id, user_ids in chunk["productUsers"].items():
+            product_users.setdefault(product_id, []).extend(user_ids)
+    write_batched(store, [(PRODUCT_KEY.format(product_id), product) for product_id, product in _catalog.items()])
+    write_batched(store, [
+        (PRODUCT_USERS_KEY.format(product_id), user_ids) for product_id, user_ids in product_users.items()
+    ])
+
+    elapsed = time.perf_counter() - start
+    rows = totals["users"] + totals["orders"] + len(_catalog)
+    summary = {
+        "users": totals["users"],
+        "orders": totals["orders"],
+        "products": len(_catalog),
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rowsPerSecond": round(rows / elapsed, 1) if elapsed else 0.0
+    }
+    if not checkpoint.chunks:
+        # Most likely a key prefix that does not match the tables; leave the
+        # checkpoint open so that a rerun with the right prefix is not skipped
+        logger.error("No users found in the user table; check the key prefixes. Nothing was rebuilt.")
+        return summary
+    checkpoint.finish(summary)
+    logger.info("Rebuild finished: %s", summary)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-dsn", default=os.getenv(
+        "REBUILD_USER_DSN", "host=user-postgres-service user=postgres password=postgres port=5432 dbname=userdb"))
+    parser.add_argument("--order-dsn", default=os.getenv(
+        "REBUILD_ORDER_DSN", "host=order-postgres-service user=postgres password=postgres port=5432 dbname=orderdb"))
+    parser.add_argument("--product-dsn", default=os.getenv(
+        "REBUILD_PRODUCT_DSN",
+        "host=product-postgres-service user=postgres password=postgres port=5432 dbname=productdb"))
+    parser.add_argument("--user-key-prefix", default=REBUILD_USER_KEY_PREFIX)
+    parser.add_argument("--order-key-prefix", default=REBUILD_ORDER_KEY_PREFIX)
+    parser.add_argument("--product-key-prefix", default=REBUILD_PRODUCT_KEY_PREFIX)
+    parser.add_argument("--workers", type=int, default=REBUILD_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=REBUILD_CHUNK_SIZE)
+    parser.add_argument("--checkpoint", default=os.getenv("REBUILD_CHECKPOINT", "rebuild-checkpoint.jsonl"),
+                        help="file recording finished chunks")
+    parser.add_argument("--restart", action="store_true", help="ignore and replace an existing checkpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    summary = rebuild(
+        users=PostgresStateTable(args.user_dsn, "user_state", args.user_key_prefix),
+        orders=PostgresStateTable(args.order_dsn, "order_state", args.order_key_prefix),
+        products=PostgresStateTable(args.product_dsn, "product_state", args.product_key_prefix),
+        store=DaprStateStore(dapr_client, DAPR_STORE_NAME),
+        checkpoint=Checkpoint(args.checkpoint),
+        workers=args.workers,
+        chunk_size=args.chunk_size
+    )
+    print(dumps(summary).decode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
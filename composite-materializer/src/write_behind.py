@@ -0,0 +1,267 @@
+import copy
+import os
+import time
+import logging
+import threading
+
+from materializer import observe_freshness_lag
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+# How long a write may wait to be coalesced with later writes to the same key
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "200"))
+# Maximum number of keys written per bulk save; the keys of one user are never split
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))
+# Writers block once this many users' composites are waiting to be flushed
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+_DELETED = object()
+
+
+class WriteBehindStore:
+    """
+    Buffers writes to keys with one of `prefixes` and flushes them to `backing`
+    in bulk from a background thread. Other keys are written through.
+
+    Keys that differ only in their prefix (a user's composite, gzip copy and
+    freshness stamp) are buffered as one entry and always flushed in the same
+    bulk save, so a stamp is never stored without its composite. Writes to a
+    key that is still waiting to be flushed replace the pending value, so a
+    key rewritten many times within one flush interval costs a single write.
+    Reads see pending writes. Once `max_pending` entries are waiting, writers
+    block until the flusher catches up. Freshness lags of buffered keys are
+    recorded when the flush that stores them succeeds. Once closed, every
+    write goes through to `backing`.
+    """
+
+    def __init__(self, backing, prefixes=("user:", "user-gzip:", "freshness:"), flush_interval_ms=None,
+                 batch_size=None, max_pending=None):
+        self.backing = backing
+        self.prefixes = tuple(prefixes)
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None
+                               else WRITE_BEHIND_FLUSH_INTERVAL_MS) / 1000.0
+        self.batch_size = batch_size or WRITE_BEHIND_BATCH_SIZE
+        self.max_pending = max_pending or WRITE_BEHIND_MAX_PENDING
+
+        self._cond = threading.Condition()
+        # {entry: {key: value}}, the entry being a key without its prefix
+        self._pending = {}
+        self._flushing = {}
+        # Source writes (entity, time) each pending or flushing key reflects, for the freshness lag
+        self._lags = {}
+        self._flushing_lags = {}
+        self._closed = False
+
+        self.saves = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.backpressure_waits = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="write-behind-flusher", daemon=True)
+        self._thread.start()
+
+    def _entry(self, key):
+        # The entry a key is buffered in, or None if it is written through
+        for prefix in self.prefixes:
+            if key.startswith(prefix):
+                return key[len(prefix):]
+        return None
+
+    def get(self, key):
+        entry = self._entry(key)
+        if entry is not None:
+            with self._cond:
+                for buffer in (self._pending, self._flushing):
+                    values = buffer.get(entry, {})
+                    if key in values:
+                        value = values[key]
+                        return None if value is _DELETED else copy.deepcopy(value)
+        return self.backing.get(key)
+
+    def save(self, key, value):
+        self.save_many([(key, value)])
+
+    def save_many(self, items):
+        buffered = []
+        written_through = []
+        for key, value in items:
+            entry = self._entry(key)
+            if entry is None:
+                written_through.append((key, value))
+            else:
+                buffered.append((entry, key, copy.deepcopy(value)))
+        # Buffered together, so the flusher cannot take some of them without the others
+        if buffered and not self._enqueue(buffered):
+            written_through.extend((key, value) for _, key, value in buffered)
+        if len(written_through) == 1:
+            self.backing.save(*written_through[0])
+        elif written_through:
+            self.backing.save_many(written_through)
+
+    def delete(self, key):
+        entry = self._entry(key)
+        if entry is None or not self._enqueue([(entry, key, _DELETED)]):
+            self.backing.delete(key)
+
+    def observe_lag(self, key, entity, written_at):
+        entry = self._entry(key)
+        if entry is None:
+            self.backing.observe_lag(key, entity, written_at)
+            return
+        with self._cond:
+            if key in self._pending.get(entry, {}):
+                self._lags.setdefault(key, []).append((entity, written_at))
+                return
+            if key in self._flushing.get(entry, {}):
+                self._flushing_lags.setdefault(key, []).append((entity, written_at))
+                return
+        # Already flushed by the time the caller got here
+        observe_freshness_lag(entity, time.time() - written_at)
+
+    def _enqueue(self, writes):
+        """
+        Buffer (entry, key, value) writes, or return False once closed so the
+        caller writes them through
+        """
+        with self._cond:
+            while (len(self._pending) >= self.max_pending and not self._closed
+                   and any(entry not in self._pending for entry, _, _ in writes)):
+                self.backpressure_waits += 1
+                self._cond.notify_all()
+                self._cond.wait()
+            if self._closed:
+                return False
+            was_empty = not self._pending
+            for entry, key, value in writes:
+                values = self._pending.setdefault(entry, {})
+                self.saves += 1
+                if key in values:
+                    self.coalesced += 1
+                values[key] = value
+            # Wake the flusher to start a coalescing window on the first pending write
+            if was_empty:
+                self._cond.notify_all()
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Give writes one interval to coalesce; writers blocked on a full
+                # queue wake the flusher early
+                if len(self._pending) < self.max_pending:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+    @timed("write_behind_flush")
+    def flush(self):
+        """
+        Write everything pending to the backing store
+        """
+        with self._cond:
+            if not self._pending or self._flushing:
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._flushing_lags, self._lags = self._lags, {}
+            self._cond.notify_all()
+
+        start = time.perf_counter()
+        written = sum(len(values) for values in self._flushing.values())
+        failed = {}
+        for batch in self._batches():
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error("Error flushing %s composites: %s", len(batch), e)
+                failed.update(batch)
+        failed_keys = {key for values in failed.values() for key in values}
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._cond:
+            lags, self._flushing_lags = self._flushing_lags, {}
+            # Retry failed writes on the next flush unless they were superseded meanwhile;
+            # either way the next write of the key reflects their source writes
+            for entry, values in failed.items():
+                pending = self._pending.setdefault(entry, {})
+                for key, value in values.items():
+                    pending.setdefault(key, value)
+                    if key in lags:
+                        self._lags.setdefault(key, []).extend(lags[key])
+            self.written += written - len(failed_keys)
+            self.flushes += 1
+            self.flush_errors += 1 if failed else 0
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            self._flushing = {}
+            self._cond.notify_all()
+        now = time.time()
+        for key, observed in lags.items():
+            if key not in failed_keys:
+                for entity, written_at in observed:
+                    observe_freshness_lag(entity, now - written_at)
+        logger.debug("Flushed %s composite writes in %.1fms", written - len(failed_keys), elapsed_ms)
+
+    def _batches(self):
+        # Entries being flushed, in lists of up to batch_size keys; an entry
+        # is never split, so one with more keys gets a batch of its own
+        batch, size = [], 0
+        for entry, values in self._flushing.items():
+            if batch and size + len(values) > self.batch_size:
+                yield batch
+                batch, size = [], 0
+            batch.append((entry, values))
+            size += len(values)
+        if batch:
+            yield batch
+
+    def _write_batch(self, batch):
+        writes = [(key, value) for _, values in batch for key, value in values.items()]
+        saves = [(key, value) for key, value in writes if value is not _DELETED]
+        if saves:
+            self.backing.save_many(saves)
+        for key, value in writes:
+            if value is _DELETED:
+                self.backing.delete(key)
+
+    def close(self):
+        """
+        Flush pending writes and stop the background thread. Writes the final
+        flush could not store are logged by key; later writes go through.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+        with self._cond:
+            lost = sorted(key for values in self._pending.values() for key in values)
+        if lost:
+            logger.error("Dropped %s composite writes that could not be flushed on close: %s", len(lost), lost)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queueDepth": len(self._pending),
+                "inFlight": len(self._flushing),
+                "saves": self.saves,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "coalescingRatio": self.saves / self.written if self.written else 0.0,
+                "flushes": self.flushes,
+                "flushErrors": self.flush_errors,
+                "backpressureWaits": self.backpressure_waits,
+                "lastFlushMs": self.last_flush_ms,
+                "maxFlushMs": self.max_flush_ms,
+                "avgFlushMs": self.total_flush_ms / self.flushes if self.flushes else 0.0
+            }
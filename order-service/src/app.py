@@ -1,25 +1,51 @@
-import json
 import os
 import logging
-import sys
 from flask import Flask, request, jsonify
-from dapr.clients import DaprClient
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+from dapr_client import dapr_client, init_client
+from bulk_ingest import ingest, iter_records
+from compression import compressible
+from fast_json import conditional_json_response, dumps, join_array, join_object, raw_json_response
+from metrics import install_metrics, stage
+from single_flight import SingleFlight
+from state_codec import decode, encode, to_json
+from logging_setup import configure_logging, install_correlation_ids, payload
+from order_store import (
+    get_orders, insert_order, insert_orders, read_index, migrate_index,
+    OrderAlreadyExists, IndexConflict, InvalidCursor
 )
+
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
 
 # Dapr configuration
 DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
 DAPR_STORE_NAME = "order-state-store"
-logger.info(f"Using Dapr HTTP port: {DAPR_HTTP_PORT}")
-logger.info(f"Using Dapr store name: {DAPR_STORE_NAME}")
+# Cache-Control of GET /orders/<id>
+ORDER_CACHE_CONTROL = os.getenv("ORDER_CACHE_CONTROL", "private, no-cache")
+ORDERS_PAGE_MAX_LIMIT = int(os.getenv("ORDERS_PAGE_MAX_LIMIT", "500"))
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+logger.info("Using Dapr store name: %s", DAPR_STORE_NAME)
+
+# Concurrent requests for the same page of a user's orders share one read
+order_list_flights = SingleFlight("orders-by-user")
+
+def read_orders_page(client, user_id, cursor, limit):
+    """
+    Read one page of a user's orders as stored JSON; returns (orders, next_cursor)
+    """
+    # Get the order IDs for this user, reading only the index segments needed
+    logger.debug("Getting order IDs for user: %s", user_id)
+    order_ids, next_cursor = read_index(client, DAPR_STORE_NAME, user_id, cursor=cursor, limit=limit)
+    logger.info("Found %s order IDs", len(order_ids))
+    
+    # Get the order details for all IDs with chunked bulk reads, kept as
+    # the stored JSON and spliced into the response without decoding
+    return get_orders(client, DAPR_STORE_NAME, order_ids, raw=True), next_cursor
 
 @app.route('/orders/<order_id>', methods=['GET'])
 def get_order(order_id):
@@ -27,79 +53,106 @@ def get_order(order_id):
     Retrieve an order by orderId
     Example: GET /orders/1001
     """
-    logger.info(f"GET /orders/{order_id} request")
+    logger.info("GET /orders/%s request", order_id)
     order_key = f"order:{order_id}"
-    logger.debug(f"Looking up order with key: {order_key}")
+    logger.debug("Looking up order with key: %s", order_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            logger.debug(f"Getting state for key: {order_key}")
+            logger.debug("Getting state for key: %s", order_key)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=order_key)
             if not resp.data:
-                logger.warning(f"Order not found: {order_id}")
+                logger.warning("Order not found: %s", order_id)
                 return jsonify({"error": "Order not found"}), 404
             
-            order_data = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Order data retrieved: {order_data}")
-            logger.info(f"Successfully retrieved order: {order_id}")
-            return jsonify(order_data), 200
+            # A document stored as JSON is sent as is
+            logger.debug("Order data retrieved: %s", payload(resp.data))
+            logger.info("Successfully retrieved order: %s", order_id)
+            return conditional_json_response(to_json(resp.data), ORDER_CACHE_CONTROL)
         
         except Exception as e:
-            logger.error(f"Error in get_order: {str(e)}", exc_info=True)
+            logger.error("Error in get_order: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/orders', methods=['GET'])
+@compressible
 def get_orders_by_user():
     """
     Retrieve all orders for a specific userId
     Example: GET /orders?userId=123
+    
+    With `limit` (and `cursor` from a previous page) only one page is read:
+    Example: GET /orders?userId=123&limit=50&cursor=50
+    Example response:
+    {
+      "orders": [ ... ],
+      "nextCursor": "100"
+    }
+    
+    Responses are compressed according to Accept-Encoding.
     """
     user_id = request.args.get('userId')
-    logger.info(f"GET /orders request with userId: {user_id}")
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    logger.info("GET /orders request with userId: %s", user_id)
     
     if not user_id:
         logger.warning("Missing required parameter: userId")
         return jsonify({"error": "userId parameter is required"}), 400
     
-    # Create an index key for user orders
-    index_key = f"user-orders:{user_id}"
-    logger.debug(f"Looking up orders with index key: {index_key}")
+    paginated = limit is not None or cursor is not None
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            logger.warning("Invalid limit parameter: %s", limit)
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        limit = min(int(limit), ORDERS_PAGE_MAX_LIMIT)
+    elif paginated:
+        limit = ORDERS_PAGE_MAX_LIMIT
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            # Get the list of order IDs for this user
-            logger.debug(f"Getting order IDs from index key: {index_key}")
-            resp = client.get_state(store_name=DAPR_STORE_NAME, key=index_key)
+            orders, next_cursor = order_list_flights.do(
+                (user_id, cursor, limit), lambda: read_orders_page(client, user_id, cursor, limit)
+            )
             
-            if not resp.data:
-                logger.info(f"No orders found for user: {user_id}")
-                return jsonify([]), 200
-            
-            order_ids = json.loads(resp.data.decode('utf-8'))
-            logger.info(f"Found {len(order_ids)} order IDs: {order_ids}")
-            
-            # Get the order details for each ID
-            orders = []
-            for order_id in order_ids:
-                order_key = f"order:{order_id}"
-                logger.debug(f"Getting order details for key: {order_key}")
-                
-                try:
-                    single_resp = client.get_state(store_name=DAPR_STORE_NAME, key=order_key)
-                    if single_resp.data:
-                        order_data = json.loads(single_resp.data.decode('utf-8'))
-                        logger.debug(f"Order data retrieved: {order_data}")
-                        orders.append(order_data)
-                    else:
-                        logger.warning(f"No data found for order ID: {order_id}")
-                except Exception as inner_e:
-                    logger.error(f"Error retrieving order {order_id}: {str(inner_e)}")
-            
-            logger.info(f"Returning {len(orders)} orders")
-            return jsonify(orders), 200
+            logger.info("Returning %s orders", len(orders))
+            with stage("serialize"):
+                body = join_array(orders)
+                if paginated:
+                    body = join_object([("orders", body), ("nextCursor", dumps(next_cursor))])
+                return raw_json_response(body), 200
         
+        except InvalidCursor:
+            logger.warning("Invalid cursor parameter: %s", cursor)
+            return jsonify({"error": "Invalid cursor"}), 400
         except Exception as e:
-            logger.error(f"Error in get_orders_by_user: {str(e)}", exc_info=True)
+            logger.error("Error in get_orders_by_user: %s", e, exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route('/orders:migrateIndex', methods=['POST'])
+def migrate_user_indexes():
+    """
+    Convert flat user-orders indexes into segmented ones ahead of their next write
+    Example request body:
+    {
+      "userIds": ["123", "456"]
+    }
+    """
+    request_data = request.json or {}
+    user_ids = request_data.get("userIds")
+    if not isinstance(user_ids, list):
+        logger.warning("Missing required field in request: userIds")
+        return jsonify({"error": "Missing required field: userIds"}), 400
+    logger.info("POST /orders:migrateIndex request for %s users", len(user_ids))
+    
+    with dapr_client() as client:
+        try:
+            migrated = [user_id for user_id in user_ids if migrate_index(client, DAPR_STORE_NAME, user_id)]
+            logger.info("Migrated %s user-orders indexes", len(migrated))
+            return jsonify({"migrated": migrated}), 200
+        
+        except Exception as e:
+            logger.error("Error in migrate_user_indexes: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/orders', methods=['POST'])
@@ -119,61 +172,71 @@ def create_order():
     }
     """
     order_data = request.json
-    logger.info(f"POST /orders request with data: {order_data}")
+    logger.info("POST /orders request with data: %s", payload(order_data))
     
     # Validate required fields
     required_fields = ["orderId", "userId", "orderDate", "totalAmount", "products"]
     for field in required_fields:
         if field not in order_data:
-            logger.warning(f"Missing required field in request: {field}")
+            logger.warning("Missing required field in request: %s", field)
             return jsonify({"error": f"Missing required field: {field}"}), 400
     
     order_id = order_data["orderId"]
     user_id = order_data["userId"]
     order_key = f"order:{order_id}"
-    logger.debug(f"Order key: {order_key}")
+    logger.debug("Order key: %s", order_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            # Check if order already exists
-            logger.debug(f"Checking if order already exists: {order_id}")
-            resp = client.get_state(store_name=DAPR_STORE_NAME, key=order_key)
-            if resp.data:
-                logger.warning(f"Order already exists: {order_id}")
-                return jsonify({"error": "Order already exists"}), 409
-            
-            # Store the order data
-            logger.debug(f"Saving order data for key: {order_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=order_key, value=json.dumps(order_data))
-            logger.debug(f"Order data saved successfully")
-            
-            # Update the user-orders index
-            index_key = f"user-orders:{user_id}"
-            logger.debug(f"Updating user-orders index for key: {index_key}")
-            
-            # Get existing index
-            index_resp = client.get_state(store_name=DAPR_STORE_NAME, key=index_key)
-            if index_resp.data:
-                order_ids = json.loads(index_resp.data.decode('utf-8'))
-                logger.debug(f"Existing order IDs in index: {order_ids}")
-                if order_id not in order_ids:
-                    order_ids.append(order_id)
-                    logger.debug(f"Added order ID to index: {order_id}")
-                else:
-                    logger.debug(f"Order ID already exists in index: {order_id}")
-            else:
-                order_ids = [order_id]
-                logger.debug(f"Created new index with order ID: {order_id}")
-            
-            # Save the updated index
-            client.save_state(store_name=DAPR_STORE_NAME, key=index_key, value=json.dumps(order_ids))
-            logger.debug(f"Index saved successfully")
+            # Save the order and update the user-orders index in one transaction
+            logger.debug("Creating order %s for user: %s", order_id, user_id)
+            insert_order(client, DAPR_STORE_NAME, order_data)
             
-            logger.info(f"Order created successfully: {order_id}")
+            logger.info("Order created successfully: %s", order_id)
             return jsonify(order_data), 201
         
+        except OrderAlreadyExists:
+            logger.warning("Order already exists: %s", order_id)
+            return jsonify({"error": "Order already exists"}), 409
+        except IndexConflict as e:
+            logger.warning("Order index contention for user %s: %s", user_id, e)
+            return jsonify({"error": str(e)}), 409
+        except Exception as e:
+            logger.error("Error in create_order: %s", e, exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route('/orders:bulk', methods=['POST'])
+def bulk_create_orders():
+    """
+    Create many orders in one request, from a JSON array or, with
+    `Content-Type: application/x-ndjson`, one order per line. Records are
+    validated as the body is read and written in batches of
+    BULK_INGEST_BATCH_SIZE, each in one transaction that also updates every
+    user-orders index of the batch once; existing orders are left unchanged.
+    Example request body (NDJSON):
+    { "orderId": "1001", "userId": "123", "orderDate": "2023-10-01", "totalAmount": 150.00, "products": [ { "productId": "p1", "quantity": 2 } ] }
+    { "userId": "123" }
+    Example response (`?results=all` also lists the created records):
+    {
+      "created": 1, "exists": 0, "invalid": 1, "failed": 0,
+      "results": [ { "index": 1, "id": null, "status": "invalid", "error": "Missing required field: orderId" } ]
+    }
+    """
+    logger.info("POST /orders:bulk request")
+    
+    with dapr_client() as client:
+        try:
+            result = ingest(
+                iter_records(request),
+                ["orderId", "userId", "orderDate", "totalAmount", "products"],
+                "orderId",
+                lambda orders: insert_orders(client, DAPR_STORE_NAME, orders),
+                include_created=request.args.get("results") == "all"
+            )
+            return jsonify(result), 200
+        
         except Exception as e:
-            logger.error(f"Error in create_order: {str(e)}", exc_info=True)
+            logger.error("Error in bulk_create_orders: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/orders/<order_id>', methods=['PUT'])
@@ -190,40 +253,40 @@ def update_order(order_id):
       ]
     }
     """
-    logger.info(f"PUT /orders/{order_id} request")
+    logger.info("PUT /orders/%s request", order_id)
     update_data = request.json
-    logger.debug(f"Update data: {update_data}")
+    logger.debug("Update data: %s", payload(update_data))
     
     order_key = f"order:{order_id}"
-    logger.debug(f"Order key: {order_key}")
+    logger.debug("Order key: %s", order_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
             # Check if order exists
-            logger.debug(f"Checking if order exists: {order_id}")
+            logger.debug("Checking if order exists: %s", order_id)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=order_key)
             if not resp.data:
-                logger.warning(f"Order not found for update: {order_id}")
+                logger.warning("Order not found for update: %s", order_id)
                 return jsonify({"error": "Order not found"}), 404
             
             # Get existing order data
-            existing_order = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Existing order data: {existing_order}")
+            existing_order = decode(resp.data)
+            logger.debug("Existing order data: %s", payload(existing_order))
             
             # Update order data
             for key, value in update_data.items():
                 existing_order[key] = value
             
             # Store the updated order data
-            logger.debug(f"Saving updated order data for key: {order_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=order_key, value=json.dumps(existing_order))
-            logger.debug(f"Order data updated successfully")
+            logger.debug("Saving updated order data for key: %s", order_key)
+            client.save_state(store_name=DAPR_STORE_NAME, key=order_key, value=encode(existing_order))
+            logger.debug("Order data updated successfully")
             
-            logger.info(f"Order updated successfully: {order_id}")
+            logger.info("Order updated successfully: %s", order_id)
             return jsonify(existing_order), 200
         
         except Exception as e:
-            logger.error(f"Error in update_order: {str(e)}", exc_info=True)
+            logger.error("Error in update_order: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -242,5 +305,6 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting Order Service application")
-    logger.info(f"Server running on 0.0.0.0:5000")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,119 @@
+import os
+import gzip
+import logging
+import functools
+
+from flask import make_response, request
+
+from metrics import stage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Set to "false" to always send responses uncompressed
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# Content codings offered, most preferred first. zstd and br are skipped unless
+# the zstandard and brotli packages are installed.
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if encoding.strip()
+]
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Compression levels: gzip 1-9, zstd 1-22, brotli 0-11
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+
+_COMPRESSORS = {
+    # mtime=0 keeps the output, and so the ETag of a compressed document, stable
+    "gzip": lambda data: gzip.compress(data, COMPRESSION_GZIP_LEVEL, mtime=0)
+}
+if zstandard is not None:
+    # ZstdCompressor objects are not thread-safe; creating one per response is cheap
+    _COMPRESSORS["zstd"] = lambda data: zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(data)
+if brotli is not None:
+    _COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=COMPRESSION_BROTLI_LEVEL)
+
+AVAILABLE_ENCODINGS = [encoding for encoding in COMPRESSION_ENCODINGS if encoding in _COMPRESSORS]
+for _encoding in COMPRESSION_ENCODINGS:
+    if _encoding not in _COMPRESSORS:
+        logger.warning("Compression %s is not available and will not be offered", _encoding)
+
+
+def accepts(encoding):
+    """
+    Whether compression is enabled and the client's Accept-Encoding allows `encoding`
+    """
+    return COMPRESSION_ENABLED and request.accept_encodings[encoding] > 0
+
+
+def negotiate():
+    """
+    The available content coding the client prefers, or None to send the
+    response uncompressed
+    """
+    if not COMPRESSION_ENABLED or not AVAILABLE_ENCODINGS:
+        return None
+    return request.accept_encodings.best_match(AVAILABLE_ENCODINGS)
+
+
+def compress(data, encoding):
+    return _COMPRESSORS[encoding](data)
+
+
+def compress_response(response):
+    """
+    Compress a complete 200 response with the negotiated content coding once
+    it reaches COMPRESSION_MIN_BYTES. Streamed responses and responses that
+    already have a Content-Encoding are left as they are.
+
+    The ETag of a compressed response gets a "-<coding>" suffix, as each
+    coding is a different representation, and a matching If-None-Match is
+    answered with 304 before anything is compressed.
+    """
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+
+    etag, weak = response.get_etag()
+    if etag:
+        etag = f"{etag}-{encoding}"
+        response.set_etag(etag, weak)
+        if request.if_none_match.contains(etag):
+            # Entity headers are dropped from 304 responses when they are sent
+            response.status_code = 304
+            response.set_data(b"")
+            return response
+
+    with stage("compress"):
+        body = compress(data, encoding)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    logger.debug("Compressed response from %s to %s bytes with %s", len(data), len(body), encoding)
+    return response
+
+
+def compressible(view):
+    """
+    Decorator that compresses a route's responses according to the
+    request's Accept-Encoding (see compress_response)
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        return compress_response(make_response(view(*args, **kwargs)))
+    return wrapper
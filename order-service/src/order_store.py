@@ -0,0 +1,461 @@
+import os
+import time
+import zlib
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dapr.clients.grpc._request import TransactionalStateOperation
+from dapr.clients.grpc._state import StateItem, StateOptions, Concurrency
+
+from metrics import timed
+from state_codec import decode, encode, to_json
+
+logger = logging.getLogger(__name__)
+
+# Number of order keys requested per get_bulk_state call
+ORDER_BULK_CHUNK_SIZE = int(os.getenv("ORDER_BULK_CHUNK_SIZE", "100"))
+# Number of bulk reads issued concurrently for a single request
+ORDER_BULK_CONCURRENCY = int(os.getenv("ORDER_BULK_CONCURRENCY", "4"))
+# Parallelism the sidecar uses to resolve the keys of one bulk read
+BULK_STATE_PARALLELISM = int(os.getenv("BULK_STATE_PARALLELISM", "10"))
+# Attempts at committing a new order before giving up on a contended user-orders index
+ORDER_INDEX_MAX_RETRIES = int(os.getenv("ORDER_INDEX_MAX_RETRIES", "16"))
+# Base delay between attempts; doubled after every conflict up to the cap and jittered
+ORDER_INDEX_RETRY_BACKOFF_MS = int(os.getenv("ORDER_INDEX_RETRY_BACKOFF_MS", "2"))
+ORDER_INDEX_RETRY_BACKOFF_MAX_MS = int(os.getenv("ORDER_INDEX_RETRY_BACKOFF_MAX_MS", "50"))
+# Order IDs per sealed segment of a new (or migrated) user-orders index
+ORDER_INDEX_SEGMENT_SIZE = int(os.getenv("ORDER_INDEX_SEGMENT_SIZE", "100"))
+
+# Number of order-claims keys; a create writes its order ID's claim key with the
+# key's ETag, so that two creates of the same ID conflict
+ORDER_CLAIM_STRIPES = int(os.getenv("ORDER_CLAIM_STRIPES", "1024"))
+
+INDEX_KEY = "user-orders:{}"
+SEGMENT_KEY = "user-orders:{}:{}"
+CLAIM_KEY = "order-claims:{}"
+
+# Creates for the same user are serialized within a process so that ETag
+# conflicts (and retries) only happen between processes or replicas
+_INDEX_LOCK_STRIPES = 64
+_index_locks = [threading.Lock() for _ in range(_INDEX_LOCK_STRIPES)]
+
+
+class OrderAlreadyExists(Exception):
+    pass
+
+
+class IndexConflict(Exception):
+    """
+    The user-orders index kept changing underneath every attempt to update it
+    """
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _new_head():
+    return {"segmentSize": ORDER_INDEX_SEGMENT_SIZE, "sealed": 0, "tail": []}
+
+
+def _decode_head(data):
+    """
+    Decode a user-orders index head.
+
+    The head is {"segmentSize": S, "sealed": n, "tail": [...]}: order IDs
+    0..n*S-1 live in the sealed segments user-orders:{userId}:{i} (S IDs
+    each) and the most recent IDs live inline in "tail", so an append only
+    rewrites the head. Returns (head, legacy_ids); legacy_ids is the flat
+    array of a not yet migrated index and None otherwise.
+    """
+    if not data:
+        return _new_head(), None
+    value = decode(data)
+    if isinstance(value, list):
+        return None, value
+    return value, None
+
+
+def _migrate_ops(user_id, order_ids):
+    """
+    Build the head and sealed segments for a flat array of order IDs
+    """
+    size = ORDER_INDEX_SEGMENT_SIZE
+    sealed = len(order_ids) // size
+    ops = [
+        TransactionalStateOperation(
+            key=SEGMENT_KEY.format(user_id, i),
+            data=encode(order_ids[i * size:(i + 1) * size])
+        )
+        for i in range(sealed)
+    ]
+    head = {"segmentSize": size, "sealed": sealed, "tail": order_ids[sealed * size:]}
+    return head, ops
+
+
+@timed("read_index")
+def read_index(client, store_name, user_id, cursor=None, limit=None):
+    """
+    Read order IDs from a user's index in insertion order.
+
+    `cursor` is the position to start at (as returned in a previous call) and
+    `limit` the maximum number of IDs; only the segments that hold the
+    requested range are read. Returns (order_ids, next_cursor) where
+    next_cursor is None once the end of the index is reached.
+    """
+    try:
+        start = int(cursor) if cursor else 0
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if start < 0:
+        raise InvalidCursor(cursor)
+
+    resp = client.get_state(store_name=store_name, key=INDEX_KEY.format(user_id))
+    head, legacy_ids = _decode_head(resp.data)
+    if legacy_ids is not None:
+        end = len(legacy_ids) if limit is None else min(len(legacy_ids), start + limit)
+        return legacy_ids[start:end], (str(end) if end < len(legacy_ids) else None)
+
+    size = head["segmentSize"]
+    sealed_count = head["sealed"] * size
+    total = sealed_count + len(head["tail"])
+    end = total if limit is None else min(total, start + limit)
+    if start >= end:
+        return [], None
+
+    order_ids = []
+    if start < sealed_count:
+        first, last = start // size, (min(end, sealed_count) - 1) // size
+        keys = [SEGMENT_KEY.format(user_id, i) for i in range(first, last + 1)]
+        logger.debug("Reading index segments %s..%s for user: %s", first, last, user_id)
+        segments = {
+            item.key: decode(item.data) if item.data else []
+            for item in client.get_bulk_state(store_name=store_name, keys=keys,
+                                              parallelism=BULK_STATE_PARALLELISM).items
+        }
+        for key in keys:
+            order_ids.extend(segments[key])
+        order_ids = order_ids[start - first * size:]
+    order_ids.extend(head["tail"][max(0, start - sealed_count):])
+    order_ids = order_ids[:end - start]
+    return order_ids, (str(end) if end < total else None)
+
+
+def migrate_index(client, store_name, user_id):
+    """
+    Convert a flat user-orders array into a segmented index in one transaction.
+    Returns False if the index was already segmented (or does not exist).
+    """
+    index_key = INDEX_KEY.format(user_id)
+    with _index_locks[zlib.crc32(index_key.encode('utf-8')) % _INDEX_LOCK_STRIPES]:
+        for attempt in range(ORDER_INDEX_MAX_RETRIES):
+            resp = client.get_state(store_name=store_name, key=index_key)
+            _, legacy_ids = _decode_head(resp.data)
+            if legacy_ids is None:
+                return False
+            head, ops = _migrate_ops(user_id, legacy_ids)
+            ops.append(TransactionalStateOperation(key=index_key, data=encode(head), etag=resp.etag))
+            try:
+                client.execute_state_transaction(store_name=store_name, operations=ops)
+            except Exception as e:
+                if not _is_write_conflict(e):
+                    raise
+                _backoff(attempt)
+                continue
+            logger.info("Migrated index for user %s: %s order IDs", user_id, len(legacy_ids))
+            return True
+    raise IndexConflict(f"Could not migrate {index_key} after {ORDER_INDEX_MAX_RETRIES} attempts")
+
+
+@timed("read_orders")
+def get_orders(client, store_name, order_ids, chunk_size=None, concurrency=None, raw=False):
+    """
+    Read the orders for a list of order IDs using chunked bulk state reads.
+
+    Orders are returned in the same order as `order_ids`, decoded or, with
+    `raw`, as JSON bytes (the stored bytes themselves for plain JSON values).
+    IDs with no stored data are logged and skipped, as are keys (or whole
+    chunks) that fail to read.
+    """
+    if chunk_size is None:
+        chunk_size = ORDER_BULK_CHUNK_SIZE
+    if concurrency is None:
+        concurrency = ORDER_BULK_CONCURRENCY
+
+    keys = [f"order:{order_id}" for order_id in order_ids]
+    chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+
+    def read_chunk(chunk):
+        logger.debug("Getting bulk state for %s order keys", len(chunk))
+        try:
+            resp = client.get_bulk_state(
+                store_name=store_name,
+                keys=chunk,
+                parallelism=BULK_STATE_PARALLELISM
+            )
+            return resp.items
+        except Exception as e:
+            logger.error("Error retrieving %s orders starting at %s: %s", len(chunk), chunk[0], e)
+            return []
+
+    if concurrency <= 1 or len(chunks) <= 1:
+        results = map(read_chunk, chunks)
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+            results = list(executor.map(read_chunk, chunks))
+
+    found = {}
+    for items in results:
+        for item in items:
+            if item.error:
+                logger.error("Error retrieving %s: %s", item.key, item.error)
+            elif item.data:
+                found[item.key] = item.data
+
+    orders = []
+    for order_id, key in zip(order_ids, keys):
+        data = found.get(key)
+        if data:
+            orders.append(to_json(data) if raw else decode(data))
+        else:
+            logger.warning("No data found for order ID: %s", order_id)
+    return orders
+
+
+def _is_write_conflict(error):
+    # Dapr reports a stale ETag as ABORTED/FAILED_PRECONDITION for single writes
+    # and as a transaction failure mentioning the ETag for transactions; a
+    # first-write insert of a key that exists fails as a duplicate key
+    code = getattr(error, "code", None)
+    if callable(code) and getattr(code(), "name", None) in ("ABORTED", "FAILED_PRECONDITION"):
+        return True
+    message = str(error).lower()
+    return "etag" in message or "duplicate key" in message or "already exists" in message
+
+
+def _backoff(attempt):
+    delay_ms = min(ORDER_INDEX_RETRY_BACKOFF_MAX_MS, ORDER_INDEX_RETRY_BACKOFF_MS * (2 ** attempt))
+    time.sleep(random.uniform(0, delay_ms) / 1000.0)
+
+
+@timed("insert_order")
+def insert_order(client, store_name, order_data):
+    """
+    Save a new order and append it to the user's user-orders index in one
+    state transaction.
+
+    The order, the index head and the order ID's claim key are read together
+    with one bulk read. The head and the claim key are written with the
+    ETags from that read: the head's so that concurrent orders for the same
+    user cannot overwrite each other's index entries, the claim key's so
+    that two creates of the same order ID conflict even for different users
+    (a missing order has no ETag to guard it with). On an ETag conflict
+    everything is re-read and the transaction retried, and a retry that
+    finds the order stored raises OrderAlreadyExists. A user's first order
+    creates an empty head (insert-only) before the transaction so it has an
+    ETag too, as does the first order of a claim key. New IDs go into the
+    head's tail; a full tail is sealed into a segment in the same
+    transaction, and a flat legacy index is migrated to segments the first
+    time it is appended to.
+
+    Raises OrderAlreadyExists if the order is already stored and IndexConflict
+    if every retry conflicts.
+    """
+    index_key = INDEX_KEY.format(order_data['userId'])
+    with _index_locks[zlib.crc32(index_key.encode('utf-8')) % _INDEX_LOCK_STRIPES]:
+        return _insert_order(client, store_name, order_data, index_key)
+
+
+def _insert_order(client, store_name, order_data, index_key):
+    order_id = order_data["orderId"]
+    user_id = order_data["userId"]
+    order_key = f"order:{order_id}"
+    claim_key = _claim_key(order_id)
+    order_value = encode(order_data)
+    for attempt in range(ORDER_INDEX_MAX_RETRIES):
+        logger.debug("Reading %s, %s and %s (attempt %s)", order_key, index_key, claim_key, attempt + 1)
+        items = {
+            item.key: item
+            for item in client.get_bulk_state(store_name=store_name, keys=[order_key, index_key, claim_key]).items
+        }
+        if items[order_key].data:
+            raise OrderAlreadyExists(order_id)
+
+        missing = _missing_heads(items, [index_key], [claim_key])
+        if missing:
+            # Without an ETag the write would be last-write-wins, so create the
+            # key first (insert-only) and read it back with its ETag
+            _create_heads(client, store_name, missing)
+            continue
+
+        ops = [TransactionalStateOperation(key=order_key, data=order_value)]
+        ops.extend(_index_ops(user_id, [order_id], index_key, items[index_key]))
+        ops.append(_claim_op(claim_key, [order_id], items[claim_key]))
+        try:
+            client.execute_state_transaction(store_name=store_name, operations=ops)
+        except Exception as e:
+            if not _is_write_conflict(e):
+                raise
+            logger.debug("ETag conflict on %s or %s, retrying: %s", index_key, claim_key, e)
+            _backoff(attempt)
+            continue
+        return order_data
+
+    raise IndexConflict(f"Could not update {index_key} after {ORDER_INDEX_MAX_RETRIES} attempts")
+
+
+def _claim_key(order_id):
+    return CLAIM_KEY.format(zlib.crc32(str(order_id).encode('utf-8')) % ORDER_CLAIM_STRIPES)
+
+
+def _claim_op(claim_key, order_ids, claim_item):
+    # The value only has to change; the ETag is what makes creates of one ID conflict
+    return TransactionalStateOperation(
+        key=claim_key, data=encode({"lastOrderId": order_ids[-1]}), etag=claim_item.etag
+    )
+
+
+def _index_ops(user_id, order_ids, index_key, index_item):
+    """
+    Operations appending `order_ids` to a user's index, read as `index_item`
+    """
+    ops = []
+    head, legacy_ids = _decode_head(index_item.data)
+    if legacy_ids is not None:
+        head, ops_migrate = _migrate_ops(user_id, legacy_ids)
+        ops.extend(ops_migrate)
+    for order_id in order_ids:
+        if order_id not in head["tail"]:
+            head["tail"].append(order_id)
+        if len(head["tail"]) >= head["segmentSize"]:
+            ops.append(TransactionalStateOperation(
+                key=SEGMENT_KEY.format(user_id, head["sealed"]),
+                data=encode(head["tail"])
+            ))
+            head["sealed"] += 1
+            head["tail"] = []
+    ops.append(TransactionalStateOperation(key=index_key, data=encode(head), etag=index_item.etag))
+    return ops
+
+
+@timed("insert_orders")
+def insert_orders(client, store_name, orders):
+    """
+    Save a batch of new orders and append them to their users' user-orders
+    indexes in one state transaction.
+
+    Orders, index heads and claim keys are read with one bulk read, and each
+    user's head is rewritten once for all of that user's new orders in the
+    batch (sealing as many segments as fill up), with the ETag from that
+    read; claim keys are written with theirs, as for a single order. On a
+    conflict the batch is re-read and retried, so an order created
+    concurrently by another request counts as existing. Orders must have
+    distinct IDs. Returns the IDs of orders that already existed, which are
+    left unchanged.
+
+    Raises IndexConflict if every retry conflicts.
+    """
+    by_user = {}
+    for order in orders:
+        # 1 and "1" share one user-orders index
+        by_user.setdefault(str(order["userId"]), []).append(order)
+    index_keys = {user_id: INDEX_KEY.format(user_id) for user_id in by_user}
+    # Take the stripes in a fixed order so that concurrent batches cannot deadlock
+    stripes = sorted({zlib.crc32(key.encode('utf-8')) % _INDEX_LOCK_STRIPES for key in index_keys.values()})
+    for stripe in stripes:
+        _index_locks[stripe].acquire()
+    try:
+        return _insert_orders(client, store_name, by_user, index_keys)
+    finally:
+        for stripe in reversed(stripes):
+            _index_locks[stripe].release()
+
+
+def _insert_orders(client, store_name, by_user, index_keys):
+    order_keys = {order["orderId"]: f"order:{order['orderId']}" for orders in by_user.values() for order in orders}
+    claim_keys = {order_id: _claim_key(order_id) for order_id in order_keys}
+    keys = list(order_keys.values()) + list(index_keys.values()) + sorted(set(claim_keys.values()))
+    for attempt in range(ORDER_INDEX_MAX_RETRIES):
+        logger.debug("Reading %s orders and %s indexes (attempt %s)", len(order_keys), len(index_keys), attempt + 1)
+        items = {
+            item.key: item
+            for item in client.get_bulk_state(store_name=store_name, keys=keys,
+                                              parallelism=BULK_STATE_PARALLELISM).items
+        }
+        existing = {order_id for order_id, key in order_keys.items() if items[key].data}
+        new_orders = {
+            user_id: [order for order in orders if order["orderId"] not in existing]
+            for user_id, orders in by_user.items()
+        }
+        new_orders = {user_id: orders for user_id, orders in new_orders.items() if orders}
+        if not new_orders:
+            return existing
+
+        claims = {}
+        for orders in new_orders.values():
+            for order in orders:
+                claims.setdefault(claim_keys[order["orderId"]], []).append(order["orderId"])
+        missing = _missing_heads(items, [index_keys[user_id] for user_id in new_orders], claims)
+        if missing:
+            # Same as for a single order: create the missing keys (insert-only)
+            # so that every one is written with an ETag
+            _create_heads(client, store_name, missing)
+            continue
+
+        ops = []
+        for user_id, orders in new_orders.items():
+            ops.extend(
+                TransactionalStateOperation(key=order_keys[order["orderId"]], data=encode(order)) for order in orders
+            )
+            index_key = index_keys[user_id]
+            ops.extend(_index_ops(user_id, [order["orderId"] for order in orders], index_key, items[index_key]))
+        ops.extend(_claim_op(claim_key, order_ids, items[claim_key]) for claim_key, order_ids in claims.items())
+
+        try:
+            client.execute_state_transaction(store_name=store_name, operations=ops)
+        except Exception as e:
+            if not _is_write_conflict(e):
+                raise
+            logger.debug("ETag conflict writing a batch of %s orders, retrying: %s", len(order_keys), e)
+            _backoff(attempt)
+            continue
+        return existing
+
+    raise IndexConflict(f"Could not update {len(index_keys)} indexes after {ORDER_INDEX_MAX_RETRIES} attempts")
+
+
+def _missing_heads(items, index_keys, claim_keys):
+    """
+    Initial values of the index heads and claim keys that do not exist yet
+    """
+    missing = {key: _new_head() for key in index_keys if not items[key].etag}
+    missing.update((key, {}) for key in claim_keys if not items[key].etag)
+    return missing
+
+
+def _create_heads(client, store_name, heads):
+    """
+    Create keys insert-only with the given initial values; keys another
+    request created first are just as good
+    """
+    logger.debug("Creating %s", ", ".join(heads))
+    options = StateOptions(concurrency=Concurrency.first_write)
+    if len(heads) > 1:
+        try:
+            client.save_bulk_state(
+                store_name=store_name,
+                states=[StateItem(key=key, value=encode(value), options=options) for key, value in heads.items()]
+            )
+            return
+        except Exception as e:
+            if not _is_write_conflict(e):
+                raise
+            # Some were created concurrently; create the others one at a time
+    for key, value in heads.items():
+        try:
+            client.save_state(store_name=store_name, key=key, value=encode(value), options=options)
+        except Exception as e:
+            if not _is_write_conflict(e):
+                raise
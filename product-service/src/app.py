@@ -1,51 +1,163 @@
 import json
 import os
 import logging
-import sys
 from flask import Flask, request, jsonify
-from dapr.clients import DaprClient
+from dapr_client import dapr_client, init_client
+from bulk_ingest import ingest, insert_new, iter_records
+from fast_json import conditional_json_response, dumps, join_object, raw_json_response
+from metrics import install_metrics
+from state_codec import decode, encode, to_json
+from single_flight import SingleFlight
+from logging_setup import configure_logging, install_correlation_ids, payload
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
 
 # Dapr configuration
 DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
 DAPR_STORE_NAME = "product-state-store"
-logger.info(f"Using Dapr HTTP port: {DAPR_HTTP_PORT}")
-logger.info(f"Using Dapr store name: {DAPR_STORE_NAME}")
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "500"))
+BULK_STATE_PARALLELISM = int(os.getenv("BULK_STATE_PARALLELISM", "10"))
+# Cache-Control of GET /products/<id>. Products are not per-user, so shared caches
+# may keep them too; "no-cache" makes them revalidate with the ETag before each use
+PRODUCT_CACHE_CONTROL = os.getenv("PRODUCT_CACHE_CONTROL", "public, no-cache")
+PUBSUB_NAME = "product-pubsub"
+PRODUCT_UPDATES_TOPIC = "product-updates"
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+logger.info("Using Dapr store name: %s", DAPR_STORE_NAME)
+
+# Concurrent reads of the same product key, from GET and batchGet alike, share one state read
+product_flights = SingleFlight("product")
+
+def read_products(client, keys):
+    """
+    Read product keys with one bulk state read; returns key -> JSON bytes or None
+    """
+    logger.debug("Getting bulk state for %s keys", len(keys))
+    resp = client.get_bulk_state(
+        store_name=DAPR_STORE_NAME,
+        keys=keys,
+        parallelism=BULK_STATE_PARALLELISM
+    )
+    found = {}
+    for item in resp.items:
+        if item.error:
+            logger.warning("Error reading key %s: %s", item.key, item.error)
+        found[item.key] = to_json(item.data) if item.data and not item.error else None
+    return found
+
+def publish_product_updated(client, product_id):
+    """
+    Notify subscribers (e.g. the all-details-direct product cache) that a product changed.
+    A failed publish does not fail the update; cached copies then expire by TTL.
+    """
+    try:
+        logger.debug("Publishing product update event for: %s", product_id)
+        client.publish_event(
+            pubsub_name=PUBSUB_NAME,
+            topic_name=PRODUCT_UPDATES_TOPIC,
+            data=json.dumps({"productId": product_id}),
+            data_content_type="application/json"
+        )
+    except Exception as e:
+        logger.warning("Error publishing product update event for %s: %s", product_id, e)
 
 @app.route('/products/<product_id>', methods=['GET'])
 def get_product(product_id):
     """
     Retrieve a product by productId
     Example: GET /products/p1
+    
+    The response carries an ETag; with a matching If-None-Match the answer
+    is 304 Not Modified without a body.
     """
-    logger.info(f"GET /products/{product_id} request")
+    logger.info("GET /products/%s request", product_id)
     product_key = f"product:{product_id}"
-    logger.debug(f"Looking up product with key: {product_key}")
+    logger.debug("Looking up product with key: %s", product_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            logger.debug(f"Getting state for key: {product_key}")
-            resp = client.get_state(store_name=DAPR_STORE_NAME, key=product_key)
-            if not resp.data:
-                logger.warning(f"Product not found: {product_id}")
+            logger.debug("Getting state for key: %s", product_key)
+            data = product_flights.do(
+                product_key, lambda: to_json(client.get_state(store_name=DAPR_STORE_NAME, key=product_key).data)
+            )
+            if not data:
+                logger.warning("Product not found: %s", product_id)
                 return jsonify({"error": "Product not found"}), 404
             
-            product_data = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Product data retrieved: {product_data}")
-            logger.info(f"Successfully retrieved product: {product_id}")
-            return jsonify(product_data), 200
+            # A document stored as JSON is sent as is
+            logger.debug("Product data retrieved: %s", payload(data))
+            logger.info("Successfully retrieved product: %s", product_id)
+            return conditional_json_response(data, PRODUCT_CACHE_CONTROL)
+        
+        except Exception as e:
+            logger.error("Error in get_product: %s", e, exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route('/products:batchGet', methods=['POST'])
+def batch_get_products():
+    """
+    Retrieve several products in one call using a bulk state read
+    Example request body:
+    {
+      "productIds": ["p1", "p2"]
+    }
+    Example response:
+    {
+      "products": { "p1": { "productId": "p1", ... } },
+      "notFound": ["p2"]
+    }
+    """
+    request_data = request.json or {}
+    product_ids = request_data.get("productIds") if isinstance(request_data, dict) else None
+    
+    if not isinstance(product_ids, list):
+        logger.warning("Missing required field in request: productIds")
+        return jsonify({"error": "Missing required field: productIds"}), 400
+    logger.info("POST /products:batchGet request for %s products", len(product_ids))
+    
+    # IDs become state keys and keys of the response object, so only non-empty strings are accepted
+    if not all(isinstance(product_id, str) and product_id for product_id in product_ids):
+        logger.warning("Invalid productIds in batch request")
+        return jsonify({"error": "productIds must be non-empty strings"}), 400
+    
+    # De-duplicate while keeping the order in which IDs were requested
+    product_ids = list(dict.fromkeys(product_ids))
+    if len(product_ids) > BATCH_GET_MAX_IDS:
+        logger.warning("Too many product IDs in batch request: %s", len(product_ids))
+        return jsonify({"error": f"At most {BATCH_GET_MAX_IDS} productIds per request"}), 400
+    
+    if not product_ids:
+        return jsonify({"products": {}, "notFound": []}), 200
+    
+    with dapr_client() as client:
+        try:
+            keys = [f"product:{product_id}" for product_id in product_ids]
+            # Keys already being read by concurrent requests are not read again
+            found = product_flights.do_many(keys, lambda missing: read_products(client, missing))
+            
+            # Products stored as JSON are spliced into the response as they are, without decoding
+            products = []
+            not_found = []
+            for product_id, key in zip(product_ids, keys):
+                if found.get(key):
+                    products.append((product_id, found[key]))
+                else:
+                    not_found.append(product_id)
+            
+            logger.info("Successfully retrieved %s products, %s not found", len(products), len(not_found))
+            return raw_json_response(join_object([
+                ("products", join_object(products)),
+                ("notFound", dumps(not_found))
+            ])), 200
         
         except Exception as e:
-            logger.error(f"Error in get_product: {str(e)}", exc_info=True)
+            logger.error("Error in batch_get_products: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/products', methods=['POST'])
@@ -61,38 +173,71 @@ def create_product():
     }
     """
     product_data = request.json
-    logger.info(f"POST /products request with data: {product_data}")
+    logger.info("POST /products request with data: %s", payload(product_data))
     
     # Validate required fields
     required_fields = ["productId", "name", "description", "price"]
     for field in required_fields:
         if field not in product_data:
-            logger.warning(f"Missing required field in request: {field}")
+            logger.warning("Missing required field in request: %s", field)
             return jsonify({"error": f"Missing required field: {field}"}), 400
     
     product_id = product_data["productId"]
     product_key = f"product:{product_id}"
-    logger.debug(f"Product key: {product_key}")
+    logger.debug("Product key: %s", product_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
             # Check if product already exists
-            logger.debug(f"Checking if product already exists: {product_id}")
+            logger.debug("Checking if product already exists: %s", product_id)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=product_key)
             if resp.data:
-                logger.warning(f"Product already exists: {product_id}")
+                logger.warning("Product already exists: %s", product_id)
                 return jsonify({"error": "Product already exists"}), 409
             
             # Store the product data
-            logger.debug(f"Saving product data for key: {product_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=product_key, value=json.dumps(product_data))
-            logger.debug(f"Product data saved successfully")
+            logger.debug("Saving product data for key: %s", product_key)
+            client.save_state(store_name=DAPR_STORE_NAME, key=product_key, value=encode(product_data))
+            logger.debug("Product data saved successfully")
             
-            logger.info(f"Product created successfully: {product_id}")
+            logger.info("Product created successfully: %s", product_id)
             return jsonify(product_data), 201
         
         except Exception as e:
-            logger.error(f"Error in create_product: {str(e)}", exc_info=True)
+            logger.error("Error in create_product: %s", e, exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route('/products:bulk', methods=['POST'])
+def bulk_create_products():
+    """
+    Create many products in one request, from a JSON array or, with
+    `Content-Type: application/x-ndjson`, one product per line. Records are
+    validated as the body is read and written in batches of
+    BULK_INGEST_BATCH_SIZE; existing products are left unchanged.
+    Example request body (NDJSON):
+    { "productId": "p1", "name": "Laptop", "description": "High-end laptop", "price": 1000.00 }
+    { "name": "Phone" }
+    Example response (`?results=all` also lists the created records):
+    {
+      "created": 1, "exists": 0, "invalid": 1, "failed": 0,
+      "results": [ { "index": 1, "id": null, "status": "invalid", "error": "Missing required field: productId" } ]
+    }
+    """
+    logger.info("POST /products:bulk request")
+    
+    with dapr_client() as client:
+        try:
+            result = ingest(
+                iter_records(request),
+                ["productId", "name", "description", "price"],
+                "productId",
+                lambda products: insert_new(client, DAPR_STORE_NAME, "product:{}", "productId", products),
+                include_created=request.args.get("results") == "all"
+            )
+            return jsonify(result), 200
+        
+        except Exception as e:
+            logger.error("Error in bulk_create_products: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/products/<product_id>', methods=['PUT'])
@@ -106,40 +251,42 @@ def update_product(product_id):
       "price": 1200.00
     }
     """
-    logger.info(f"PUT /products/{product_id} request")
+    logger.info("PUT /products/%s request", product_id)
     update_data = request.json
-    logger.debug(f"Update data: {update_data}")
+    logger.debug("Update data: %s", payload(update_data))
     
     product_key = f"product:{product_id}"
-    logger.debug(f"Product key: {product_key}")
+    logger.debug("Product key: %s", product_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
             # Check if product exists
-            logger.debug(f"Checking if product exists: {product_id}")
+            logger.debug("Checking if product exists: %s", product_id)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=product_key)
             if not resp.data:
-                logger.warning(f"Product not found for update: {product_id}")
+                logger.warning("Product not found for update: %s", product_id)
                 return jsonify({"error": "Product not found"}), 404
             
             # Get existing product data
-            existing_product = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Existing product data: {existing_product}")
+            existing_product = decode(resp.data)
+            logger.debug("Existing product data: %s", payload(existing_product))
             
             # Update product data
             for key, value in update_data.items():
                 existing_product[key] = value
             
             # Store the updated product data
-            logger.debug(f"Saving updated product data for key: {product_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=product_key, value=json.dumps(existing_product))
-            logger.debug(f"Product data updated successfully")
+            logger.debug("Saving updated product data for key: %s", product_key)
+            client.save_state(store_name=DAPR_STORE_NAME, key=product_key, value=encode(existing_product))
+            logger.debug("Product data updated successfully")
+            
+            publish_product_updated(client, product_id)
             
-            logger.info(f"Product updated successfully: {product_id}")
+            logger.info("Product updated successfully: %s", product_id)
             return jsonify(existing_product), 200
         
         except Exception as e:
-            logger.error(f"Error in update_product: {str(e)}", exc_info=True)
+            logger.error("Error in update_product: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -158,5 +305,6 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting Product Service application")
-    logger.info(f"Server running on 0.0.0.0:5000")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,46 @@
+import os
+import shutil
+
+# Gunicorn settings used when SERVER_MODE is "production" (the default).
+# Each worker is a separate process, so it can use its own CPU core; within a
+# worker, requests are served by GUNICORN_THREADS threads.
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# Seconds a request may run before its worker is restarted
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+# Seconds an idle keep-alive connection is held open
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# Restart a worker after this many requests (plus up to 10% jitter); 0 disables it
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+# The services log requests themselves
+accesslog = None
+errorlog = "-"
+
+
+def on_starting(server):
+    # Workers write their metrics to files in this directory; start empty so
+    # counters from a previous run are not merged in
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # The app is imported after the fork, so every worker starts its own log
+    # writer thread and opens its own channels to the sidecar before it
+    # accepts requests
+    from logging_setup import configure_logging
+    from dapr_client import init_client
+    configure_logging()
+    init_client()
+    server.log.info(f"Worker {worker.pid} initialized its Dapr client")
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
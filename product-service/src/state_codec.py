@@ -0,0 +1,143 @@
+import os
+import gzip
+import base64
+
+from fast_json import dumps, loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoding of state values written from now on: "json" or "msgpack"
+STATE_CODEC = os.getenv("STATE_CODEC", "json")
+# Compression of state values written from now on: "none", "gzip" or "zstd"
+STATE_COMPRESSION = os.getenv("STATE_COMPRESSION", "none")
+# Compression level (gzip 1-9, zstd 1-22)
+STATE_COMPRESSION_LEVEL = int(os.getenv("STATE_COMPRESSION_LEVEL", "3"))
+
+# Values other than plain JSON are wrapped in a 4 byte header: MAGIC, the
+# envelope version, the codec and the compression. No JSON document starts
+# with MAGIC, so plain JSON values (envelope version 0) need no header and
+# stay readable by anything that reads JSON.
+MAGIC = 0
+ENVELOPE_VERSION = 1
+HEADER_SIZE = 4
+CODECS = {"json": 1, "msgpack": 2}
+COMPRESSIONS = {"none": 0, "gzip": 1, "zstd": 2}
+_CODEC_NAMES = {codec_id: name for name, codec_id in CODECS.items()}
+_COMPRESSION_NAMES = {compression_id: name for name, compression_id in COMPRESSIONS.items()}
+
+if STATE_CODEC not in CODECS:
+    raise ValueError(f"Unsupported STATE_CODEC: {STATE_CODEC}")
+if STATE_COMPRESSION not in COMPRESSIONS:
+    raise ValueError(f"Unsupported STATE_COMPRESSION: {STATE_COMPRESSION}")
+if STATE_CODEC == "msgpack" and msgpack is None:
+    raise RuntimeError("STATE_CODEC=msgpack requires the msgpack package")
+if STATE_COMPRESSION == "zstd" and zstandard is None:
+    raise RuntimeError("STATE_COMPRESSION=zstd requires the zstandard package")
+
+
+class UnsupportedEnvelope(ValueError):
+    """
+    A state value was written with an envelope version, codec or compression
+    this process cannot read
+    """
+
+
+def _pack(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _unpack(data):
+    if msgpack is None:
+        raise UnsupportedEnvelope("Reading msgpack state values requires the msgpack package")
+    return msgpack.unpackb(data, raw=False)
+
+
+def _zstd_decompress(data):
+    if zstandard is None:
+        raise UnsupportedEnvelope("Reading zstd state values requires the zstandard package")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+_ENCODERS = {1: dumps, 2: _pack}
+_DECODERS = {1: loads, 2: _unpack}
+_COMPRESSORS = {
+    0: lambda data, level: data,
+    1: lambda data, level: gzip.compress(data, level, mtime=0),
+    2: lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+}
+_DECOMPRESSORS = {0: lambda data: data, 1: gzip.decompress, 2: _zstd_decompress}
+
+
+def encode(value, codec=None, compression=None, level=None):
+    """
+    Encode a state value with STATE_CODEC and STATE_COMPRESSION, or the
+    given codec and compression. Uncompressed JSON is written as plain JSON.
+    """
+    codec_id = CODECS[codec or STATE_CODEC]
+    compression_id = COMPRESSIONS[compression or STATE_COMPRESSION]
+    data = _ENCODERS[codec_id](value)
+    if codec_id == CODECS["json"] and compression_id == COMPRESSIONS["none"]:
+        return data
+    body = _COMPRESSORS[compression_id](data, STATE_COMPRESSION_LEVEL if level is None else level)
+    return bytes((MAGIC, ENVELOPE_VERSION, codec_id, compression_id)) + body
+
+
+def envelope(data):
+    """
+    (codec, compression) names of a stored value; ("json", "none") for plain JSON
+    """
+    if not data or data[0] != MAGIC:
+        return "json", "none"
+    _check(data)
+    return _CODEC_NAMES[data[2]], _COMPRESSION_NAMES[data[3]]
+
+
+def _check(data):
+    if len(data) < HEADER_SIZE or data[1] != ENVELOPE_VERSION:
+        raise UnsupportedEnvelope(f"Unsupported state envelope version: {data[1:2].hex() or 'missing'}")
+    if data[2] not in _DECODERS or data[3] not in _DECOMPRESSORS:
+        raise UnsupportedEnvelope(f"Unsupported state codec or compression: {data[2]}, {data[3]}")
+
+
+def decode(data):
+    """
+    Decode a stored state value, whichever codec and compression it was
+    written with. Plain JSON (bytes or str) is read as is.
+    """
+    if isinstance(data, str) or not data or data[0] != MAGIC:
+        return loads(data)
+    _check(data)
+    return _DECODERS[data[2]](_DECOMPRESSORS[data[3]](data[HEADER_SIZE:]))
+
+
+def to_json(data):
+    """
+    JSON bytes of a stored state value. Plain JSON is returned without
+    decoding, so read endpoints can keep sending stored documents as they are.
+    """
+    if not data or data[0] != MAGIC:
+        return data
+    _check(data)
+    body = _DECOMPRESSORS[data[3]](data[HEADER_SIZE:])
+    if data[2] == CODECS["json"]:
+        return body
+    return dumps(_DECODERS[data[2]](body))
+
+
+def decode_row(value, is_binary):
+    """
+    Decode the value column of a Dapr PostgreSQL state table row, as read by
+    the database driver: JSON values are stored as jsonb (already decoded)
+    and anything else, such as enveloped values, as a base64 JSON string
+    """
+    if is_binary:
+        return decode(base64.b64decode(value))
+    return value
@@ -1,25 +1,28 @@
-import json
 import os
 import logging
-import sys
 from flask import Flask, request, jsonify
-from dapr.clients import DaprClient
+from dapr_client import dapr_client, init_client
+from bulk_ingest import ingest, insert_new, iter_records
+from fast_json import conditional_json_response
+from metrics import install_metrics
+from state_codec import decode, encode, to_json
+from logging_setup import configure_logging, install_correlation_ids, payload
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# Configure logging (level from LOG_LEVEL, written to stdout by a background thread)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+install_correlation_ids(app)
+install_metrics(app)
 
 # Dapr configuration
 DAPR_HTTP_PORT = os.getenv("DAPR_HTTP_PORT", "3500")
 DAPR_STORE_NAME = "user-state-store"
-logger.info(f"Using Dapr HTTP port: {DAPR_HTTP_PORT}")
-logger.info(f"Using Dapr store name: {DAPR_STORE_NAME}")
+# Cache-Control of GET /users/<id>; clients revalidate with If-None-Match
+USER_CACHE_CONTROL = os.getenv("USER_CACHE_CONTROL", "private, no-cache")
+logger.info("Using Dapr HTTP port: %s", DAPR_HTTP_PORT)
+logger.info("Using Dapr store name: %s", DAPR_STORE_NAME)
 
 @app.route('/users/<user_id>', methods=['GET'])
 def get_user(user_id):
@@ -27,25 +30,25 @@ def get_user(user_id):
     Retrieve a user profile by userId
     Example: GET /users/123
     """
-    logger.info(f"GET /users/{user_id} request")
+    logger.info("GET /users/%s request", user_id)
     user_key = f"user:{user_id}"
-    logger.debug(f"Looking up user with key: {user_key}")
+    logger.debug("Looking up user with key: %s", user_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
-            logger.debug(f"Getting state for key: {user_key}")
+            logger.debug("Getting state for key: %s", user_key)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=user_key)
             if not resp.data:
-                logger.warning(f"User not found: {user_id}")
+                logger.warning("User not found: %s", user_id)
                 return jsonify({"error": "User not found"}), 404
             
-            user_data = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"User data retrieved: {user_data}")
-            logger.info(f"Successfully retrieved user: {user_id}")
-            return jsonify(user_data), 200
+            # A document stored as JSON is sent as is
+            logger.debug("User data retrieved: %s", payload(resp.data))
+            logger.info("Successfully retrieved user: %s", user_id)
+            return conditional_json_response(to_json(resp.data), USER_CACHE_CONTROL)
         
         except Exception as e:
-            logger.error(f"Error in get_user: {str(e)}", exc_info=True)
+            logger.error("Error in get_user: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/users', methods=['POST'])
@@ -60,38 +63,71 @@ def create_user():
     }
     """
     user_data = request.json
-    logger.info(f"POST /users request with data: {user_data}")
+    logger.info("POST /users request with data: %s", payload(user_data))
     
     # Validate required fields
     required_fields = ["userId", "name", "email"]
     for field in required_fields:
         if field not in user_data:
-            logger.warning(f"Missing required field in request: {field}")
+            logger.warning("Missing required field in request: %s", field)
             return jsonify({"error": f"Missing required field: {field}"}), 400
     
     user_id = user_data["userId"]
     user_key = f"user:{user_id}"
-    logger.debug(f"User key: {user_key}")
+    logger.debug("User key: %s", user_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
             # Check if user already exists
-            logger.debug(f"Checking if user already exists: {user_id}")
+            logger.debug("Checking if user already exists: %s", user_id)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=user_key)
             if resp.data:
-                logger.warning(f"User already exists: {user_id}")
+                logger.warning("User already exists: %s", user_id)
                 return jsonify({"error": "User already exists"}), 409
             
             # Store the user data
-            logger.debug(f"Saving user data for key: {user_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=user_key, value=json.dumps(user_data))
-            logger.debug(f"User data saved successfully")
+            logger.debug("Saving user data for key: %s", user_key)
+            client.save_state(store_name=DAPR_STORE_NAME, key=user_key, value=encode(user_data))
+            logger.debug("User data saved successfully")
             
-            logger.info(f"User created successfully: {user_id}")
+            logger.info("User created successfully: %s", user_id)
             return jsonify(user_data), 201
         
         except Exception as e:
-            logger.error(f"Error in create_user: {str(e)}", exc_info=True)
+            logger.error("Error in create_user: %s", e, exc_info=True)
+            return jsonify({"error": str(e)}), 500
+
+@app.route('/users:bulk', methods=['POST'])
+def bulk_create_users():
+    """
+    Create many users in one request, from a JSON array or, with
+    `Content-Type: application/x-ndjson`, one user per line. Records are
+    validated as the body is read and written in batches of
+    BULK_INGEST_BATCH_SIZE; existing users are left unchanged.
+    Example request body (NDJSON):
+    { "userId": "123", "name": "Alice", "email": "alice@example.com" }
+    { "name": "Bob" }
+    Example response (`?results=all` also lists the created records):
+    {
+      "created": 1, "exists": 0, "invalid": 1, "failed": 0,
+      "results": [ { "index": 1, "id": null, "status": "invalid", "error": "Missing required field: userId" } ]
+    }
+    """
+    logger.info("POST /users:bulk request")
+    
+    with dapr_client() as client:
+        try:
+            result = ingest(
+                iter_records(request),
+                ["userId", "name", "email"],
+                "userId",
+                lambda users: insert_new(client, DAPR_STORE_NAME, "user:{}", "userId", users),
+                include_created=request.args.get("results") == "all"
+            )
+            return jsonify(result), 200
+        
+        except Exception as e:
+            logger.error("Error in bulk_create_users: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/users/<user_id>', methods=['PUT'])
@@ -105,40 +141,40 @@ def update_user(user_id):
       "email": "alice.smith@example.com"
     }
     """
-    logger.info(f"PUT /users/{user_id} request")
+    logger.info("PUT /users/%s request", user_id)
     update_data = request.json
-    logger.debug(f"Update data: {update_data}")
+    logger.debug("Update data: %s", payload(update_data))
     
     user_key = f"user:{user_id}"
-    logger.debug(f"User key: {user_key}")
+    logger.debug("User key: %s", user_key)
     
-    with DaprClient() as client:
+    with dapr_client() as client:
         try:
             # Check if user exists
-            logger.debug(f"Checking if user exists: {user_id}")
+            logger.debug("Checking if user exists: %s", user_id)
             resp = client.get_state(store_name=DAPR_STORE_NAME, key=user_key)
             if not resp.data:
-                logger.warning(f"User not found for update: {user_id}")
+                logger.warning("User not found for update: %s", user_id)
                 return jsonify({"error": "User not found"}), 404
             
             # Get existing user data
-            existing_user = json.loads(resp.data.decode('utf-8'))
-            logger.debug(f"Existing user data: {existing_user}")
+            existing_user = decode(resp.data)
+            logger.debug("Existing user data: %s", payload(existing_user))
             
             # Update user data
             for key, value in update_data.items():
                 existing_user[key] = value
             
             # Store the updated user data
-            logger.debug(f"Saving updated user data for key: {user_key}")
-            client.save_state(store_name=DAPR_STORE_NAME, key=user_key, value=json.dumps(existing_user))
-            logger.debug(f"User data updated successfully")
+            logger.debug("Saving updated user data for key: %s", user_key)
+            client.save_state(store_name=DAPR_STORE_NAME, key=user_key, value=encode(existing_user))
+            logger.debug("User data updated successfully")
             
-            logger.info(f"User updated successfully: {user_id}")
+            logger.info("User updated successfully: %s", user_id)
             return jsonify(existing_user), 200
         
         except Exception as e:
-            logger.error(f"Error in update_user: {str(e)}", exc_info=True)
+            logger.error("Error in update_user: %s", e, exc_info=True)
             return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -157,5 +193,6 @@ def health_check():
 
 if __name__ == '__main__':
     logger.info("Starting User Service application")
-    logger.info(f"Server running on 0.0.0.0:5000")
+    init_client()
+    logger.info("Server running on 0.0.0.0:5000")
     app.run(host='0.0.0.0', port=5000)
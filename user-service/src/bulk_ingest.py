@@ -0,0 +1,234 @@
+import codecs
+import json
+import os
+import logging
+
+from dapr.clients.grpc._state import StateItem, StateOptions, Concurrency
+
+from fast_json import loads
+from metrics import timed
+from state_codec import encode
+
+logger = logging.getLogger(__name__)
+
+# Records written per bulk state save (and, for orders, per transaction)
+BULK_INGEST_BATCH_SIZE = int(os.getenv("BULK_INGEST_BATCH_SIZE", "500"))
+# Parallelism the sidecar uses to resolve the keys of the existence check
+BULK_INGEST_READ_PARALLELISM = int(os.getenv("BULK_INGEST_READ_PARALLELISM", "10"))
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+_READ_CHUNK_BYTES = 64 * 1024
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_records(request):
+    """
+    Read the records of a bulk request body one at a time, without holding
+    the whole body: an NDJSON stream (Content-Type: application/x-ndjson) or
+    a JSON array. Yields (index, record, error) with error set, and record
+    None, for a record that cannot be decoded; a malformed JSON array ends
+    the stream since nothing after the error can be located.
+    """
+    if request.mimetype == NDJSON_MIMETYPE:
+        return _iter_ndjson(request.stream)
+    return _iter_array(request.stream)
+
+
+def _iter_ndjson(stream):
+    index = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield index, loads(line), None
+        except ValueError as e:
+            yield index, None, f"Invalid JSON: {e}"
+        index += 1
+
+
+def _iter_array(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        # Drop what has been consumed and append the next chunk
+        nonlocal buffer, pos, eof
+        chunk = stream.read(_READ_CHUNK_BYTES)
+        eof = not chunk
+        buffer = buffer[pos:] + decoder.decode(chunk, final=eof)
+        pos = 0
+
+    def skip():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip()
+    if buffer[pos:pos + 1] != "[":
+        yield 0, None, "Expected a JSON array or NDJSON (Content-Type: application/x-ndjson)"
+        return
+    pos += 1
+    index = 0
+    skip()
+    if buffer[pos:pos + 1] == "]":
+        return
+    while True:
+        try:
+            record, end = _decoder.raw_decode(buffer, pos)
+            # A value that ends at the end of the buffer may continue in the next chunk
+            complete = end < len(buffer) or eof
+        except ValueError as e:
+            if eof:
+                yield index, None, f"Invalid JSON: {e}"
+                return
+            complete = False
+        if not complete:
+            fill()
+            continue
+        pos = end
+        yield index, record, None
+        index += 1
+        skip()
+        if buffer[pos:pos + 1] == "]":
+            return
+        if buffer[pos:pos + 1] != ",":
+            yield index, None, f"Expected ',' or ']' after record {index - 1}"
+            return
+        pos += 1
+        skip()
+
+
+def validate(record, required_fields, id_field):
+    """
+    Return why a record cannot be ingested, or None if it can
+    """
+    if not isinstance(record, dict):
+        return "Record must be a JSON object"
+    for field in required_fields:
+        if field not in record:
+            return f"Missing required field: {field}"
+    if not isinstance(record[id_field], (str, int)) or isinstance(record[id_field], bool):
+        return f"{id_field} must be a string or integer"
+    return None
+
+
+def ingest(records, required_fields, id_field, write_batch, batch_size=None, include_created=False):
+    """
+    Validate records as they are read and write the valid ones in batches.
+
+    write_batch(records) writes a list of new records and returns the IDs of
+    those that already existed, which are left unchanged. If it raises, every
+    record of the batch is reported as failed and ingestion goes on with the
+    next batch. IDs are stored as strings, so 1 and "1" are the same record.
+    A record repeating the ID of an earlier one is reported as already
+    existing: within a batch it is never written, and in a later batch the
+    existence check finds the earlier one.
+
+    Returns counts per status and the per-record results: every record that
+    was not created, and with `include_created` the created ones too.
+    """
+    if batch_size is None:
+        batch_size = BULK_INGEST_BATCH_SIZE
+    counts = {"created": 0, "exists": 0, "invalid": 0, "failed": 0}
+    results = []
+    batch = []
+    batch_ids = set()
+
+    def report(index, record_id, status, error=None):
+        counts[status] += 1
+        if status != "created" or include_created:
+            result = {"index": index, "id": record_id, "status": status}
+            if error:
+                result["error"] = error
+            results.append(result)
+
+    def flush():
+        try:
+            existing = write_batch([record for _, record in batch])
+        except Exception as e:
+            logger.error("Error writing batch of %s records starting at %s: %s", len(batch), batch[0][0], e)
+            for index, record in batch:
+                report(index, record[id_field], "failed", str(e))
+        else:
+            for index, record in batch:
+                report(index, record[id_field], "exists" if record[id_field] in existing else "created")
+        batch.clear()
+        batch_ids.clear()
+
+    for index, record, error in records:
+        error = error or validate(record, required_fields, id_field)
+        if error:
+            report(index, record.get(id_field) if isinstance(record, dict) else None, "invalid", error)
+            continue
+        # The same key either way, see key_format in insert_new
+        record_id = record[id_field] = str(record[id_field])
+        if record_id in batch_ids:
+            report(index, record_id, "exists")
+            continue
+        batch_ids.add(record_id)
+        batch.append((index, record))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    logger.info("Bulk ingest finished: %s", counts)
+    results.sort(key=lambda result: result["index"])
+    return dict(counts, results=results)
+
+
+@timed("bulk_write")
+def insert_new(client, store_name, key_format, id_field, records):
+    """
+    Save the records whose keys do not exist yet with one bulk read and one
+    bulk save. Returns the IDs of the records that already existed.
+
+    The save is insert-only (first-write), so a record created concurrently
+    by another request after the read is not overwritten. A bulk save is
+    applied in one transaction by the PostgreSQL state store; if it fails on
+    such a conflict, the records are saved one at a time and the conflicting
+    ones count as existing.
+    """
+    keys = [key_format.format(record[id_field]) for record in records]
+    resp = client.get_bulk_state(store_name=store_name, keys=keys, parallelism=BULK_INGEST_READ_PARALLELISM)
+    found = {item.key for item in resp.items if item.data}
+    options = StateOptions(concurrency=Concurrency.first_write)
+    states = [
+        StateItem(key=key, value=encode(record), options=options)
+        for key, record in zip(keys, records)
+        if key not in found
+    ]
+    if states:
+        logger.debug("Saving %s new records, %s already exist", len(states), len(found))
+        try:
+            client.save_bulk_state(store_name=store_name, states=states)
+        except Exception as e:
+            if not _is_write_conflict(e):
+                raise
+            logger.debug("Bulk save conflicted, saving %s records one at a time", len(states))
+            for state in states:
+                try:
+                    client.save_state(store_name=store_name, key=state.key, value=state.value, options=options)
+                except Exception as e:
+                    if not _is_write_conflict(e):
+                        raise
+                    found.add(state.key)
+    return {record[id_field] for key, record in zip(keys, records) if key in found}
+
+
+def _is_write_conflict(error):
+    # A first-write save of a key that exists: ABORTED/FAILED_PRECONDITION
+    # from the sidecar, or the store's duplicate key / ETag error in the message
+    code = getattr(error, "code", None)
+    if callable(code) and getattr(code(), "name", None) in ("ABORTED", "FAILED_PRECONDITION"):
+        return True
+    message = str(error).lower()
+    return "etag" in message or "duplicate key" in message or "already exists" in message
@@ -0,0 +1,137 @@
+import os
+import time
+import logging
+import threading
+import itertools
+import functools
+import atexit
+from contextlib import contextmanager
+
+import grpc
+from dapr.clients import DaprClient
+
+from metrics import observe_dapr_call
+
+logger = logging.getLogger(__name__)
+
+# Number of long-lived clients (gRPC channels) shared by all requests in a process
+DAPR_CLIENT_POOL_SIZE = int(os.getenv("DAPR_CLIENT_POOL_SIZE", "1"))
+
+# gRPC status codes that mean the channel to the sidecar is unusable
+_RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.CANCELLED)
+
+_lock = threading.Lock()
+_pool = []
+_next_slot = None
+_owner_pid = None
+_client_factory = DaprClient
+
+
+class _ClientSlot:
+    """
+    Forwards calls to a long-lived client and replaces that client when a
+    call fails because its channel to the sidecar is broken
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._client = factory()
+
+    def __getattr__(self, name):
+        client = self._client
+        attr = getattr(client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                observe_dapr_call(name, kwargs, time.perf_counter() - start, failed=True)
+                if isinstance(e, grpc.RpcError) and e.code() in _RECONNECT_CODES:
+                    self._reconnect(client)
+                raise
+            observe_dapr_call(name, kwargs, time.perf_counter() - start, result)
+            return result
+        return call
+
+    def _reconnect(self, failed):
+        with self._lock:
+            if self._client is not failed:
+                return
+            logger.warning("Reconnecting Dapr client after channel failure")
+            self._client = self._factory()
+        _close_quietly(failed)
+
+    def close(self):
+        _close_quietly(self._client)
+
+
+def set_client_factory(factory):
+    """
+    Replace the callable used to create clients (e.g. with a fake for benchmarks)
+    """
+    global _client_factory
+    close_client()
+    _client_factory = factory
+
+
+def init_client():
+    """
+    Create the process-wide client pool. Safe to call more than once.
+    """
+    with _lock:
+        _ensure_pool()
+
+
+def get_client():
+    """
+    Return a long-lived client from the pool, creating the pool on first use
+    """
+    with _lock:
+        _ensure_pool()
+        return next(_next_slot)
+
+
+def _ensure_pool():
+    global _pool, _next_slot, _owner_pid
+    # Channels must not be shared across fork(); rebuild them in the child
+    if _pool and _owner_pid == os.getpid():
+        return
+    logger.info("Creating %s Dapr client(s) for pid %s", DAPR_CLIENT_POOL_SIZE, os.getpid())
+    _pool = [_ClientSlot(_client_factory) for _ in range(max(1, DAPR_CLIENT_POOL_SIZE))]
+    _next_slot = itertools.cycle(_pool)
+    _owner_pid = os.getpid()
+
+
+def close_client():
+    """
+    Close every client in the pool. Called automatically at interpreter exit.
+    """
+    global _pool, _next_slot, _owner_pid
+    with _lock:
+        pool, _pool, _next_slot, _owner_pid = _pool, [], None, None
+    for slot in pool:
+        slot.close()
+
+
+def _close_quietly(client):
+    try:
+        client.close()
+    except Exception as e:
+        logger.debug("Error closing Dapr client: %s", e)
+
+
+@contextmanager
+def dapr_client():
+    """
+    Drop-in replacement for `with DaprClient() as client:` that reuses a
+    shared client instead of opening a new channel for every request
+    """
+    yield get_client()
+
+
+atexit.register(close_client)